@@ -0,0 +1,184 @@
+from sqlalchemy import select, func, text
+from models import db, User, Doctor, Department, DoctorDailyStats
+from datetime import date, timedelta
+import availability
+import database
+
+# doctor_daily_stats holds one row per doctor per day with the number of
+# appointments in each status and the slots the doctor published. SQLite
+# triggers keep it current on every write path (booking's INSERT ... SELECT,
+# status changes, bulk imports, deletes) inside the writing transaction, so
+# reports read a few rows per doctor per day instead of scanning appointments.
+# Appointments moved to appointments_archive by lifecycle.py stay counted
+# until they are deleted from the archive (see deletion.py).
+
+STATUS_COLUMNS = {
+    "Booked": "booked", "Completed": "completed", "Cancelled": "cancelled", "No-show": "no_show"
+}
+MAX_RANGE_DAYS = 366
+DEFAULT_PAST_DAYS = 30
+
+# lifecycle.py copies a row into the archive before deleting it from the live
+# table; such deletes are moves, not removals
+ARCHIVED = (
+    "WHEN NOT EXISTS (SELECT 1 FROM appointments_archive a WHERE a.id = OLD.id "
+    "AND a.doctor_id = OLD.doctor_id AND a.date = OLD.date AND a.status IS OLD.status)"
+)
+
+
+def _add(row, sign):
+    # upsert adding (or with sign "-", removing) one appointment
+    counts = ", ".join(f"{row}.status = '{status}'" for status in STATUS_COLUMNS)
+    updates = ", ".join(
+        f"{column} = {column} {sign} excluded.{column}" for column in STATUS_COLUMNS.values()
+    )
+    return (
+        f"INSERT INTO doctor_daily_stats (doctor_id, date, {', '.join(STATUS_COLUMNS.values())}) "
+        f"VALUES ({row}.doctor_id, {row}.date, {counts}) "
+        f"ON CONFLICT (doctor_id, date) DO UPDATE SET {updates};"
+    )
+
+
+def _slots(row, sign):
+    return (
+        f"INSERT INTO doctor_daily_stats (doctor_id, date, published_slots) "
+        f"VALUES ({row}.doctor_id, {row}.date, 1) "
+        f"ON CONFLICT (doctor_id, date) DO UPDATE SET published_slots = published_slots {sign} 1;"
+    )
+
+
+TRIGGERS = {
+    "trg_stats_appointment_insert":
+        f"AFTER INSERT ON appointments BEGIN {_add('NEW', '+')} END",
+    "trg_stats_appointment_delete":
+        f"AFTER DELETE ON appointments {ARCHIVED} BEGIN {_add('OLD', '-')} END",
+    "trg_stats_appointment_update":
+        f"AFTER UPDATE OF status, doctor_id, date ON appointments BEGIN "
+        f"{_add('OLD', '-')} {_add('NEW', '+')} END",
+    "trg_stats_archive_delete":
+        f"AFTER DELETE ON appointments_archive BEGIN {_add('OLD', '-')} END",
+    "trg_stats_slot_insert":
+        f"AFTER INSERT ON doctor_availability BEGIN {_slots('NEW', '+')} END",
+    "trg_stats_slot_delete":
+        f"AFTER DELETE ON doctor_availability BEGIN {_slots('OLD', '-')} END",
+}
+
+POPULATE = [
+    "DELETE FROM doctor_daily_stats",
+    "INSERT INTO doctor_daily_stats (doctor_id, date, booked, completed, cancelled, no_show) "
+    "SELECT doctor_id, date, "
+    "SUM(status = 'Booked'), SUM(status = 'Completed'), SUM(status = 'Cancelled'), SUM(status = 'No-show') "
+    "FROM (SELECT doctor_id, date, status FROM appointments "
+    "UNION ALL SELECT doctor_id, date, status FROM appointments_archive) "
+    "GROUP BY doctor_id, date",
+    "INSERT INTO doctor_daily_stats (doctor_id, date, published_slots) "
+    "SELECT doctor_id, date, COUNT(*) FROM doctor_availability WHERE true GROUP BY doctor_id, date "
+    "ON CONFLICT (doctor_id, date) DO UPDATE SET published_slots = excluded.published_slots",
+]
+
+
+def ensure_rollups(engine):
+    # Creating the triggers and filling the table happen in one transaction,
+    # so no write can land between the backfill and the first trigger.
+    with engine.begin() as conn:
+        if not database.sync_triggers(conn, "trg_stats_", TRIGGERS):
+            return False
+        for statement in POPULATE:
+            conn.execute(text(statement))
+        return True
+
+
+def _rate(part, whole):
+    return round(part / whole, 4) if whole else None
+
+
+def _figures(booked, completed, cancelled, no_show, published, filled):
+    booked, completed, cancelled, no_show, published, filled = (
+        int(booked or 0), int(completed or 0), int(cancelled or 0), int(no_show or 0),
+        int(published or 0), int(filled or 0)
+    )
+    total = booked + completed + cancelled + no_show
+    return {
+        "appointments": total,
+        "booked": booked,
+        "completed": completed,
+        "cancelled": cancelled,
+        "no_show": no_show,
+        "published_slots": published,
+        "filled_slots": filled,
+        "utilization": _rate(filled, published),
+        "cancellation_rate": _rate(cancelled, total),
+        "no_show_rate": _rate(no_show, total),
+    }
+
+
+def _sums():
+    return (
+        func.sum(DoctorDailyStats.booked),
+        func.sum(DoctorDailyStats.completed),
+        func.sum(DoctorDailyStats.cancelled),
+        func.sum(DoctorDailyStats.no_show),
+        func.sum(DoctorDailyStats.published_slots),
+        # days without published slots (older history) do not count towards
+        # utilization, and a day cannot be more than full; a no-show still
+        # held its slot
+        func.sum(func.min(
+            DoctorDailyStats.booked + DoctorDailyStats.completed + DoctorDailyStats.no_show,
+            DoctorDailyStats.published_slots
+        )),
+    )
+
+
+def default_range(today=None):
+    today = today or date.today()
+    return today - timedelta(days=DEFAULT_PAST_DAYS), today + timedelta(days=availability.WINDOW_DAYS - 1)
+
+
+def report(start, end):
+    # Work is bounded by doctors x days in the range, not by how many
+    # appointments exist.
+    in_range = (DoctorDailyStats.date >= start, DoctorDailyStats.date <= end)
+
+    totals = db.session.execute(select(*_sums()).where(*in_range)).one()
+
+    daily = db.session.execute(
+        select(DoctorDailyStats.date, *_sums()).where(*in_range)
+        .group_by(DoctorDailyStats.date).order_by(DoctorDailyStats.date)
+    ).all()
+
+    doctors = db.session.execute(
+        select(Doctor.id, User.name, Department.name, *_sums())
+        .select_from(DoctorDailyStats)
+        .join(Doctor, Doctor.id == DoctorDailyStats.doctor_id)
+        .join(User, User.id == Doctor.user_id)
+        .outerjoin(Department, Department.id == Doctor.department_id)
+        .where(*in_range)
+        .group_by(Doctor.id)
+        .order_by(User.name)
+    ).all()
+
+    departments = db.session.execute(
+        select(Department.id, Department.name, *_sums())
+        .select_from(DoctorDailyStats)
+        .join(Doctor, Doctor.id == DoctorDailyStats.doctor_id)
+        .outerjoin(Department, Department.id == Doctor.department_id)
+        .where(*in_range)
+        .group_by(Department.id)
+        .order_by(Department.name)
+    ).all()
+
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "totals": _figures(*totals),
+        "daily": [
+            {"date": row[0].isoformat(), **_figures(*row[1:])} for row in daily
+        ],
+        "doctors": [
+            {"id": row[0], "name": row[1], "department": row[2], **_figures(*row[3:])}
+            for row in doctors
+        ],
+        "departments": [
+            {"id": row[0], "name": row[1], **_figures(*row[2:])} for row in departments
+        ],
+    }
@@ -1,6 +1,12 @@
 from flask import Flask, render_template
 from flask_login import LoginManager
 from models import db, User
+import database
+import fragment_cache
+import lifecycle
+import migrations
+import passwords
+import principal_cache
 from dotenv import load_dotenv
 import os
 
@@ -8,19 +14,46 @@ def create_app():
     load_dotenv()
     app = Flask(__name__, instance_relative_config=True)
     app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hms.db'
+    database.load_config(app)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQL_INSTRUMENTATION'] = os.getenv("SQL_INSTRUMENTATION", "0") == "1"
+    app.config['SQL_N_PLUS_ONE_THRESHOLD'] = int(os.getenv("SQL_N_PLUS_ONE_THRESHOLD", "5"))
+    app.config['PRINCIPAL_CACHE_SIZE'] = int(os.getenv("PRINCIPAL_CACHE_SIZE", "4096"))
+    app.config['PRINCIPAL_CACHE_TTL'] = int(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+    app.config['PASSWORD_HASH_METHOD'] = os.getenv("PASSWORD_HASH_METHOD", passwords.DEFAULT_METHOD)
+    app.config['PASSWORD_POOL_WORKERS'] = int(os.getenv("PASSWORD_POOL_WORKERS") or min(os.cpu_count() or 1, 4))
+    app.config['PASSWORD_POOL_MAX_PENDING'] = int(os.getenv("PASSWORD_POOL_MAX_PENDING", "8"))
+    app.config['PASSWORD_POOL_TIMEOUT'] = float(os.getenv("PASSWORD_POOL_TIMEOUT", "2"))
+    app.config['FRAGMENT_CACHE_MAX_BYTES'] = int(os.getenv("FRAGMENT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    app.config['FRAGMENT_CACHE_TTL'] = int(os.getenv("FRAGMENT_CACHE_TTL", "300"))
+    app.config['FRAGMENT_CACHE_DIR'] = os.getenv("FRAGMENT_CACHE_DIR")
+    app.config['API_COMPRESS_MIN_BYTES'] = int(os.getenv("API_COMPRESS_MIN_BYTES", "500"))
+    app.config['WAITLIST_POLL_TIMEOUT'] = float(os.getenv("WAITLIST_POLL_TIMEOUT", "25"))
+    app.config['WAITLIST_STREAM_SECONDS'] = int(os.getenv("WAITLIST_STREAM_SECONDS", "300"))
+    app.config['EVENTS_STREAM_SECONDS'] = int(os.getenv("EVENTS_STREAM_SECONDS", "300"))
+    app.config['LIFECYCLE_INTERVAL'] = int(os.getenv("LIFECYCLE_INTERVAL", "0"))
+    app.config['LIFECYCLE_ARCHIVE_AFTER_DAYS'] = int(os.getenv("LIFECYCLE_ARCHIVE_AFTER_DAYS", str(lifecycle.ARCHIVE_AFTER_DAYS)))
 
     db.init_app(app)
 
+    with app.app_context():
+        database.init_engine(app, db.engine)
+
+    if app.config['SQL_INSTRUMENTATION']:
+        import instrumentation
+        instrumentation.init_app(app, app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+
     login_manager = LoginManager()
     login_manager.login_view = "auth.login"
     login_manager.init_app(app)
+    principal_cache.init_app(app)
+    passwords.init_app(app)
+    fragment_cache.init_app(app)
 
     @login_manager.user_loader
     def load_user(user_id):
         try:
-            return User.query.get(int(user_id))
+            return principal_cache.load(int(user_id))
         except Exception:
             return None
     
@@ -28,14 +61,20 @@ def create_app():
     from blueprints.admin import admin_bp
     from blueprints.doctor import doctor_bp
     from blueprints.patient import patient_bp
+    from blueprints.api import api_bp
 
     app.register_blueprint(auth_bp, url_prefix="/auth")
     app.register_blueprint(admin_bp, url_prefix="/admin")
     app.register_blueprint(doctor_bp, url_prefix="/doctor")
     app.register_blueprint(patient_bp, url_prefix="/patient")
+    app.register_blueprint(api_bp, url_prefix="/api/v1")
+
+    from cli import register_commands
+    register_commands(app)
 
     with app.app_context():
         db.create_all()
+        migrations.upgrade(db.engine)
 
         admin = User.query.filter_by(role="admin").first()
         if not admin:
@@ -51,6 +90,8 @@ def create_app():
         else:
             print(">> Admin already exists")
 
+    lifecycle.init_app(app)
+
     @app.route("/")
     def home():
         return render_template("index.html")
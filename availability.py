@@ -0,0 +1,247 @@
+from sqlalchemy import select, func, case, and_, or_, delete, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, User, Doctor, Department, DoctorAvailability, Appointment
+from datetime import date, time, timedelta
+
+WINDOW_DAYS = 7
+
+
+def parse_range(value):
+    # "9:00-10:30" -> (time(9, 0), time(10, 30)); None for blank or malformed input
+    if not value or "-" not in value:
+        return None
+    try:
+        start, end = value.strip().split("-", 1)
+        h1, m1 = map(int, start.strip().split(":"))
+        h2, m2 = map(int, end.strip().split(":"))
+        return time(h1, m1), time(h2, m2)
+    except ValueError:
+        return None
+
+
+def format_range(time_start, time_end):
+    return f"{time_start.strftime('%H:%M')}-{time_end.strftime('%H:%M')}"
+
+
+def period(time_start):
+    return "morning" if time_start < time(12, 0) else "evening"
+
+
+def window_dates(start=None, days=WINDOW_DAYS):
+    start = start or date.today()
+    return [start + timedelta(days=i) for i in range(days)]
+
+
+def replace_days(doctor_id, slots_by_date):
+    # Bulk upsert of a doctor's slots. Every date in slots_by_date is replaced:
+    # listed (time_start, time_end) slots are inserted or updated in one
+    # statement and any other slot on those dates is removed.
+    dates = list(slots_by_date)
+    if not dates:
+        return 0
+
+    rows = [
+        {
+            "doctor_id": doctor_id,
+            "date": day,
+            "time_start": slot[0],
+            "time_end": slot[1],
+        }
+        for day, slots in slots_by_date.items()
+        for slot in slots
+    ]
+
+    stale = delete(DoctorAvailability).where(
+        DoctorAvailability.doctor_id == doctor_id,
+        DoctorAvailability.date.in_(dates)
+    )
+    if rows:
+        stale = stale.where(
+            tuple_(DoctorAvailability.date, DoctorAvailability.time_start).not_in(
+                [(r["date"], r["time_start"]) for r in rows]
+            )
+        )
+    db.session.execute(stale)
+
+    if rows:
+        stmt = sqlite_insert(DoctorAvailability).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["doctor_id", "date", "time_start"],
+            set_={"time_end": stmt.excluded.time_end}
+        )
+        db.session.execute(stmt)
+
+    return len(rows)
+
+
+def slots_in_window(doctor_ids, start, end):
+    # {doctor_id: {date: [slot, ...]}} for every requested doctor in one query
+    rows = DoctorAvailability.query.filter(
+        DoctorAvailability.doctor_id.in_(doctor_ids),
+        DoctorAvailability.date >= start,
+        DoctorAvailability.date <= end
+    ).order_by(
+        DoctorAvailability.doctor_id,
+        DoctorAvailability.date,
+        DoctorAvailability.time_start
+    ).all()
+
+    result = {}
+    for slot in rows:
+        result.setdefault(slot.doctor_id, {}).setdefault(slot.date, []).append(slot)
+    return result
+
+
+def _slot_join():
+    return and_(
+        Appointment.doctor_id == DoctorAvailability.doctor_id,
+        Appointment.date == DoctorAvailability.date,
+        Appointment.time_start == DoctorAvailability.time_start,
+        Appointment.status == "Booked"
+    )
+
+
+def grid_statement(doctor_id, start, end, patient_id=None):
+    mine = func.max(case((Appointment.patient_id == patient_id, 1), else_=0))
+    return select(
+        DoctorAvailability.date,
+        DoctorAvailability.time_start,
+        DoctorAvailability.time_end,
+        func.count(Appointment.id).label("booked"),
+        mine.label("mine")
+    ).outerjoin(
+        Appointment, _slot_join()
+    ).where(
+        DoctorAvailability.doctor_id == doctor_id,
+        DoctorAvailability.date >= start,
+        DoctorAvailability.date <= end
+    ).group_by(
+        DoctorAvailability.id
+    ).order_by(
+        DoctorAvailability.date,
+        DoctorAvailability.time_start
+    )
+
+
+def grid(doctor_id, start, end, patient_id=None):
+    # Published slots for the window with their booking state, in one query.
+    rows = db.session.execute(grid_statement(doctor_id, start, end, patient_id)).all()
+
+    by_date = {}
+    for row in rows:
+        by_date.setdefault(row.date, []).append({
+            "period": period(row.time_start),
+            "label": format_range(row.time_start, row.time_end),
+            "time_start": row.time_start.strftime("%H:%M"),
+            "time_end": row.time_end.strftime("%H:%M"),
+            "booked": row.booked > 0,
+            "mine": bool(row.mine),
+        })
+
+    return [
+        {"date": day.strftime("%Y-%m-%d"), "slots": by_date.get(day, [])}
+        for day in window_dates(start, (end - start).days + 1)
+    ]
+
+
+def booked_by_patient_statement(patient_id, doctor_id, start, end):
+    return select(Appointment.date, Appointment.time_start).where(
+        Appointment.patient_id == patient_id,
+        Appointment.date >= start,
+        Appointment.date <= end,
+        Appointment.doctor_id == doctor_id,
+        Appointment.status == "Booked"
+    )
+
+
+def booked_by_patient(patient_id, doctor_id, start, end):
+    # {"YYYY-MM-DD HH:MM", ...} for the patient's active bookings with the doctor
+    rows = db.session.execute(booked_by_patient_statement(patient_id, doctor_id, start, end))
+    return {f"{row.date.strftime('%Y-%m-%d')} {row.time_start.strftime('%H:%M')}" for row in rows}
+
+
+def free_slots(doctor_id, start, end):
+    # Slots in the window nobody has booked; a slot takes one booking (see
+    # uq_appointments_active_slot)
+    return db.session.query(DoctorAvailability).outerjoin(
+        Appointment, _slot_join()
+    ).filter(
+        DoctorAvailability.doctor_id == doctor_id,
+        DoctorAvailability.date >= start,
+        DoctorAvailability.date <= end
+    ).group_by(
+        DoctorAvailability.id
+    ).having(
+        func.count(Appointment.id) == 0
+    ).order_by(
+        DoctorAvailability.date,
+        DoctorAvailability.time_start
+    ).all()
+
+
+def first_available_statement(start, end, department_id=None, specialization=None,
+                              after_time=None, limit=10):
+    booked = func.count(Appointment.id)
+
+    stmt = select(
+        DoctorAvailability.doctor_id,
+        DoctorAvailability.date,
+        DoctorAvailability.time_start,
+        DoctorAvailability.time_end,
+        User.name.label("doctor_name"),
+        Doctor.specialization,
+        Department.name.label("department")
+    ).join(
+        Doctor, Doctor.id == DoctorAvailability.doctor_id
+    ).join(
+        User, User.id == Doctor.user_id
+    ).outerjoin(
+        Department, Department.id == Doctor.department_id
+    ).outerjoin(
+        Appointment, _slot_join()
+    ).where(
+        DoctorAvailability.date >= start,
+        DoctorAvailability.date <= end
+    )
+
+    if after_time is not None:
+        # skip slots that already started on the first day of the range
+        stmt = stmt.where(or_(
+            DoctorAvailability.date > start,
+            DoctorAvailability.time_start >= after_time
+        ))
+    if department_id is not None:
+        stmt = stmt.where(Doctor.department_id == department_id)
+    if specialization:
+        stmt = stmt.where(Doctor.specialization.ilike(specialization))
+
+    return stmt.group_by(
+        DoctorAvailability.id
+    ).having(
+        booked == 0
+    ).order_by(
+        DoctorAvailability.date,
+        DoctorAvailability.time_start,
+        DoctorAvailability.doctor_id
+    ).limit(limit)
+
+
+def first_available(start, end, department_id=None, specialization=None,
+                    after_time=None, limit=10):
+    # The earliest open slots across every matching doctor, in one query
+    rows = db.session.execute(first_available_statement(
+        start, end, department_id, specialization, after_time, limit
+    )).all()
+
+    return [
+        {
+            "doctor_id": row.doctor_id,
+            "doctor_name": row.doctor_name,
+            "specialization": row.specialization,
+            "department": row.department,
+            "date": row.date.strftime("%Y-%m-%d"),
+            "time_start": row.time_start.strftime("%H:%M"),
+            "time_end": row.time_end.strftime("%H:%M"),
+        }
+        for row in rows
+    ]
@@ -1,7 +1,21 @@
-from flask import Blueprint, request, render_template, redirect, url_for
+from flask import Blueprint, request, render_template, stream_template, redirect, url_for, current_app, abort
 from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload
 from models import db, User, Doctor, Patient, Department, Appointment, Treatment
-from datetime import datetime
+from datetime import datetime, date
+from blueprints.auth import busy
+import analytics
+import bulk_admin
+import deletion
+import events
+import fragment_cache
+import passwords
+import queries
+import instrumentation
+import principal_cache
+import search_index
+import treatments
+import waitlist
 
 admin_bp = Blueprint("admin", __name__)
 
@@ -16,21 +30,25 @@ def dashboard():
     if not admin_only():
         return "Access denied", 403
 
-    doctors = Doctor.query.all()
-    patients = Patient.query.all()
+    per_page = queries.page_size_arg(request.args)
+    since = events.position()
 
-    upcoming = Appointment.query.filter(
-        Appointment.date >= datetime.today().date(),
-        Appointment.status == "Booked"
-    ).order_by(Appointment.date).all()
+    doctors = queries.dashboard_doctors(request.args.get("doctors_after"), per_page)
+    patients = queries.dashboard_patients(request.args.get("patients_after"), per_page)
+    upcoming = queries.dashboard_upcoming(request.args.get("upcoming_after"), per_page)
 
     return render_template(
         "admin/dashboard.html",
         doctors=doctors,
         patients=patients,
         upcoming=upcoming,
-        total_doctors=len(doctors),
-        total_patients=len(patients),
+        total_doctors=doctors.total,
+        total_patients=patients.total,
+        total_upcoming=upcoming.total,
+        per_page=per_page,
+        paginated=True,
+        since=since,
+        today=date.today().isoformat()
     )
 
 @admin_bp.route("/appointment/cancel/<int:app_id>")
@@ -40,12 +58,110 @@ def admin_cancel_appointment(app_id):
         return "Access denied", 403
 
     app = Appointment.query.get_or_404(app_id)
-    app.status = "Cancelled"
+    # the freed slot goes to the next patient on the waitlist, if any
+    entry = waitlist.release(app)
     db.session.commit()
+    fragment_cache.invalidate_doctor(app.doctor_id)
+    events.released(app.id, entry)
 
     return redirect(url_for("admin.dashboard"))
 
 
+@admin_bp.route("/events")
+@login_required
+def dashboard_events():
+    # Server-sent deltas for every doctor's appointments
+    if not admin_only():
+        return "Access denied", 403
+
+    return events.stream(
+        "admin",
+        request.headers.get("Last-Event-ID") or request.args.get("since"),
+        current_app.config["EVENTS_STREAM_SECONDS"]
+    )
+
+
+@admin_bp.route("/appointments/bulk", methods=["POST"])
+@login_required
+def bulk_appointments():
+    # cancel or delete the appointments ticked on the dashboard
+    if not admin_only():
+        return "Access denied", 403
+
+    ids = request.form.getlist("ids", type=int)
+    if not ids:
+        return redirect(url_for("admin.dashboard"))
+    try:
+        summary = bulk_admin.apply_selection(request.form.get("action"), ids)
+    except ValueError as e:
+        return str(e), 400
+
+    db.session.commit()
+    summary.announce()
+    return render_template("admin/bulk_result.html", summary=summary.as_dict())
+
+
+@admin_bp.route("/doctors/<int:doctor_id>/appointments", methods=["GET"])
+@login_required
+def doctor_appointments_page(doctor_id):
+    if not admin_only():
+        return "Access denied", 403
+
+    doctor = Doctor.query.options(joinedload(Doctor.user)).get_or_404(doctor_id)
+    return render_template(
+        "admin/doctor_appointments.html",
+        doctor=doctor,
+        colleagues=colleagues(doctor),
+        form={}
+    )
+
+
+@admin_bp.route("/doctors/<int:doctor_id>/appointments", methods=["POST"])
+@login_required
+def doctor_appointments(doctor_id):
+    # cancel or reassign everything the doctor has booked in a date range
+    if not admin_only():
+        return "Access denied", 403
+
+    doctor = Doctor.query.options(joinedload(Doctor.user)).get_or_404(doctor_id)
+    form = request.form
+    summary, error = None, None
+    try:
+        summary = bulk_admin.apply_range(
+            doctor.id,
+            form.get("action"),
+            queries.date_arg(form, "start"),
+            queries.date_arg(form, "end"),
+            target_id=form.get("target_id", type=int),
+            close=form.get("close") == "1",
+            cancel_unmoved=form.get("cancel_unmoved") == "1"
+        )
+    except ValueError as e:
+        db.session.rollback()
+        error = str(e)
+    else:
+        db.session.commit()
+        summary.announce()
+
+    return render_template(
+        "admin/doctor_appointments.html",
+        doctor=doctor,
+        colleagues=colleagues(doctor),
+        form=form,
+        summary=summary.as_dict() if summary else None,
+        error=error
+    ), 400 if error else 200
+
+
+def colleagues(doctor):
+    if doctor.department_id is None:
+        return []
+    return Doctor.query.options(joinedload(Doctor.user)).filter(
+        Doctor.department_id == doctor.department_id,
+        Doctor.id != doctor.id
+    ).order_by(Doctor.id).all()
+
+
 @admin_bp.route("/search")
 @login_required
 def search():
@@ -54,8 +170,8 @@ def search():
 
     query = request.args.get("query", "")
 
-    doctors = Doctor.query.join(User).filter(User.name.contains(query)).all()
-    patients = Patient.query.join(User).filter(User.name.contains(query)).all()
+    doctors = queries.search_doctors(query)
+    patients = queries.search_patients(query)
 
     return render_template(
         "admin/dashboard.html",
@@ -95,7 +211,10 @@ def add_doctor():
         return "Email already exists", 400
 
     user = User(name=name, email=email, role="doctor")
-    user.set_password(password)
+    try:
+        user.set_password(password)
+    except passwords.PoolSaturated:
+        return busy()
     db.session.add(user)
     db.session.commit()
 
@@ -105,6 +224,8 @@ def add_doctor():
         department_id=department_id or None,
     )
     db.session.add(doctor)
+    db.session.flush()
+    search_index.index_doctor(doctor.id)
     db.session.commit()
 
     return redirect(url_for("admin.dashboard"))
@@ -159,11 +280,16 @@ def edit_doctor(doctor_id):
         return "Access denied", 403
 
     doctor = Doctor.query.get_or_404(doctor_id)
-    
+    user_id = doctor.user_id
+
     doctor.specialization = request.form.get("specialization")
     doctor.department_id = request.form.get("department_id")
 
+    db.session.flush()
+    search_index.index_doctor(doctor.id)
     db.session.commit()
+    principal_cache.invalidate(user_id)
+    fragment_cache.invalidate_doctor(doctor_id)
     return redirect(url_for("admin.dashboard"))
 
 
@@ -176,14 +302,8 @@ def delete_doctor(doctor_id):
     if not admin_only():
         return "Access denied", 403
 
-    doctor = Doctor.query.get_or_404(doctor_id)
-    user = doctor.user
-
-    Appointment.query.filter_by(doctor_id=doctor_id).delete()
-
-    db.session.delete(doctor)
-    db.session.delete(user)
-    db.session.commit()
+    if deletion.delete_doctor(doctor_id) is None:
+        abort(404)
 
     return redirect(url_for("admin.dashboard"))
 
@@ -195,14 +315,22 @@ def delete_patient(patient_id):
     if not admin_only():
         return "Access denied", 403
 
-    patient = Patient.query.get_or_404(patient_id)
-    user = patient.user
+    if deletion.delete_patient(patient_id) is None:
+        abort(404)
+
+    return redirect(url_for("admin.dashboard"))
 
-    Appointment.query.filter_by(patient_id=patient_id).delete()
 
-    db.session.delete(patient)
-    db.session.delete(user)
-    db.session.commit()
+@admin_bp.route("/patients/anonymize/<int:patient_id>", methods=["POST"])
+@login_required
+def anonymize_patient(patient_id):
+    # keeps the visit history for the doctors, drops who the patient was;
+    # POST only, so a prefetched or embedded link cannot trigger it
+    if not admin_only():
+        return "Access denied", 403
+
+    if deletion.anonymize_patient(patient_id) is None:
+        abort(404)
 
     return redirect(url_for("admin.dashboard"))
 
@@ -213,63 +341,91 @@ def patient_history(patient_id):
     if not admin_only():
         return "Access denied", 403
 
-    patient = Patient.query.get_or_404(patient_id)
-
-    appointments = Appointment.query.filter_by(patient_id=patient_id).order_by(
-        Appointment.date
-    ).all()
-
-    history = []
-
-    for a in appointments:
-        if a.treatment:
-
-            raw = a.treatment.notes or ""
-            cleaned = raw.replace("\n", " ").replace("  ", " ")
-
-            vt = ""
-            td = ""
-            md = ""
-
-            if "Visit Type:" in cleaned:
-                try:
-                    vt = cleaned.split("Visit Type:")[1].split("Tests:")[0].strip()
-                except:
-                    pass
-
-            if "Tests:" in cleaned:
-                try:
-                    td = cleaned.split("Tests:")[1].split("Medicines:")[0].strip()
-                except:
-                    pass
-
-            if "Medicines:" in cleaned:
-                try:
-                    md = cleaned.split("Medicines:")[1].strip()
-                except:
-                    pass
-
-            vt = vt.rstrip(",").strip()
-            td = td.rstrip(",").strip()
-            md = md.rstrip(",").strip()
-
-            history.append({
-                "visit_type": vt,
-                "test_done": td,
-                "diagnosis": a.treatment.diagnosis,
-                "prescription": a.treatment.prescription,
-                "medicines": md,
-                "doctor": a.doctor.user.name,
-                "department": a.doctor.department.name if a.doctor.department else None,
-                "date": a.date,
-                "time_start": a.time_start,
-                "time_end": a.time_end,
-                "status": a.status,
-                "appointment_id": a.id
-            })
+    # the page streams after the view returns, so load everything it renders now
+    patient = Patient.query.options(joinedload(Patient.user)).get_or_404(patient_id)
 
-    return render_template(
+    start = queries.date_arg(request.args, "start")
+    end = queries.date_arg(request.args, "end")
+
+    page = queries.history_page(
+        patient.id,
+        start=start,
+        end=end,
+        cursor=request.args.get("after"),
+        page_size=queries.page_size_arg(request.args)
+    )
+
+    return stream_template(
         "admin/patient_history.html",
         patient=patient,
-        history=history
-    )
\ No newline at end of file
+        history=page.items,
+        page=page,
+        start=start,
+        end=end
+    )
+
+
+@admin_bp.route("/prescriptions")
+@login_required
+def prescribed_patients():
+    if not admin_only():
+        return "Access denied", 403
+
+    medicine = request.args.get("medicine", "").strip()
+    if not medicine:
+        return {"error": "medicine is required"}, 400
+
+    return {
+        "medicine": medicine,
+        "patients": [
+            {"id": row.id, "name": row.name, "email": row.email}
+            for row in treatments.patients_prescribed(medicine)
+        ]
+    }
+
+
+@admin_bp.route("/analytics")
+@login_required
+def analytics_report():
+    if not admin_only():
+        return "Access denied", 403
+
+    start, end = analytics.default_range()
+    start = queries.date_arg(request.args, "start") or start
+    end = queries.date_arg(request.args, "end") or end
+
+    if end < start:
+        return {"error": "end must not be before start"}, 400
+    if (end - start).days >= analytics.MAX_RANGE_DAYS:
+        return {"error": f"range is limited to {analytics.MAX_RANGE_DAYS} days"}, 400
+
+    return analytics.report(start, end)
+
+
+@admin_bp.route("/fragment-cache")
+@login_required
+def fragment_cache_report():
+    if not admin_only():
+        return "Access denied", 403
+
+    report = fragment_cache.stats()
+    if request.args.get("reset") == "1":
+        fragment_cache.reset_stats()
+
+    return report
+
+
+@admin_bp.route("/instrumentation")
+@login_required
+def instrumentation_report():
+    if not admin_only():
+        return "Access denied", 403
+
+    if not instrumentation.enabled(current_app):
+        return {"error": "SQL instrumentation is disabled; set SQL_INSTRUMENTATION=1"}, 404
+
+    report = instrumentation.snapshot()
+    if request.args.get("reset") == "1":
+        instrumentation.reset()
+
+    return {"endpoints": report}
@@ -0,0 +1,597 @@
+from flask import Blueprint, request, abort
+from flask_login import current_user
+from sqlalchemy import select, func
+from sqlalchemy.orm import aliased
+from models import db, User, Doctor, Patient, Department, Appointment, WaitlistEntry
+from datetime import datetime, date, time
+import booking
+import bulk_admin
+import compression
+import deletion
+import events
+import fragment_cache
+import projection
+import queries
+import schedules
+import search_index
+import waitlist
+
+# Versioned JSON API for the mobile and kiosk clients, mounted at /api/v1.
+# Every list takes ?fields=a,b to pick columns, ?per_page= and ?after=<cursor>
+# and answers {"data": [...], "next": <cursor or null>}. Sessions are the same
+# flask-login cookies as the HTML views.
+
+api_bp = Blueprint("api", __name__)
+api_bp.after_request(compression.compress)
+
+DoctorUser = aliased(User)
+PatientUser = aliased(User)
+
+APPOINTMENTS = projection.Resource(
+    Appointment,
+    {
+        "id": Appointment.id,
+        "date": Appointment.date,
+        "time_start": Appointment.time_start,
+        "time_end": Appointment.time_end,
+        "status": Appointment.status,
+        "doctor_id": Appointment.doctor_id,
+        "doctor": (DoctorUser.name, ["doctor", "doctor_user"]),
+        "specialization": (Doctor.specialization, ["doctor"]),
+        "department": (Department.name, ["doctor", "department"]),
+        "patient_id": Appointment.patient_id,
+        "patient": (PatientUser.name, ["patient", "patient_user"]),
+    },
+    joins={
+        "doctor": (Doctor, Doctor.id == Appointment.doctor_id, False),
+        "doctor_user": (DoctorUser, DoctorUser.id == Doctor.user_id, False),
+        "department": (Department, Department.id == Doctor.department_id, True),
+        "patient": (Patient, Patient.id == Appointment.patient_id, False),
+        "patient_user": (PatientUser, PatientUser.id == Patient.user_id, False),
+    },
+    default=["id", "date", "time_start", "time_end", "status", "doctor_id", "doctor", "department"],
+)
+
+DOCTORS = projection.Resource(
+    Doctor,
+    {
+        "id": Doctor.id,
+        "name": (User.name, ["user"]),
+        "specialization": Doctor.specialization,
+        "department_id": Doctor.department_id,
+        "department": (Department.name, ["department"]),
+        "version": Doctor.version,
+    },
+    joins={
+        "user": (User, User.id == Doctor.user_id, False),
+        "department": (Department, Department.id == Doctor.department_id, True),
+    },
+    default=["id", "name", "specialization", "department"],
+)
+
+PATIENTS = projection.Resource(
+    Patient,
+    {
+        "id": Patient.id,
+        "name": (User.name, ["user"]),
+        "email": (User.email, ["user"]),
+        "dob": Patient.dob,
+        "contact": Patient.contact,
+        "address": Patient.address,
+    },
+    joins={"user": (User, User.id == Patient.user_id, False)},
+    default=["id", "name", "email", "contact"],
+)
+
+# history rows come from queries.history_page, which already reads columns
+HISTORY_FIELDS = [
+    "appointment_id", "date", "time_start", "time_end", "status", "doctor", "department",
+    "visit_type", "test_done", "diagnosis", "prescription", "medicines", "archived",
+]
+
+BOOKING_ERRORS = {
+    "unavailable": ("Slot not offered", 422),
+    "booked": ("Slot already booked", 409),
+    "own": ("You already have a booking at this time", 409),
+}
+
+
+@api_bp.before_request
+def require_login():
+    if not current_user.is_authenticated:
+        return {"error": "Login required"}, 401
+
+
+@api_bp.errorhandler(projection.UnknownField)
+def unknown_field(e):
+    return {"error": f"Unknown field: {e}"}, 400
+
+
+@api_bp.errorhandler(404)
+def not_found(e):
+    return {"error": "Not found"}, 404
+
+
+def denied():
+    return {"error": "Access denied"}, 403
+
+
+def list_page(resource, keyset, where=(), require=(), after="after"):
+    names = resource.parse(request.args.get("fields"))
+    return projection.page(
+        resource.select(names, require).where(*where),
+        keyset,
+        resource.serializer(names),
+        request.args.get(after),
+        queries.page_size_arg(request.args),
+    )
+
+
+def upcoming_page(*where):
+    return list_page(APPOINTMENTS, queries.UPCOMING_KEYSET, queries.upcoming_where(*where))
+
+
+def history_response(patient_id, **filters):
+    names = request.args.get("fields")
+    names = [n.strip() for n in names.split(",") if n.strip()] if names else HISTORY_FIELDS
+    for name in names:
+        if name not in HISTORY_FIELDS:
+            raise projection.UnknownField(name)
+
+    page = queries.history_page(
+        patient_id,
+        start=queries.date_arg(request.args, "start"),
+        end=queries.date_arg(request.args, "end"),
+        cursor=request.args.get("after"),
+        page_size=queries.page_size_arg(request.args),
+        **filters
+    )
+
+    def plain(value):
+        if isinstance(value, time):
+            return value.strftime("%H:%M")
+        if isinstance(value, date):
+            return value.isoformat()
+        return value
+
+    return {
+        "data": [{name: plain(item[name]) for name in names} for item in page.items],
+        "next": page.next_cursor,
+    }
+
+
+def one(resource, where):
+    # dashboards apply ?fields= to their list, the record gets the defaults
+    names = resource.default
+    row = db.session.execute(resource.select(names).where(where)).first()
+    return resource.serializer(names)(row) if row is not None else None
+
+
+@api_bp.route("/me")
+def me():
+    return {
+        "id": current_user.id,
+        "name": current_user.name,
+        "email": current_user.email,
+        "role": current_user.role,
+        "patient_id": current_user.patient_id,
+        "doctor_id": current_user.doctor_id,
+    }
+
+
+# patient
+
+@api_bp.route("/patient/dashboard")
+def patient_dashboard():
+    if current_user.role != "patient":
+        return denied()
+
+    return {
+        "patient": one(PATIENTS, Patient.id == current_user.patient_id),
+        "upcoming": upcoming_page(Appointment.patient_id == current_user.patient_id),
+    }
+
+
+@api_bp.route("/patient/appointments")
+def patient_appointments():
+    if current_user.role != "patient":
+        return denied()
+
+    if request.args.get("scope", "upcoming") == "upcoming":
+        return upcoming_page(Appointment.patient_id == current_user.patient_id)
+
+    return list_page(
+        APPOINTMENTS,
+        [Appointment.date, Appointment.time_start, Appointment.id],
+        (Appointment.patient_id == current_user.patient_id,),
+    )
+
+
+@api_bp.route("/patient/appointments", methods=["POST"])
+def patient_book():
+    if current_user.role != "patient":
+        return denied()
+
+    data = request.get_json(silent=True) or {}
+    try:
+        doctor_id = int(data["doctor_id"])
+        day = datetime.strptime(data["date"], "%Y-%m-%d").date()
+        time_start = datetime.strptime(data["time_start"], "%H:%M").time()
+    except (KeyError, TypeError, ValueError):
+        return {"error": "doctor_id, date (YYYY-MM-DD) and time_start (HH:MM) are required"}, 400
+
+    appointment_id, error = booking.book(current_user.patient_id, doctor_id, day, time_start)
+    if error:
+        message, status = BOOKING_ERRORS[error]
+        return {"error": message, "code": error}, status
+
+    fragment_cache.invalidate_doctor(doctor_id)
+    events.appointment("booked", appointment_id)
+    return {"id": appointment_id}, 201
+
+
+@api_bp.route("/patient/appointments/<int:app_id>/cancel", methods=["POST"])
+def patient_cancel(app_id):
+    if current_user.role != "patient":
+        return denied()
+
+    appointment = Appointment.query.get_or_404(app_id)
+    if appointment.patient_id != current_user.patient_id:
+        return denied()
+
+    entry = waitlist.release(appointment)
+    db.session.commit()
+    fragment_cache.invalidate_doctor(appointment.doctor_id)
+    events.released(appointment.id, entry)
+    return {"id": appointment.id, "status": appointment.status}
+
+
+@api_bp.route("/patient/history")
+def patient_history():
+    if current_user.role != "patient":
+        return denied()
+
+    return history_response(current_user.patient_id, treated_only=False)
+
+
+@api_bp.route("/doctors")
+def doctors():
+    # the directory; with ?q= it is a ranked full-text search, capped by
+    # ?limit= and not paginated
+    if current_user.role not in ("patient", "admin"):
+        return denied()
+
+    q = request.args.get("q", "").strip()
+    if not q:
+        return list_page(DOCTORS, [Doctor.id])
+
+    names = DOCTORS.parse(request.args.get("fields"))
+    ids = search_index.search(q, queries.page_size_arg(request.args, "limit", search_index.DEFAULT_LIMIT))
+    rows = db.session.execute(
+        DOCTORS.select(names).add_columns(Doctor.id.label("_key0")).where(Doctor.id.in_(ids))
+    ).all() if ids else []
+
+    rank = {doctor_id: i for i, doctor_id in enumerate(ids)}
+    serialize = DOCTORS.serializer(names)
+    return {
+        "data": [serialize(row) for row in sorted(rows, key=lambda row: rank[row._key0])],
+        "next": None,
+    }
+
+
+WAITLIST_ERRORS = {
+    "past": ("Date or all its slots have passed", 422),
+    "open": ("Slots are still free that day", 409),
+    "unavailable": ("No slots that day", 422),
+    "booked": ("You already have a booking with this doctor that day", 409),
+    "waiting": ("Already on the waitlist for that day", 409),
+}
+
+
+@api_bp.route("/patient/waitlist")
+def patient_waitlist():
+    # changes can be followed with /patient/waitlist/status?token= (long
+    # poll) or /patient/waitlist/events (server-sent events)
+    if current_user.role != "patient":
+        return denied()
+
+    items = waitlist.entries(current_user.patient_id)
+    return {"data": items, "token": waitlist.state_token(items)}
+
+
+@api_bp.route("/patient/waitlist", methods=["POST"])
+def patient_join_waitlist():
+    if current_user.role != "patient":
+        return denied()
+
+    data = request.get_json(silent=True) or {}
+    try:
+        doctor_id = int(data["doctor_id"])
+        day = datetime.strptime(data["date"], "%Y-%m-%d").date()
+    except (KeyError, TypeError, ValueError):
+        return {"error": "doctor_id and date (YYYY-MM-DD) are required"}, 400
+
+    entry, error = waitlist.join(current_user.patient_id, doctor_id, day)
+    if error:
+        message, status = WAITLIST_ERRORS[error]
+        return {"error": message, "code": error}, status
+
+    db.session.commit()
+    return {"id": entry.id, "status": entry.status}, 201
+
+
+@api_bp.route("/patient/waitlist/<int:entry_id>/leave", methods=["POST"])
+def patient_leave_waitlist(entry_id):
+    if current_user.role != "patient":
+        return denied()
+
+    entry = WaitlistEntry.query.get_or_404(entry_id)
+    if entry.patient_id != current_user.patient_id:
+        return denied()
+
+    waitlist.leave(entry)
+    db.session.commit()
+    return {"id": entry.id, "status": entry.status}
+
+
+# doctor
+
+@api_bp.route("/doctor/dashboard")
+def doctor_dashboard():
+    if current_user.role != "doctor":
+        return denied()
+
+    return {
+        "doctor": one(DOCTORS, Doctor.id == current_user.doctor_id),
+        "upcoming": upcoming_page(Appointment.doctor_id == current_user.doctor_id),
+    }
+
+
+@api_bp.route("/doctor/appointments")
+def doctor_appointments():
+    if current_user.role != "doctor":
+        return denied()
+
+    return upcoming_page(Appointment.doctor_id == current_user.doctor_id)
+
+
+@api_bp.route("/doctor/patients/<int:patient_id>/history")
+def doctor_patient_history(patient_id):
+    if current_user.role != "doctor":
+        return denied()
+
+    return history_response(patient_id, doctor_id=current_user.doctor_id)
+
+
+# admin
+
+@api_bp.route("/admin/dashboard")
+def admin_dashboard():
+    if current_user.role != "admin":
+        return denied()
+
+    today = date.today()
+    totals = db.session.execute(select(
+        select(func.count(Doctor.id)).scalar_subquery(),
+        select(func.count(Patient.id)).scalar_subquery(),
+        select(func.count(Appointment.id)).where(
+            Appointment.date >= today,
+            Appointment.status == "Booked"
+        ).scalar_subquery(),
+    )).one()
+
+    return {
+        "total_doctors": totals[0],
+        "total_patients": totals[1],
+        "total_upcoming": totals[2],
+        "upcoming": upcoming_page(),
+    }
+
+
+@api_bp.route("/admin/doctors")
+def admin_doctors():
+    if current_user.role != "admin":
+        return denied()
+
+    return list_page(DOCTORS, [Doctor.id])
+
+
+@api_bp.route("/admin/patients")
+def admin_patients():
+    if current_user.role != "admin":
+        return denied()
+
+    return list_page(PATIENTS, [Patient.id])
+
+
+@api_bp.route("/admin/appointments")
+def admin_appointments():
+    if current_user.role != "admin":
+        return denied()
+
+    return upcoming_page()
+
+
+@api_bp.route("/admin/patients/<int:patient_id>/history")
+def admin_patient_history(patient_id):
+    if current_user.role != "admin":
+        return denied()
+
+    return history_response(patient_id)
+
+
+@api_bp.route("/admin/search")
+def admin_search():
+    if current_user.role != "admin":
+        return denied()
+
+    # two lists, so each pages with its own cursor: ?doctors_after= / ?patients_after=
+    q = request.args.get("q", "")
+    return {
+        "doctors": list_page(
+            DOCTORS, [Doctor.id], (User.name.contains(q),), require=["user"], after="doctors_after"
+        ),
+        "patients": list_page(
+            PATIENTS, [Patient.id], (User.name.contains(q),), require=["user"], after="patients_after"
+        ),
+    }
+
+
+@api_bp.route("/admin/departments/<int:department_id>/schedule", methods=["POST"])
+def admin_department_schedule(department_id):
+    # {"weeks": [{"mon": ["09:00-12:00"], ...}, ...], "overrides": {"2025-12-25": []},
+    #  "anchor": "YYYY-MM-DD", "doctor_ids": [...]}; everything but weeks optional.
+    # All doctors are updated and published in one transaction.
+    if current_user.role != "admin":
+        return denied()
+
+    Department.query.get_or_404(department_id)
+    data = request.get_json(silent=True) or {}
+    try:
+        weeks = schedules.parse_weeks(data.get("weeks"))
+        day_overrides = schedules.parse_overrides(data.get("overrides"))
+        anchor = datetime.strptime(data["anchor"], "%Y-%m-%d").date() if data.get("anchor") else None
+        doctor_ids = [int(i) for i in data["doctor_ids"]] if data.get("doctor_ids") is not None else None
+    except (TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+
+    written = schedules.apply_department(department_id, weeks, day_overrides, anchor, doctor_ids)
+    db.session.commit()
+    for doctor_id in written:
+        fragment_cache.invalidate_doctor(doctor_id)
+
+    return {"department_id": department_id, "doctors": {str(k): v for k, v in written.items()}}
+
+
+@api_bp.route("/admin/appointments/bulk", methods=["POST"])
+def admin_bulk_appointments():
+    # {"action": "cancel" | "delete", "ids": [...]}, one transaction
+    if current_user.role != "admin":
+        return denied()
+
+    data = request.get_json(silent=True) or {}
+    try:
+        ids = [int(i) for i in data["ids"]]
+        summary = bulk_admin.apply_selection(data.get("action"), ids)
+    except (KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        return {"error": str(e) if isinstance(e, ValueError) else "ids (list of integers) is required"}, 400
+
+    db.session.commit()
+    summary.announce()
+    return summary.as_dict()
+
+
+@api_bp.route("/admin/doctors/<int:doctor_id>/appointments", methods=["POST"])
+def admin_doctor_appointments(doctor_id):
+    # {"action": "cancel" | "reassign", "start": "YYYY-MM-DD", "end": "YYYY-MM-DD",
+    #  "target_id": 2, "cancel_unmoved": false, "close": false}; target_id
+    # only for reassign. One transaction.
+    if current_user.role != "admin":
+        return denied()
+
+    Doctor.query.get_or_404(doctor_id)
+    data = request.get_json(silent=True) or {}
+    try:
+        summary = bulk_admin.apply_range(
+            doctor_id,
+            data.get("action"),
+            queries.date_arg(data, "start"),
+            queries.date_arg(data, "end"),
+            target_id=int(data["target_id"]) if data.get("target_id") is not None else None,
+            close=bool(data.get("close")),
+            cancel_unmoved=bool(data.get("cancel_unmoved"))
+        )
+    except (TypeError, ValueError) as e:
+        db.session.rollback()
+        return {"error": str(e)}, 400
+
+    db.session.commit()
+    summary.announce()
+    return summary.as_dict()
+
+
+@api_bp.route("/admin/doctors/<int:doctor_id>", methods=["DELETE"])
+def admin_delete_doctor(doctor_id):
+    if current_user.role != "admin":
+        return denied()
+
+    result = deletion.delete_doctor(doctor_id)
+    if result is None:
+        abort(404)
+    return {"id": doctor_id, "deleted": result}
+
+
+@api_bp.route("/admin/patients/<int:patient_id>", methods=["DELETE"])
+def admin_delete_patient(patient_id):
+    if current_user.role != "admin":
+        return denied()
+
+    result = deletion.delete_patient(patient_id)
+    if result is None:
+        abort(404)
+    return {"id": patient_id, "deleted": result}
+
+
+@api_bp.route("/admin/patients/<int:patient_id>/anonymize", methods=["POST"])
+def admin_anonymize_patient(patient_id):
+    if current_user.role != "admin":
+        return denied()
+
+    result = deletion.anonymize_patient(patient_id)
+    if result is None:
+        abort(404)
+    return {"id": patient_id, "anonymized": result}
+
+
+@api_bp.route("/admin/waitlist")
+def admin_waitlist():
+    # the queue for one doctor and day, first in line first
+    if current_user.role != "admin":
+        return denied()
+
+    doctor_id = request.args.get("doctor_id", type=int)
+    day = queries.date_arg(request.args, "date")
+    if doctor_id is None or day is None:
+        return {"error": "doctor_id and date (YYYY-MM-DD) are required"}, 400
+
+    rows = db.session.execute(
+        select(WaitlistEntry.id, WaitlistEntry.patient_id, User.name, WaitlistEntry.priority, WaitlistEntry.created_at)
+        .join(Patient, Patient.id == WaitlistEntry.patient_id)
+        .join(User, User.id == Patient.user_id)
+        .where(
+            WaitlistEntry.doctor_id == doctor_id,
+            WaitlistEntry.date == day,
+            WaitlistEntry.status == "Waiting"
+        ).order_by(*waitlist.QUEUE_ORDER)
+    ).all()
+
+    return {
+        "data": [
+            {
+                "id": row[0],
+                "patient_id": row[1],
+                "patient": row[2],
+                "priority": row[3],
+                "created_at": row[4].isoformat(),
+                "position": i,
+            }
+            for i, row in enumerate(rows, start=1)
+        ]
+    }
+
+
+@api_bp.route("/admin/waitlist/<int:entry_id>", methods=["POST"])
+def admin_waitlist_priority(entry_id):
+    if current_user.role != "admin":
+        return denied()
+
+    entry = WaitlistEntry.query.get_or_404(entry_id)
+    try:
+        priority = int((request.get_json(silent=True) or {})["priority"])
+    except (KeyError, TypeError, ValueError):
+        return {"error": "priority (integer) is required"}, 400
+
+    waitlist.set_priority(entry, priority)
+    db.session.commit()
+    return {"id": entry.id, "priority": entry.priority}
@@ -1,10 +1,15 @@
 from flask import Blueprint, request, redirect, url_for, flash, render_template
 from flask_login import login_user, logout_user, login_required, current_user
 from models import db, User, Patient
+import passwords
 
 auth_bp = Blueprint("auth", __name__)
 
 
+def busy():
+    return "Server busy, please try again", 503, {"Retry-After": "1"}
+
+
 @auth_bp.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
@@ -20,7 +25,10 @@ def register():
             email=email,
             role="patient"
         )
-        user.set_password(password)
+        try:
+            user.set_password(password)
+        except passwords.PoolSaturated:
+            return busy()
         db.session.add(user)
         db.session.commit()
 
@@ -46,9 +54,16 @@ def login():
 
         user = User.query.filter_by(email=email).first()
 
-        if not user or not user.check_password(password):
-            return "Invalid email or password", 401
-        
+        try:
+            if not user or not user.check_password(password):
+                return "Invalid email or password", 401
+
+            if passwords.needs_rehash(user.password_hash):
+                user.set_password(password)
+                db.session.commit()
+        except passwords.PoolSaturated:
+            return busy()
+
         login_user(user)
 
         if user.role == "admin":
@@ -1,8 +1,15 @@
-from flask import Blueprint, request, redirect, render_template, url_for
+from flask import Blueprint, request, redirect, render_template, stream_template, url_for, current_app
 from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload
 from models import db, User, Doctor, Patient, Appointment, Treatment
 from datetime import datetime, date, timedelta
-import json
+import availability
+import events
+import fragment_cache
+import queries
+import schedules
+import treatments
+import waitlist
 
 doctor_bp = Blueprint("doctor", __name__)
 
@@ -19,33 +26,37 @@ def doctor_dashboard():
         return "Access denied", 403
 
     doctor = current_user.doctor_profile
-    today = date.today()
+    # taken before the queries so the live stream replays anything after them
+    since = events.position()
 
-    upcoming = Appointment.query.filter(
-        Appointment.doctor_id == doctor.id,
-        Appointment.date >= today,
-        Appointment.status == "Booked"   
-    ).order_by(Appointment.date, Appointment.time_start).all()
+    upcoming = db.session.execute(
+        queries.upcoming_statement(Appointment.doctor_id == doctor.id)
+    ).scalars().all()
 
 
     assigned_patients = upcoming
 
-    next_7_days = [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
-
-    saved = {}
-    if doctor.availability:
-        try:
-            saved = json.loads(doctor.availability)
-        except:
-            saved = {}
-
     return render_template(
         "doctor/dashboard.html",
         doctor=doctor,
         upcoming=upcoming,
         assigned_patients=assigned_patients,
-        next_7_days=next_7_days,
-        saved=saved
+        since=since
+    )
+
+
+@doctor_bp.route("/events")
+@login_required
+def dashboard_events():
+    # Server-sent deltas for the dashboard: booked, cancelled, completed and
+    # treatment events for this doctor's appointments.
+    if not doctor_only():
+        return "Access denied", 403
+
+    return events.stream(
+        events.doctor_channel(current_user.doctor_id),
+        request.headers.get("Last-Event-ID") or request.args.get("since"),
+        current_app.config["EVENTS_STREAM_SECONDS"]
     )
 
 
@@ -59,7 +70,7 @@ def update_history_page(app_id):
 
     appointment = Appointment.query.get_or_404(app_id)
 
-    if appointment.doctor_id != current_user.doctor_profile.id:
+    if appointment.doctor_id != current_user.doctor_id:
         return "Unauthorized", 403
 
     return render_template(
@@ -78,7 +89,7 @@ def update_history(app_id):
 
     appointment = Appointment.query.get_or_404(app_id)
 
-    if appointment.doctor_id != current_user.doctor_profile.id:
+    if appointment.doctor_id != current_user.doctor_id:
         return "Unauthorized", 403
 
     visit_type = request.form.get("visit_type")
@@ -95,9 +106,12 @@ def update_history(app_id):
 
     t.diagnosis = diagnosis
     t.prescription = prescription
-    t.notes = f"Visit Type: {visit_type}, Tests: {test_done}, Medicines: {medicines}"
+    t.visit_type = visit_type or ""
+    t.tests_done = test_done or ""
+    treatments.set_medicines(t, medicines)
 
     db.session.commit()
+    events.appointment("treatment", appointment.id)
 
     return redirect(url_for("doctor.doctor_dashboard"))
 
@@ -108,64 +122,33 @@ def patient_history(patient_id):
     if not doctor_only():
         return "Access denied", 403
 
-    doctor = current_user.doctor_profile
-
-    appointments = Appointment.query.filter_by(
-        patient_id=patient_id,
-        doctor_id=doctor.id
-    ).order_by(Appointment.date).all()
-
-    history = []
-
-    for a in appointments:
-        if a.treatment:
-
-            raw = a.treatment.notes or ""
-            cleaned = raw.replace("\n", " ").replace("  ", " ")
-
-            vt = ""
-            td = ""
-            md = ""
-
-            if "Visit Type:" in cleaned:
-                try:
-                    vt = cleaned.split("Visit Type:")[1].split("Tests:")[0].strip()
-                except:
-                    pass
-
-            if "Tests:" in cleaned:
-                try:
-                    td = cleaned.split("Tests:")[1].split("Medicines:")[0].strip()
-                except:
-                    pass
-
-            if "Medicines:" in cleaned:
-                try:
-                    md = cleaned.split("Medicines:")[1].strip()
-                except:
-                    pass
-
-            vt = vt.rstrip(",").strip()
-            td = td.rstrip(",").strip()
-            md = md.rstrip(",").strip()
-
-
-            history.append({
-                "visit_type": vt,
-                "test_done": td,
-                "diagnosis": a.treatment.diagnosis,
-                "prescription": a.treatment.prescription,
-                "medicines": md,
-                "date": a.date
-            })
-
-    patient = Patient.query.get_or_404(patient_id)
+    # the page streams after the view returns, so load everything it renders now
+    doctor = Doctor.query.options(
+        joinedload(Doctor.user),
+        joinedload(Doctor.department)
+    ).get(current_user.doctor_id)
+    patient = Patient.query.options(joinedload(Patient.user)).get_or_404(patient_id)
+
+    start = queries.date_arg(request.args, "start")
+    end = queries.date_arg(request.args, "end")
+
+    page = queries.history_page(
+        patient.id,
+        doctor_id=doctor.id,
+        start=start,
+        end=end,
+        cursor=request.args.get("after"),
+        page_size=queries.page_size_arg(request.args)
+    )
 
-    return render_template(
+    return stream_template(
         "doctor/patient_history.html",
         patient=patient,
         doctor=doctor,
-        history=history
+        history=page.items,
+        page=page,
+        start=start,
+        end=end
     )
 
 
@@ -179,11 +162,13 @@ def mark_complete(app_id):
 
     app = Appointment.query.get_or_404(app_id)
 
-    if app.doctor_id != current_user.doctor_profile.id:
+    if app.doctor_id != current_user.doctor_id:
         return "Unauthorized", 403
 
     app.status = "Completed"
     db.session.commit()
+    fragment_cache.invalidate_doctor(app.doctor_id)
+    events.appointment("completed", app.id)
 
     return redirect(url_for("doctor.doctor_dashboard"))
 
@@ -198,11 +183,13 @@ def cancel_appointment(app_id):
 
     app = Appointment.query.get_or_404(app_id)
 
-    if app.doctor_id != current_user.doctor_profile.id:
+    if app.doctor_id != current_user.doctor_id:
         return "Unauthorized", 403
 
-    app.status = "Cancelled"
+    entry = waitlist.release(app)
     db.session.commit()
+    fragment_cache.invalidate_doctor(app.doctor_id)
+    events.released(app.id, entry)
 
     return redirect(url_for("doctor.doctor_dashboard"))
 
@@ -213,22 +200,47 @@ def availability_page():
     if not doctor_only():
         return "Access denied", 403
 
-    doctor = current_user.doctor_profile
+    doctor_id = current_user.doctor_id
+    today = date.today()
 
-    saved = {}
-    if doctor.availability:
-        try:
-            saved = json.loads(doctor.availability)
-        except:
-            saved = {}
+    schedule, weeks = schedules.template(doctor_id)
+    if schedule is None:
+        # no template yet: start from what is published for the coming week
+        slots = availability.slots_in_window([doctor_id], today, today + timedelta(days=6)).get(doctor_id, {})
+        for day, day_slots in slots.items():
+            weeks[0][day.weekday()] = [(s.time_start, s.time_end) for s in day_slots]
 
-    today = date.today()
-    next_7_days = [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
+    cycle = request.args.get("weeks", len(weeks), type=int)
+    cycle = max(1, min(cycle, schedules.MAX_CYCLE_WEEKS))
+    weeks = (weeks + [{} for _ in range(cycle)])[:cycle]
+
+    def fields(slots):
+        entry = {"morning": "", "evening": ""}
+        for time_start, time_end in slots:
+            key = availability.period(time_start)
+            if not entry[key]:
+                entry[key] = availability.format_range(time_start, time_end)
+        return entry
+
+    days = availability.window_dates(today, availability.WINDOW_DAYS)
+    published = availability.slots_in_window([doctor_id], days[0], days[-1]).get(doctor_id, {})
 
     return render_template(
         "doctor/availability.html",
-        next_7_days=next_7_days,
-        saved=saved
+        weekdays=["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"],
+        weeks=[[fields(week.get(i, [])) for i in range(7)] for week in weeks],
+        overrides=[
+            {"date": day.strftime("%Y-%m-%d"), **fields(slots)}
+            for day, slots in schedules.overrides(doctor_id, today).items()
+        ],
+        max_weeks=schedules.MAX_CYCLE_WEEKS,
+        published=[
+            {
+                "date": day.strftime("%Y-%m-%d"),
+                "slots": [availability.format_range(s.time_start, s.time_end) for s in published.get(day, [])]
+            }
+            for day in days
+        ]
     )
 
 
@@ -238,17 +250,34 @@ def save_availability():
     if not doctor_only():
         return "Access denied", 403
 
-    doctor = current_user.doctor_profile
-
-    availability = {}
-
-    for i in range(1, 8):
-        availability[f"day_{i}"] = {
-            "morning": request.form.get(f"morning_{i}", ""),
-            "evening": request.form.get(f"evening_{i}", "")
-        }
-
-    doctor.availability = json.dumps(availability)
+    doctor_id = current_user.doctor_id
+    cycle = max(1, min(request.form.get("cycle_weeks", 1, type=int), schedules.MAX_CYCLE_WEEKS))
+
+    def ranges(prefix):
+        return [
+            slot for slot in (
+                availability.parse_range(request.form.get(f"{prefix}_morning", "")),
+                availability.parse_range(request.form.get(f"{prefix}_evening", ""))
+            )
+            if slot
+        ]
+
+    weeks = [
+        {weekday: ranges(f"w{week}_d{weekday}") for weekday in range(7)}
+        for week in range(cycle)
+    ]
+
+    # an override date with both fields blank closes that day
+    day_overrides = {}
+    for i in range(request.form.get("override_count", 0, type=int)):
+        day = queries.date_arg(request.form, f"o{i}_date")
+        if day is not None and day >= date.today():
+            day_overrides[day] = ranges(f"o{i}")
+
+    schedules.set_template(doctor_id, weeks)
+    schedules.set_overrides(doctor_id, day_overrides, replace_from=date.today())
+    schedules.materialize([doctor_id])
     db.session.commit()
+    fragment_cache.invalidate_doctor(doctor_id)
 
     return redirect(url_for("doctor.doctor_dashboard"))
@@ -1,11 +1,26 @@
-from flask import Blueprint, request, redirect, url_for, render_template
+from flask import Blueprint, Response, request, redirect, url_for, render_template, abort, current_app, stream_with_context
 from flask_login import login_required, current_user
-from models import db, User, Patient, Doctor, Department, Appointment, Treatment
+from models import db, User, Patient, Doctor, Department, Appointment, Treatment, WaitlistEntry
+from markupsafe import Markup
 from datetime import datetime, date, timedelta, time
+from time import monotonic
 import json
+import re
+import availability
+import booking
+import conditional
+import events
+import fragment_cache
+import queries
+import search_index
+import versions
+import waitlist
 
 patient_bp = Blueprint("patient", __name__)
 
+# comment lines sent on an idle event stream so proxies keep it open
+KEEPALIVE_SECONDS = 15
+
 
 def patient_only():
     return current_user.is_authenticated and current_user.role == "patient"
@@ -23,30 +38,31 @@ def dashboard():
 
     q = request.args.get("q", "").strip()
 
+    # the whole directory unless ?limit= asks for fewer
+    limit = queries.page_size_arg(request.args, "limit") if "limit" in request.args else None
+    ids = queries.directory_ids(q, limit)
+    doctor_versions = versions.doctor_versions(ids)
+
+    # one cached card per doctor version; only doctors whose card is missing
+    # are loaded and rendered
+    cards = fragment_cache.get_many(
+        "card",
+        [(i, doctor_versions[i][0]) for i in ids if i in doctor_versions],
+        lambda missing: {
+            d.id: render_template("patient/_doctor_card.html", d=d)
+            for d in queries.doctors_by_ids(missing)
+        }
+    )
 
-    doctors_query = Doctor.query.join(User).outerjoin(Department)
-
-
-    if q:
-        doctors_query = doctors_query.filter(
-            (User.name.ilike(f"%{q}%")) |
-            (Doctor.specialization.ilike(f"%{q}%")) |
-            (Department.name.ilike(f"%{q}%"))
-        )
-
-    doctors = doctors_query.all()
-
-    upcoming = Appointment.query.filter(
-        Appointment.patient_id == patient.id,
-        Appointment.date >= date.today(),
-        Appointment.status == "Booked"
-    ).order_by(Appointment.date, Appointment.time_start).all()
+    upcoming = db.session.execute(
+        queries.upcoming_statement(Appointment.patient_id == patient.id)
+    ).scalars().all()
 
 
     return render_template(
         "patient/dashboard.html",
         patient=patient,
-        doctors=doctors,
+        doctor_cards=Markup("".join(cards)),
         upcoming=upcoming,
         q=q   
     )
@@ -58,48 +74,112 @@ def doctor_details(doctor_id):
     if not patient_only():
         return "Access denied", 403
 
-    doctor = Doctor.query.get_or_404(doctor_id)
-    return render_template("patient/doctor_details.html", doctor=doctor)
+    version, updated_at = doctor_version_or_404(doctor_id)
 
+    return conditional.respond(
+        conditional.make_etag("details", doctor_id, version),
+        conditional.last_modified(updated_at),
+        conditional.DIRECTORY,
+        lambda: render_template(
+            "patient/doctor_details.html",
+            doctor=Doctor.query.get_or_404(doctor_id)
+        )
+    )
 
-@patient_bp.route("/doctor/<int:doctor_id>/availability")
-@login_required
-def doctor_availability(doctor_id):
-    if not patient_only():
-        return "Access denied", 403
 
-    doctor = Doctor.query.get_or_404(doctor_id)
+def doctor_version_or_404(doctor_id):
+    found = versions.doctor_versions([doctor_id]).get(doctor_id)
+    if found is None:
+        abort(404)
+    return found
 
 
-    availability = json.loads(doctor.availability) if doctor.availability else {}
+def availability_etag(kind, doctor_id, version):
+    # the grid marks the patient's own bookings and moves with the date
+    return conditional.make_etag(kind, doctor_id, version, current_user.patient_id, date.today())
 
 
+def availability_grid(doctor, patient_id):
     today = date.today()
-    dates = [(today + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
+    return availability.grid(
+        doctor.id,
+        today,
+        today + timedelta(days=availability.WINDOW_DAYS - 1),
+        patient_id=patient_id
+    )
 
 
-    booked = Appointment.query.filter(
-        Appointment.doctor_id == doctor.id,
-        Appointment.status == "Booked"
-    ).all()
+BOOKED_MARKER = re.compile(r"@@booked ([0-9-]+ [0-9:]+)@@")
 
-    booked_slots = {(str(a.date), a.time_start.strftime("%H:%M")) for a in booked}
 
-    patient = current_user.patient_profile
-    my_booked = Appointment.query.filter_by(
-        doctor_id=doctor.id,
-        patient_id=patient.id,
-        status="Booked"
-    ).all()
-    patient_booked_slots = {(str(a.date), a.time_start.strftime("%H:%M")) for a in my_booked}
+def booked_marker(day, time_start):
+    return f"@@booked {day} {time_start}@@"
 
-    return render_template(
-        "patient/doctor_availability.html",
-        doctor=doctor,
-        dates=dates,
-        availability=availability,
-        booked_slots=booked_slots,
-        patient_booked_slots=patient_booked_slots
+
+def overlay_own_bookings(grid, mine):
+    return Markup(BOOKED_MARKER.sub(
+        lambda m: "You booked this" if m.group(1) in mine else "Booked", grid
+    ))
+
+
+@patient_bp.route("/doctor/<int:doctor_id>/availability")
+@login_required
+def doctor_availability(doctor_id):
+    if not patient_only():
+        return "Access denied", 403
+
+    version, updated_at = doctor_version_or_404(doctor_id)
+
+    def render():
+        today = date.today()
+        end = today + timedelta(days=availability.WINDOW_DAYS - 1)
+
+        # the grid is cached per doctor version without the patient's own
+        # bookings, which are overlaid on every request
+        grid = fragment_cache.get_or_render(
+            "grid", doctor_id, version, (today,),
+            lambda: render_template(
+                "patient/_availability_grid.html",
+                doctor_id=doctor_id,
+                days=availability.grid(doctor_id, today, end),
+                booked_marker=booked_marker
+            )
+        )
+        mine = availability.booked_by_patient(current_user.patient_id, doctor_id, today, end)
+
+        return render_template(
+            "patient/doctor_availability.html",
+            grid=overlay_own_bookings(grid, mine)
+        )
+
+    return conditional.respond(
+        availability_etag("availability", doctor_id, version),
+        conditional.last_modified(updated_at),
+        conditional.REVALIDATE,
+        render
+    )
+
+
+@patient_bp.route("/doctor/<int:doctor_id>/availability.json")
+@login_required
+def doctor_availability_json(doctor_id):
+    if not patient_only():
+        return {"error": "Access denied"}, 403
+
+    version, updated_at = doctor_version_or_404(doctor_id)
+
+    def render():
+        doctor = Doctor.query.get_or_404(doctor_id)
+        return {
+            "doctor_id": doctor.id,
+            "days": availability_grid(doctor, current_user.patient_id)
+        }
+
+    return conditional.respond(
+        availability_etag("availability.json", doctor_id, version),
+        conditional.last_modified(updated_at),
+        conditional.REVALIDATE,
+        render
     )
 
 @patient_bp.route("/book", methods=["POST"])
@@ -108,60 +188,30 @@ def book_appointment():
     if not patient_only():
         return "Access denied", 403
 
-    patient = current_user.patient_profile
-
     doctor_id = request.form.get("doctor_id")
     date_str = request.form.get("date")
     time_start_str = request.form.get("time_start")
-    time_end_str = request.form.get("time_end")
 
-    if not doctor_id or not date_str or not time_start_str or not time_end_str:
+    if not doctor_id or not date_str or not time_start_str:
         return redirect(url_for("patient.doctor_availability", doctor_id=doctor_id))
 
     appt_date = datetime.strptime(date_str, "%Y-%m-%d").date()
 
     try:
         h1, m1 = map(int, time_start_str.split(":"))
-        h2, m2 = map(int, time_end_str.split(":"))
         time_start = time(h1, m1)
-        time_end = time(h2, m2)
+        doctor_id = int(doctor_id)
     except:
         return redirect(url_for("patient.doctor_availability", doctor_id=doctor_id))
-    
-
-
-    conflict = Appointment.query.filter(
-        Appointment.doctor_id == doctor_id,
-        Appointment.date == appt_date,
-        Appointment.time_start == time_start,
-        Appointment.status == "Booked"
-    ).first()
-
-    if conflict:
-        return redirect(url_for("patient.doctor_availability", doctor_id=doctor_id) + "?error=booked")
-
-    already = Appointment.query.filter(
-        Appointment.doctor_id == doctor_id,
-        Appointment.patient_id == patient.id,
-        Appointment.date == appt_date,
-        Appointment.status == "Booked"
-    ).first()
-
-    if already:
-        return redirect(url_for("patient.doctor_availability", doctor_id=doctor_id) + "?error=own")
-
-    appointment = Appointment(
-        patient_id=patient.id,
-        doctor_id=doctor_id,
-        date=appt_date,
-        time_start=time_start,
-        time_end=time_end,
-        status="Booked"
-    )
 
-    db.session.add(appointment)
-    db.session.commit()
-    db.session.expire_all() 
+    appointment_id, error = booking.book(current_user.patient_id, doctor_id, appt_date, time_start)
+
+    if error:
+        return redirect(url_for("patient.doctor_availability", doctor_id=doctor_id) + f"?error={error}")
+
+    fragment_cache.invalidate_doctor(doctor_id)
+    db.session.expire_all()
+    events.appointment("booked", appointment_id)
 
     return redirect(url_for("patient.dashboard"))
 
@@ -171,16 +221,19 @@ def appointment_history():
     if not patient_only():
         return "Access denied", 403
 
-    patient = current_user.patient_profile
-
-    past_appointments = Appointment.query.filter(
-        Appointment.patient_id == patient.id,
-        Appointment.status == "Completed"
-    ).order_by(Appointment.date.desc()).all()
+    # completed visits, live and archived
+    page = queries.history_page(
+        current_user.patient_id,
+        status="Completed",
+        treated_only=False,
+        cursor=request.args.get("after"),
+        page_size=queries.page_size_arg(request.args)
+    )
 
     return render_template(
         "patient/history.html",
-        appointments=past_appointments
+        history=page.items,
+        page=page
     )
 
 @patient_bp.route("/cancel/<int:app_id>")
@@ -191,11 +244,13 @@ def cancel_appointment(app_id):
 
     appointment = Appointment.query.get_or_404(app_id)
 
-    if appointment.patient_id != current_user.patient_profile.id:
+    if appointment.patient_id != current_user.patient_id:
         return "Cannot cancel this appointment", 403
 
-    appointment.status = "Cancelled"
+    entry = waitlist.release(appointment)
     db.session.commit()
+    fragment_cache.invalidate_doctor(appointment.doctor_id)
+    events.released(appointment.id, entry)
     db.session.expire_all()
 
     return redirect(url_for("patient.dashboard"))
@@ -233,20 +288,180 @@ def search_doctor():
         return "Access denied", 403
 
     query = request.args.get("q", "")
+    limit = queries.page_size_arg(request.args, "limit", search_index.DEFAULT_LIMIT)
+
+    ids = queries.directory_ids(query, limit)
+    found = versions.doctor_versions(ids)
+    today = date.today()
+
+    def render():
+        doctors = queries.doctors_by_ids(ids)
+        slots = availability.slots_in_window(
+            [d.id for d in doctors],
+            today,
+            today + timedelta(days=availability.WINDOW_DAYS - 1)
+        )
+        return {
+            "results": [
+                {
+                    "id": d.id,
+                    "name": d.user.name,
+                    "specialization": d.specialization,
+                    "availability": {
+                        day.strftime("%Y-%m-%d"): [
+                            availability.format_range(s.time_start, s.time_end)
+                            for s in day_slots
+                        ]
+                        for day, day_slots in slots.get(d.id, {}).items()
+                    }
+                }
+                for d in doctors
+            ]
+        }
+
+    # results are the same for every patient
+    return conditional.respond(
+        conditional.make_etag("search", today, *(f"{i}:{found[i][0]}" for i in ids if i in found)),
+        conditional.last_modified(*(updated_at for _, updated_at in found.values())),
+        conditional.DIRECTORY,
+        render
+    )
 
-    doctors = Doctor.query.join(User).filter(
-        (User.name.contains(query)) |
-        (Doctor.specialization.contains(query))
-    ).all()
-
-    return {
-        "results": [
-            {
-                "id": d.id,
-                "name": d.user.name,
-                "specialization": d.specialization,
-                "availability": json.loads(d.availability) if d.availability else {}
-            }
-            for d in doctors
-        ]
-    }
+
+@patient_bp.route("/first-available")
+@login_required
+def first_available():
+    if not patient_only():
+        return {"error": "Access denied"}, 403
+
+    today = date.today()
+
+    try:
+        start = datetime.strptime(request.args["start"], "%Y-%m-%d").date() if request.args.get("start") else today
+        end = datetime.strptime(request.args["end"], "%Y-%m-%d").date() if request.args.get("end") else start + timedelta(days=13)
+        department_id = request.args.get("department_id", type=int)
+        limit = min(max(int(request.args.get("limit", 10)), 1), 50)
+    except ValueError:
+        return {"error": "Invalid parameters"}, 400
+
+    start = max(start, today)
+    if end < start:
+        return {"error": "end must not be before start"}, 400
+
+    slots = availability.first_available(
+        start,
+        end,
+        department_id=department_id,
+        specialization=request.args.get("specialization", "").strip() or None,
+        after_time=datetime.now().time() if start == today else None,
+        limit=limit
+    )
+
+    return {"results": slots}
+
+
+WAITLIST_ERRORS = {
+    "past": "That date, or every slot on it, has passed.",
+    "open": "There are still free slots that day, book one instead.",
+    "unavailable": "The doctor has no slots that day.",
+    "booked": "You already have a booking with this doctor that day.",
+    "waiting": "You are already on the waitlist for that day.",
+}
+
+
+@patient_bp.route("/waitlist")
+@login_required
+def waitlist_page():
+    if not patient_only():
+        return "Access denied", 403
+
+    items = waitlist.entries(current_user.patient_id)
+    return render_template(
+        "patient/waitlist.html",
+        entries=items,
+        token=waitlist.state_token(items),
+        error=WAITLIST_ERRORS.get(request.args.get("error"))
+    )
+
+
+@patient_bp.route("/waitlist", methods=["POST"])
+@login_required
+def join_waitlist():
+    if not patient_only():
+        return "Access denied", 403
+
+    doctor_id = request.form.get("doctor_id", type=int)
+    day = queries.date_arg(request.form, "date")
+    if doctor_id is None or day is None:
+        return redirect(url_for("patient.dashboard"))
+
+    entry, error = waitlist.join(current_user.patient_id, doctor_id, day)
+    if error:
+        return redirect(url_for("patient.waitlist_page", error=error))
+
+    db.session.commit()
+    return redirect(url_for("patient.waitlist_page"))
+
+
+@patient_bp.route("/waitlist/<int:entry_id>/leave", methods=["POST"])
+@login_required
+def leave_waitlist(entry_id):
+    if not patient_only():
+        return "Access denied", 403
+
+    entry = WaitlistEntry.query.get_or_404(entry_id)
+    if entry.patient_id != current_user.patient_id:
+        return "Access denied", 403
+
+    waitlist.leave(entry)
+    db.session.commit()
+    return redirect(url_for("patient.waitlist_page"))
+
+
+@patient_bp.route("/waitlist/status")
+@login_required
+def waitlist_status():
+    # Long poll: answers as soon as the entries differ from ?token=, or with
+    # the unchanged state after WAITLIST_POLL_TIMEOUT seconds.
+    if not patient_only():
+        return {"error": "Access denied"}, 403
+
+    items, token = waitlist.wait_for_change(
+        current_user.patient_id,
+        request.args.get("token"),
+        current_app.config["WAITLIST_POLL_TIMEOUT"]
+    )
+    return {"token": token, "entries": items}
+
+
+@patient_bp.route("/waitlist/events")
+@login_required
+def waitlist_events():
+    # Server-sent events: a "status" event whenever the entries change.
+    # The stream ends after WAITLIST_STREAM_SECONDS and EventSource
+    # reconnects, resuming from Last-Event-ID.
+    if not patient_only():
+        return "Access denied", 403
+
+    patient_id = current_user.patient_id
+    lifetime = current_app.config["WAITLIST_STREAM_SECONDS"]
+    token = request.headers.get("Last-Event-ID")
+
+    def stream(token):
+        deadline = monotonic() + lifetime
+        yield "retry: 3000\n\n"
+        while monotonic() < deadline:
+            items, current = waitlist.wait_for_change(
+                patient_id, token, min(KEEPALIVE_SECONDS, max(deadline - monotonic(), 0))
+            )
+            if current != token:
+                token = current
+                yield f"id: {token}\nevent: status\ndata: {json.dumps(items)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+
+    return Response(
+        stream_with_context(stream(token)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,57 @@
+from sqlalchemy import insert, select, exists, literal, Integer, String
+from sqlalchemy.exc import IntegrityError
+from models import db, Appointment, DoctorAvailability
+
+
+def booking_statement(patient_id, doctor_id, day, time_start):
+    # INSERT ... SELECT from the published slot: nothing is inserted when the
+    # doctor does not offer the slot, and the partial unique indexes on
+    # appointments reject a second active booking.
+    slot = select(
+        literal(patient_id, Integer),
+        DoctorAvailability.doctor_id,
+        DoctorAvailability.date,
+        DoctorAvailability.time_start,
+        DoctorAvailability.time_end,
+        literal("Booked", String)
+    ).where(
+        DoctorAvailability.doctor_id == doctor_id,
+        DoctorAvailability.date == day,
+        DoctorAvailability.time_start == time_start
+    )
+
+    return insert(Appointment).from_select(
+        ["patient_id", "doctor_id", "date", "time_start", "time_end", "status"],
+        slot
+    )
+
+
+def own_day_statement(patient_id, doctor_id, day):
+    # whether the patient already holds a booking with the doctor that day
+    return select(exists().where(
+        Appointment.patient_id == patient_id,
+        Appointment.doctor_id == doctor_id,
+        Appointment.date == day,
+        Appointment.status == "Booked"
+    ))
+
+
+def book(patient_id, doctor_id, day, time_start, session=None):
+    # Returns (appointment_id, None) on success or (None, error) where error
+    # is "unavailable", "booked" or "own".
+    session = session or db.session
+
+    try:
+        result = session.execute(booking_statement(patient_id, doctor_id, day, time_start))
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        # which index refused it: uq_appointments_active_patient_day when the
+        # patient already has this doctor that day, else the slot is taken
+        own = session.execute(own_day_statement(patient_id, doctor_id, day)).scalar()
+        return None, "own" if own else "booked"
+
+    if result.rowcount == 0:
+        return None, "unavailable"
+
+    return result.lastrowid, None
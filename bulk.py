@@ -0,0 +1,315 @@
+from sqlalchemy import select, insert, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import aliased
+from models import db, User, Department, Doctor, Patient, Appointment, Treatment, TreatmentMedicine
+from datetime import date, time
+from itertools import islice
+import csv
+import json
+import passwords
+import treatments
+
+KINDS = ("departments", "users", "doctors", "patients", "appointments")
+FORMATS = ("csv", "jsonl")
+BATCH_SIZE = 1000
+
+COLUMNS = {
+    "departments": ["name", "description"],
+    # accounts without a doctor or patient profile, e.g. admins
+    "users": ["name", "email", "password_hash", "role"],
+    "doctors": ["name", "email", "password_hash", "specialization", "department"],
+    "patients": ["name", "email", "password_hash", "dob", "contact", "address"],
+    "appointments": [
+        "patient_email", "doctor_email", "date", "time_start", "time_end", "status",
+        "diagnosis", "prescription", "visit_type", "tests_done", "medicines",
+    ],
+}
+
+PROFILE_ROLES = ("doctor", "patient")
+
+
+class InvalidRow(Exception):
+    pass
+
+
+def format_for(path, default="jsonl"):
+    for fmt in FORMATS:
+        if path.lower().endswith("." + fmt):
+            return fmt
+    return default
+
+
+def read_rows(stream, fmt):
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _plain(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return value
+
+
+def write_rows(stream, fmt, columns, rows):
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(["" if v is None else _plain(v) for v in row])
+        return
+    for row in rows:
+        stream.write(json.dumps({c: _plain(v) for c, v in zip(columns, row)}) + "\n")
+
+
+def batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _value(row, key):
+    value = row.get(key)
+    if isinstance(value, str):
+        value = value.strip()
+    return value or None
+
+
+def _date(value):
+    return date.fromisoformat(value) if value else None
+
+
+def _time(value):
+    return time.fromisoformat(value) if value else None
+
+
+def _password_hashes(batch):
+    # Rows exported from another install carry password_hash and are kept
+    # as is; plain passwords are hashed across the worker processes.
+    plain = [i for i, row in enumerate(batch) if not _value(row, "password_hash")]
+    for i in plain:
+        if not _value(batch[i], "password"):
+            raise InvalidRow(f"{batch[i].get('email')}: password or password_hash is required")
+
+    hashes = [_value(row, "password_hash") for row in batch]
+    for i, hashed in zip(plain, passwords.hash_many(batch[i]["password"] for i in plain)):
+        hashes[i] = hashed
+    return hashes
+
+
+def _insert_users(batch, role=None):
+    rows = [
+        {
+            "name": _value(row, "name"),
+            "email": _value(row, "email"),
+            "password_hash": password_hash,
+            "role": role or _value(row, "role"),
+        }
+        for row, password_hash in zip(batch, _password_hashes(batch))
+    ]
+    result = db.session.execute(
+        insert(User).returning(User.id, sort_by_parameter_order=True), rows
+    )
+    return result.scalars().all()
+
+
+def _department_ids(names):
+    names = {name for name in names if name}
+    if not names:
+        return {}
+    db.session.execute(
+        sqlite_insert(Department).on_conflict_do_nothing(),
+        [{"name": name} for name in names]
+    )
+    return dict(db.session.execute(
+        select(Department.name, Department.id).where(Department.name.in_(names))
+    ).all())
+
+
+def _profile_ids(model, emails):
+    return dict(db.session.execute(
+        select(User.email, model.id).join(model, model.user_id == User.id).where(
+            User.email.in_(set(emails))
+        )
+    ).all())
+
+
+def _import_departments(batch):
+    db.session.execute(
+        sqlite_insert(Department).on_conflict_do_nothing(),
+        [{"name": _value(row, "name"), "description": _value(row, "description")} for row in batch]
+    )
+
+
+def _import_users(batch):
+    for row in batch:
+        if _value(row, "role") in PROFILE_ROLES or not _value(row, "role"):
+            raise InvalidRow(f"{row.get('email')}: import doctors and patients with their own kind")
+    _insert_users(batch)
+
+
+def _import_doctors(batch):
+    departments = _department_ids(_value(row, "department") for row in batch)
+    user_ids = _insert_users(batch, "doctor")
+    db.session.execute(insert(Doctor), [
+        {
+            "user_id": user_id,
+            "specialization": _value(row, "specialization"),
+            "department_id": departments.get(_value(row, "department")),
+        }
+        for row, user_id in zip(batch, user_ids)
+    ])
+
+
+def _import_patients(batch):
+    user_ids = _insert_users(batch, "patient")
+    db.session.execute(insert(Patient), [
+        {
+            "user_id": user_id,
+            "dob": _date(_value(row, "dob")),
+            "contact": _value(row, "contact"),
+            "address": _value(row, "address"),
+        }
+        for row, user_id in zip(batch, user_ids)
+    ])
+
+
+def _import_appointments(batch):
+    patients = _profile_ids(Patient, (_value(row, "patient_email") for row in batch))
+    doctors = _profile_ids(Doctor, (_value(row, "doctor_email") for row in batch))
+
+    rows = []
+    for row in batch:
+        patient_id = patients.get(_value(row, "patient_email"))
+        doctor_id = doctors.get(_value(row, "doctor_email"))
+        if patient_id is None or doctor_id is None:
+            raise InvalidRow(
+                f"unknown patient or doctor: {row.get('patient_email')} / {row.get('doctor_email')}"
+            )
+        rows.append({
+            "patient_id": patient_id,
+            "doctor_id": doctor_id,
+            "date": _date(_value(row, "date")),
+            "time_start": _time(_value(row, "time_start")),
+            "time_end": _time(_value(row, "time_end")),
+            "status": _value(row, "status") or "Booked",
+        })
+
+    appointment_ids = db.session.execute(
+        insert(Appointment).returning(Appointment.id, sort_by_parameter_order=True), rows
+    ).scalars().all()
+
+    treated = [
+        (appointment_id, row) for appointment_id, row in zip(appointment_ids, batch)
+        if any(_value(row, key) for key in COLUMNS["appointments"][6:])
+    ]
+    if not treated:
+        return
+
+    # visit_type "" rather than NULL, so the legacy notes backfill skips them
+    treatment_ids = db.session.execute(
+        insert(Treatment).returning(Treatment.id, sort_by_parameter_order=True),
+        [
+            {
+                "appointment_id": appointment_id,
+                "diagnosis": _value(row, "diagnosis"),
+                "prescription": _value(row, "prescription"),
+                "visit_type": _value(row, "visit_type") or "",
+                "tests_done": _value(row, "tests_done") or "",
+            }
+            for appointment_id, row in treated
+        ]
+    ).scalars().all()
+
+    medicines = [
+        {"treatment_id": treatment_id, "position": i, "name": name[:200]}
+        for treatment_id, (_, row) in zip(treatment_ids, treated)
+        for i, name in enumerate(treatments.split_medicines(_value(row, "medicines")))
+    ]
+    if medicines:
+        db.session.execute(insert(TreatmentMedicine), medicines)
+
+
+IMPORTERS = {
+    "departments": _import_departments,
+    "users": _import_users,
+    "doctors": _import_doctors,
+    "patients": _import_patients,
+    "appointments": _import_appointments,
+}
+
+
+def import_rows(kind, rows, batch_size=BATCH_SIZE, progress=None):
+    # One transaction per batch; only the current batch is held in memory.
+    # A failing batch is rolled back and earlier batches stay committed.
+    imported = 0
+    for batch in batches(rows, batch_size):
+        try:
+            IMPORTERS[kind](batch)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        imported += len(batch)
+        if progress:
+            progress(imported)
+    return imported
+
+
+def export_statement(kind):
+    if kind == "departments":
+        return select(Department.name, Department.description).order_by(Department.id)
+
+    if kind == "users":
+        return select(User.name, User.email, User.password_hash, User.role).where(
+            User.role.not_in(PROFILE_ROLES)
+        ).order_by(User.id)
+
+    if kind == "doctors":
+        return select(
+            User.name, User.email, User.password_hash, Doctor.specialization, Department.name
+        ).join(User, User.id == Doctor.user_id).outerjoin(
+            Department, Department.id == Doctor.department_id
+        ).order_by(Doctor.id)
+
+    if kind == "patients":
+        return select(
+            User.name, User.email, User.password_hash, Patient.dob, Patient.contact, Patient.address
+        ).join(User, User.id == Patient.user_id).order_by(Patient.id)
+
+    patient_user = aliased(User)
+    doctor_user = aliased(User)
+    medicines = select(func.group_concat(TreatmentMedicine.name, ", ")).where(
+        TreatmentMedicine.treatment_id == Treatment.id
+    ).scalar_subquery()
+
+    return select(
+        patient_user.email, doctor_user.email, Appointment.date, Appointment.time_start,
+        Appointment.time_end, Appointment.status, Treatment.diagnosis, Treatment.prescription,
+        Treatment.visit_type, Treatment.tests_done, medicines
+    ).join(
+        Patient, Patient.id == Appointment.patient_id
+    ).join(
+        patient_user, patient_user.id == Patient.user_id
+    ).join(
+        Doctor, Doctor.id == Appointment.doctor_id
+    ).join(
+        doctor_user, doctor_user.id == Doctor.user_id
+    ).outerjoin(
+        Treatment, Treatment.appointment_id == Appointment.id
+    ).order_by(Appointment.id)
+
+
+def export_rows(kind, batch_size=BATCH_SIZE):
+    # yield_per streams the result in batch_size chunks instead of loading it
+    result = db.session.execute(
+        export_statement(kind).execution_options(yield_per=batch_size)
+    )
+    for row in result:
+        yield tuple(row)
@@ -0,0 +1,260 @@
+from sqlalchemy import select, update, delete, exists, tuple_
+from sqlalchemy.orm import aliased
+from models import (
+    db, Doctor, DoctorAvailability, DoctorSchedule, Appointment, Treatment,
+    TreatmentMedicine, WaitlistEntry
+)
+from datetime import timedelta
+import events
+import fragment_cache
+import schedules
+import waitlist
+
+# Admin operations on many appointments at once: cancel or delete a picked
+# set, and cancel or move everything a doctor has booked in a date range
+# (e.g. while on leave). Each is a handful of set-based UPDATE / DELETE
+# statements in the caller's transaction; the caller commits and then calls
+# Summary.announce() to drop cached fragments and update the live
+# dashboards.
+
+MAX_RANGE_DAYS = 366
+COUNTS = ("cancelled", "reassigned", "deleted", "backfilled", "closed_slots", "expired_waitlist")
+
+
+class Summary:
+
+    def __init__(self):
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.unmoved = []
+        self.doctor_ids = set()
+        self.pending = []
+        self.deleted = []
+
+    def as_dict(self):
+        return dict(self.counts, unmoved=self.unmoved)
+
+    def announce(self):
+        # after the commit
+        for doctor_id in self.doctor_ids:
+            fragment_cache.invalidate_doctor(doctor_id)
+        for data in self.deleted:
+            events.publish("deleted", data)
+        for name, ids, also in self.pending:
+            events.appointments(name, ids, also)
+
+
+def check_range(start, end):
+    if start is None or end is None or start > end:
+        raise ValueError("start and end (YYYY-MM-DD) are required, start first")
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f"The range can cover at most {MAX_RANGE_DAYS} days")
+
+
+def _backfill(summary, slots):
+    # Offer freed (doctor_id, date, time_start) slots to the waitlists. Only
+    # days somebody is waiting for are looked at.
+    days = {(doctor_id, day) for doctor_id, day, _ in slots}
+    if not days:
+        return
+    waiting = {
+        tuple(row) for row in db.session.execute(
+            select(WaitlistEntry.doctor_id, WaitlistEntry.date).where(
+                WaitlistEntry.status == "Waiting",
+                tuple_(WaitlistEntry.doctor_id, WaitlistEntry.date).in_(list(days))
+            ).distinct()
+        )
+    }
+    booked = []
+    for doctor_id, day, time_start in sorted(slots):
+        if (doctor_id, day) not in waiting:
+            continue
+        entry = waitlist.backfill(doctor_id, day, time_start)
+        if entry is not None:
+            booked.append(entry.appointment_id)
+    if booked:
+        summary.counts["backfilled"] += len(booked)
+        summary.pending.append(("booked", booked, ()))
+
+
+def cancel(where, backfill=True, summary=None):
+    # Cancel every booked appointment matching the where clauses
+    summary = summary or Summary()
+    rows = db.session.execute(
+        update(Appointment).where(
+            Appointment.status == "Booked", *where
+        ).values(status="Cancelled").returning(
+            Appointment.id, Appointment.doctor_id, Appointment.date, Appointment.time_start
+        ),
+        execution_options={"synchronize_session": "fetch"}
+    ).all()
+    if not rows:
+        return summary
+
+    summary.counts["cancelled"] += len(rows)
+    summary.doctor_ids.update(row.doctor_id for row in rows)
+    summary.pending.append(("cancelled", [row.id for row in rows], ()))
+    if backfill:
+        _backfill(summary, [(row.doctor_id, row.date, row.time_start) for row in rows])
+    return summary
+
+
+def delete_appointments(appointment_ids, summary=None):
+    # Remove appointments with their treatments; booked slots they held go
+    # to the waitlist.
+    summary = summary or Summary()
+    if not appointment_ids:
+        return summary
+    # the dashboards get the rows as they were
+    snapshots = events.snapshots(appointment_ids)
+
+    treatment_ids = select(Treatment.id).where(Treatment.appointment_id.in_(appointment_ids))
+    db.session.execute(
+        delete(TreatmentMedicine).where(TreatmentMedicine.treatment_id.in_(treatment_ids)),
+        execution_options={"synchronize_session": False}
+    )
+    db.session.execute(
+        delete(Treatment).where(Treatment.appointment_id.in_(appointment_ids)),
+        execution_options={"synchronize_session": False}
+    )
+    db.session.execute(
+        update(WaitlistEntry).where(
+            WaitlistEntry.appointment_id.in_(appointment_ids)
+        ).values(appointment_id=None),
+        execution_options={"synchronize_session": False}
+    )
+    rows = db.session.execute(
+        delete(Appointment).where(Appointment.id.in_(appointment_ids)).returning(
+            Appointment.id, Appointment.doctor_id, Appointment.date,
+            Appointment.time_start, Appointment.status
+        ),
+        execution_options={"synchronize_session": "fetch"}
+    ).all()
+    # the rows are gone, so the session must not flush stale treatments
+    db.session.expire_all()
+
+    summary.counts["deleted"] += len(rows)
+    summary.doctor_ids.update(row.doctor_id for row in rows)
+    summary.deleted.extend(snapshots[row.id] for row in rows if row.id in snapshots)
+    _backfill(summary, [
+        (row.doctor_id, row.date, row.time_start) for row in rows if row.status == "Booked"
+    ])
+    return summary
+
+
+def close_days(doctor_id, start, end, summary=None):
+    # Unpublish the doctor's slots in the range. A recurring schedule gets
+    # closed-day overrides so materializing does not put them back.
+    summary = summary or Summary()
+    if db.session.get(DoctorSchedule, doctor_id) is not None:
+        days = (end - start).days + 1
+        schedules.set_overrides(doctor_id, {start + timedelta(days=i): [] for i in range(days)})
+    result = db.session.execute(
+        delete(DoctorAvailability).where(
+            DoctorAvailability.doctor_id == doctor_id,
+            DoctorAvailability.date >= start,
+            DoctorAvailability.date <= end
+        ),
+        execution_options={"synchronize_session": False}
+    )
+    summary.counts["closed_slots"] += result.rowcount
+    summary.counts["expired_waitlist"] += waitlist.close(doctor_id, start, end)
+    summary.doctor_ids.add(doctor_id)
+    return summary
+
+
+def cancel_range(doctor_id, start, end, close=False):
+    check_range(start, end)
+    summary = cancel(
+        (Appointment.doctor_id == doctor_id, Appointment.date >= start, Appointment.date <= end),
+        backfill=not close
+    )
+    if close:
+        close_days(doctor_id, start, end, summary)
+    return summary
+
+
+def reassign(doctor_id, target_id, start, end, cancel_unmoved=False, close=False):
+    # Move the doctor's bookings in the range to another doctor of the same
+    # department. A booking moves when the target publishes the same slot,
+    # has it free and has nothing else with that patient that day; the rest
+    # stay (listed in unmoved) or are cancelled with cancel_unmoved.
+    check_range(start, end)
+    source = db.session.get(Doctor, doctor_id)
+    target = db.session.get(Doctor, target_id)
+    if source is None or target is None:
+        raise ValueError("Unknown doctor")
+    if source.id == target.id:
+        raise ValueError("Pick a different doctor to take the appointments")
+    if source.department_id is None or source.department_id != target.department_id:
+        raise ValueError("Both doctors must be in the same department")
+
+    in_range = (Appointment.doctor_id == doctor_id, Appointment.date >= start, Appointment.date <= end)
+    taken = aliased(Appointment)
+    slot = (
+        DoctorAvailability.doctor_id == target_id,
+        DoctorAvailability.date == Appointment.date,
+        DoctorAvailability.time_start == Appointment.time_start
+    )
+    moved = db.session.execute(
+        update(Appointment).where(
+            Appointment.status == "Booked",
+            *in_range,
+            exists().where(*slot),
+            ~exists().where(
+                taken.doctor_id == target_id,
+                taken.date == Appointment.date,
+                taken.time_start == Appointment.time_start,
+                taken.status == "Booked"
+            ),
+            ~exists().where(
+                taken.doctor_id == target_id,
+                taken.patient_id == Appointment.patient_id,
+                taken.date == Appointment.date,
+                taken.status == "Booked"
+            )
+        ).values(
+            doctor_id=target_id,
+            time_end=select(DoctorAvailability.time_end).where(*slot).scalar_subquery()
+        ).returning(Appointment.id, Appointment.date, Appointment.time_start),
+        execution_options={"synchronize_session": "fetch"}
+    ).all()
+
+    summary = Summary()
+    summary.doctor_ids.update((doctor_id, target_id))
+    if moved:
+        summary.counts["reassigned"] = len(moved)
+        summary.pending.append(("reassigned", [row.id for row in moved], (doctor_id,)))
+
+    if cancel_unmoved:
+        cancel(in_range, backfill=not close, summary=summary)
+    else:
+        summary.unmoved = db.session.execute(
+            select(Appointment.id).where(Appointment.status == "Booked", *in_range)
+            .order_by(Appointment.date, Appointment.time_start)
+        ).scalars().all()
+
+    if close:
+        close_days(doctor_id, start, end, summary)
+    else:
+        _backfill(summary, [(doctor_id, row.date, row.time_start) for row in moved])
+    return summary
+
+
+def apply_selection(action, appointment_ids):
+    # action on appointments picked by id: "cancel" or "delete"
+    if action == "cancel":
+        return cancel((Appointment.id.in_(appointment_ids),))
+    if action == "delete":
+        return delete_appointments(appointment_ids)
+    raise ValueError("action must be cancel or delete")
+
+
+def apply_range(doctor_id, action, start, end, target_id=None, close=False, cancel_unmoved=False):
+    # action on a doctor's bookings in a date range: "cancel" or "reassign"
+    if action == "cancel":
+        return cancel_range(doctor_id, start, end, close)
+    if action == "reassign":
+        if target_id is None:
+            raise ValueError("Pick the doctor who takes the appointments")
+        return reassign(doctor_id, target_id, start, end, cancel_unmoved, close)
+    raise ValueError("action must be cancel or reassign")
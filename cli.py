@@ -0,0 +1,467 @@
+from sqlalchemy import create_engine, insert, select, func
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter, sleep
+from models import db, User, Doctor, Patient, DoctorAvailability, Appointment
+from datetime import date, time, timedelta
+from flask import current_app
+import click
+import os
+import sys
+import tempfile
+import threading
+import availability
+import booking
+import bulk
+import database
+import deletion
+import lifecycle
+import loadtest
+import migrations
+import passwords
+import query_plans
+import search_index
+import seed as seed_module
+
+
+@click.command("check-query-plans")
+@click.option("--verbose", is_flag=True, help="Print the full plan for every query.")
+def check_query_plans(verbose):
+    """Fail if an Appointment hot-path query falls back to a full table scan."""
+    results = query_plans.check()
+    failed = 0
+
+    for name, (plan, scans) in results.items():
+        status = "FAIL" if scans else "ok"
+        click.echo(f"{status:4} {name}")
+        if scans or verbose:
+            for step in plan:
+                click.echo(f"       {step}")
+        if scans:
+            failed += 1
+
+    if failed:
+        raise click.ClickException(f"{failed} quer{'y' if failed == 1 else 'ies'} use a full table scan")
+
+
+@contextmanager
+def scratch_engine(pragmas=None, timeout=60):
+    # A throwaway file database with the full schema, for load tools that
+    # must not touch hms.db.
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": timeout})
+    if pragmas:
+        database.tune_sqlite(engine, pragmas)
+
+    try:
+        db.metadata.create_all(engine)
+        migrations.upgrade(engine)
+        yield engine
+    finally:
+        engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def seed_booking_fixture(engine, doctors, patients, slots_by_doctor):
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {"id": i, "name": f"user {i}", "email": f"user{i}@example.com",
+             "password_hash": "x", "role": "doctor" if i <= doctors else "patient"}
+            for i in range(1, doctors + patients + 1)
+        ])
+        conn.execute(insert(Doctor), [
+            {"id": i, "user_id": i} for i in range(1, doctors + 1)
+        ])
+        conn.execute(insert(Patient), [
+            {"id": i, "user_id": doctors + i} for i in range(1, patients + 1)
+        ])
+        conn.execute(insert(DoctorAvailability), [
+            {"doctor_id": doctor_id, "date": day, "time_start": start, "time_end": end}
+            for doctor_id in range(1, doctors + 1)
+            for day, start, end in slots_by_doctor
+        ])
+
+
+@click.command("stress-booking")
+@click.option("--bookings", default=300, show_default=True, help="Concurrent attempts on one slot.")
+@click.option("--workers", default=64, show_default=True)
+def stress_booking(bookings, workers):
+    """Race many patients for one slot on a scratch database; exactly one must win."""
+    slot_date, slot_time = date.today() + timedelta(days=1), time(9, 0)
+
+    with scratch_engine() as engine:
+        seed_booking_fixture(engine, 1, bookings, [(slot_date, slot_time, time(10, 0))])
+
+        start = threading.Barrier(min(workers, bookings))
+
+        def attempt(patient_id):
+            try:
+                start.wait(timeout=5)
+            except threading.BrokenBarrierError:
+                pass
+            with Session(engine) as session:
+                return booking.book(patient_id, 1, slot_date, slot_time, session=session)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(attempt, range(1, bookings + 1)))
+
+        with engine.connect() as conn:
+            stored = conn.execute(
+                select(func.count(Appointment.id)).where(Appointment.status == "Booked")
+            ).scalar()
+
+    winners = sum(1 for appointment_id, _ in results if appointment_id)
+    rejected = sum(1 for _, error in results if error == "booked")
+    click.echo(f"{bookings} attempts: {winners} booked, {rejected} rejected, {stored} stored")
+
+    if winners != 1 or stored != 1 or winners + rejected != bookings:
+        raise click.ClickException("slot was not booked exactly once")
+
+
+def _run_booking_load(engine, writers, readers, seconds, days, slots_per_day):
+    today = date.today()
+    stop = threading.Event()
+    next_patient = iter(range(1, 10 ** 9))
+    patient_lock = threading.Lock()
+    counts = {"bookings": 0, "reads": 0, "errors": 0}
+    counts_lock = threading.Lock()
+
+    def bump(key):
+        with counts_lock:
+            counts[key] += 1
+
+    def writer(doctor_id):
+        with Session(engine) as session:
+            for day in range(days):
+                for slot in range(slots_per_day):
+                    if stop.is_set():
+                        return
+                    with patient_lock:
+                        patient_id = next(next_patient)
+                    try:
+                        _, error = booking.book(
+                            patient_id, doctor_id, today + timedelta(days=day),
+                            time(8 + slot // 4, (slot % 4) * 15), session=session
+                        )
+                        bump("errors" if error else "bookings")
+                    except OperationalError:
+                        session.rollback()
+                        bump("errors")
+
+    def reader(n):
+        statement = availability.grid_statement
+        with Session(engine) as session:
+            i = n
+            while not stop.is_set():
+                doctor_id = i % writers + 1
+                try:
+                    session.execute(statement(doctor_id, today, today + timedelta(days=6))).all()
+                    session.rollback()
+                    bump("reads")
+                except OperationalError:
+                    session.rollback()
+                    bump("errors")
+                i += 1
+
+    threads = [threading.Thread(target=writer, args=(d,)) for d in range(1, writers + 1)]
+    threads += [threading.Thread(target=reader, args=(r,)) for r in range(readers)]
+
+    started = perf_counter()
+    for t in threads:
+        t.start()
+    stop.wait(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = perf_counter() - started
+
+    return {key: value / elapsed for key, value in counts.items()}
+
+
+@click.command("bench-booking")
+@click.option("--seconds", default=5.0, show_default=True)
+@click.option("--writers", default=4, show_default=True, help="Booking threads, one doctor each.")
+@click.option("--readers", default=8, show_default=True, help="Threads reading availability grids.")
+def bench_booking(seconds, writers, readers):
+    """Compare booking and read throughput with default vs tuned SQLite settings."""
+    days, slots_per_day = 60, 40
+    today = date.today()
+    slots = [
+        (today + timedelta(days=d), time(8 + s // 4, (s % 4) * 15), time(8 + s // 4, (s % 4) * 15 + 14))
+        for d in range(days)
+        for s in range(slots_per_day)
+    ]
+    patients = writers * days * slots_per_day
+
+    modes = [
+        ("default (rollback journal)", None),
+        ("tuned (WAL, synchronous=NORMAL)", database.sqlite_pragmas()),
+    ]
+
+    click.echo(f"{'settings':34} {'bookings/s':>11} {'reads/s':>10} {'errors/s':>9}")
+    for label, pragmas in modes:
+        with scratch_engine(pragmas, timeout=5) as engine:
+            seed_booking_fixture(engine, writers, patients, slots)
+            rates = _run_booking_load(engine, writers, readers, seconds, days, slots_per_day)
+        click.echo(f"{label:34} {rates['bookings']:11.1f} {rates['reads']:10.1f} {rates['errors']:9.1f}")
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _run_login_burst(app, email, workers, logins, requests):
+    # Requests share a fixed set of workers, like a sync WSGI server; the
+    # logins are queued first so a cheap request waits behind them unless the
+    # hash pool turns the excess away. Each login posts to the login route
+    # from its own client, so it pays for the lookup and session as well.
+    latencies = []
+    outcomes = {"ok": 0, "busy": 0}
+    lock = threading.Lock()
+
+    def login():
+        response = app.test_client().post(
+            "/auth/login", data={"email": email, "password": "bench-password"}
+        )
+        response.close()
+        if response.status_code == 503:
+            key = "busy"
+        elif response.status_code == 302:
+            key = "ok"
+        else:
+            raise ValueError(f"login returned {response.status_code}")
+        with lock:
+            outcomes[key] += 1
+
+    def cheap(submitted):
+        app.test_client().get("/").close()
+        with lock:
+            latencies.append((perf_counter() - submitted) * 1000)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(login) for _ in range(logins)]
+        futures += [executor.submit(cheap, perf_counter()) for _ in range(requests)]
+    for future in futures:
+        future.result()
+
+    return latencies, outcomes
+
+
+@click.command("bench-login")
+@click.option("--workers", default=8, show_default=True, help="Simulated request workers.")
+@click.option("--logins", default=64, show_default=True, help="Logins in the burst.")
+@click.option("--requests", default=200, show_default=True, help="Non-auth requests during the burst.")
+def bench_login(workers, logins, requests):
+    """Compare non-auth request latency during a login burst through /auth/login with inline vs pooled hashing."""
+    app = current_app._get_current_object()
+    method = app.config["PASSWORD_HASH_METHOD"]
+    pool_workers = max(1, app.config["PASSWORD_POOL_WORKERS"])
+    max_pending = min(app.config["PASSWORD_POOL_MAX_PENDING"], workers // 2 or 1)
+    # a throwaway patient account, removed afterwards
+    email = "bench-login@example.invalid"
+
+    modes = [
+        ("no requests in flight", None),
+        ("inline hashing", dict(workers=0, max_pending=logins + requests, timeout=None)),
+        (f"pool ({pool_workers} procs, {max_pending} pending)",
+         dict(workers=pool_workers, max_pending=max_pending, timeout=0.05)),
+    ]
+
+    if User.query.filter_by(email=email).first():
+        raise click.ClickException(f"{email} already exists; remove it first")
+    user = User(name="Login Bench", email=email, role="patient")
+    db.session.add(user)
+
+    click.echo(f"{'hashing':32} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'logins ok':>10} {'503s':>6}")
+    try:
+        for label, options in modes:
+            passwords.configure(method=method, **(options or dict(workers=0)))
+            user.password_hash = passwords.hash_password("bench-password")
+            db.session.commit()
+            latencies, outcomes = _run_login_burst(
+                app, email, workers, logins if options else 0, requests
+            )
+            click.echo(
+                f"{label:32} {_percentile(latencies, 50):8.1f} {_percentile(latencies, 95):8.1f} "
+                f"{_percentile(latencies, 99):8.1f} {outcomes['ok']:10} {outcomes['busy']:6}"
+            )
+    finally:
+        passwords.init_app(app)
+        db.session.rollback()
+        if user.id is not None:
+            db.session.delete(user)
+            db.session.commit()
+
+
+@click.command("import-data")
+@click.argument("kind", type=click.Choice(bulk.KINDS))
+@click.argument("source", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("--format", "fmt", type=click.Choice(bulk.FORMATS), help="Defaults to the file extension, jsonl for stdin.")
+@click.option("--batch-size", default=bulk.BATCH_SIZE, show_default=True, help="Rows per transaction.")
+@click.option("--hash-workers", default=os.cpu_count() or 1, show_default=True, help="Processes hashing plain passwords.")
+def import_data(kind, source, fmt, batch_size, hash_workers):
+    """Stream-import departments, users, doctors, patients or appointments from CSV/JSONL."""
+    app = current_app._get_current_object()
+    fmt = fmt or bulk.format_for(source)
+    started = perf_counter()
+
+    passwords.configure(method=app.config["PASSWORD_HASH_METHOD"], workers=hash_workers)
+    stream = sys.stdin if source == "-" else open(source, newline="", encoding="utf-8")
+    imported = 0
+    try:
+        imported = bulk.import_rows(kind, bulk.read_rows(stream, fmt), batch_size)
+        if kind == "doctors":
+            search_index.rebuild()
+            db.session.commit()
+    except (bulk.InvalidRow, ValueError, IntegrityError) as e:
+        raise click.ClickException(f"batch failed, earlier batches were kept: {e}")
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        passwords.init_app(app)
+
+    click.echo(f"imported {imported} {kind} in {perf_counter() - started:.1f}s")
+
+
+@click.command("export-data")
+@click.argument("kind", type=click.Choice(bulk.KINDS))
+@click.argument("target", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "fmt", type=click.Choice(bulk.FORMATS), help="Defaults to the file extension, jsonl for stdout.")
+@click.option("--batch-size", default=bulk.BATCH_SIZE, show_default=True, help="Rows fetched per round trip.")
+def export_data(kind, target, fmt, batch_size):
+    """Stream-export a table in the format import-data reads."""
+    fmt = fmt or bulk.format_for(target)
+    stream = sys.stdout if target == "-" else open(target, "w", newline="", encoding="utf-8")
+    try:
+        bulk.write_rows(stream, fmt, bulk.COLUMNS[kind], bulk.export_rows(kind, batch_size))
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+
+
+@click.command("seed-data")
+@click.option("--departments", default=10, show_default=True)
+@click.option("--doctors", default=50, show_default=True)
+@click.option("--patients", default=5000, show_default=True)
+@click.option("--years", default=2, show_default=True, help="Years of appointment history.")
+@click.option("--fill", default=0.7, show_default=True, help="Share of past slots that were booked.")
+@click.option("--seed", default=0, show_default=True, help="Random seed, for repeatable data.")
+def seed_data(departments, doctors, patients, years, fill, seed):
+    """Fill the configured database with synthetic departments, doctors, patients and appointments."""
+    started = perf_counter()
+    counts = seed_module.generate(
+        departments=departments, doctors=doctors, patients=patients, years=years, fill=fill,
+        seed=seed, progress=lambda kind, n: click.echo(f"  {kind}: {n}", err=True)
+    )
+    summary = ", ".join(f"{n} {kind}" for kind, n in counts.items())
+    click.echo(f"seeded {summary} in {perf_counter() - started:.1f}s (password: {seed_module.PASSWORD})")
+
+
+@click.command("bench-routes")
+@click.option("--sessions", default=200, show_default=True, help="Patient, doctor and admin sessions to run.")
+@click.option("--concurrency", default=4, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+@click.option("--baseline", type=click.Path(dir_okay=False), help="JSON baseline to compare against.")
+@click.option("--save-baseline", is_flag=True, help="Write the results to --baseline instead of comparing.")
+@click.option("--tolerance", default=0.5, show_default=True, help="Allowed p95 growth over the baseline.")
+def bench_routes(sessions, concurrency, seed, baseline, save_baseline, tolerance):
+    """Run patient, doctor and admin workflows and report per-step latency and query counts."""
+    app = current_app._get_current_object()
+    try:
+        results, seconds = loadtest.run(app, sessions, concurrency, seed)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    total = sum(r["requests"] for r in results.values())
+    click.echo(f"{'step':30} {'reqs':>6} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'errors':>7}")
+    for step, r in results.items():
+        click.echo(
+            f"{step:30} {r['requests']:6} {r['rps']:7.1f} {r['p50']:8.1f} {r['p95']:8.1f} "
+            f"{r['p99']:8.1f} {r['avg_queries']:8.1f} {r['errors']:7}"
+        )
+    click.echo(f"{total} requests in {seconds:.1f}s ({total / seconds:.1f} req/s)")
+
+    if baseline and save_baseline:
+        loadtest.save_baseline(baseline, results)
+        click.echo(f"baseline written to {baseline}")
+    elif baseline:
+        regressions = loadtest.compare(results, loadtest.load_baseline(baseline), tolerance)
+        for line in regressions:
+            click.echo(f"REGRESSION {line}")
+        if regressions:
+            raise click.ClickException(f"{len(regressions)} regression(s) against {baseline}")
+
+
+@click.command("lifecycle")
+@click.option("--once", is_flag=True, help="Run one pass and exit.")
+@click.option("--interval", default=300, show_default=True, help="Seconds between passes.")
+@click.option("--archive-after-days", default=lifecycle.ARCHIVE_AFTER_DAYS, show_default=True)
+@click.option("--batch-size", default=lifecycle.BATCH_SIZE, show_default=True, help="Appointments per transaction.")
+def lifecycle_worker(once, interval, archive_after_days, batch_size):
+    """Close past bookings (treated ones as completed, the rest as no-shows), archive old appointments and publish schedules, once or in a loop."""
+    while True:
+        try:
+            result = lifecycle.run_once(archive_after_days=archive_after_days, batch_size=batch_size)
+            click.echo(
+                f"{result['completed']} completed, {result['no_shows']} no-shows, {result['archived']} archived, "
+                f"{result['published_days']} schedule days published, "
+                f"{result['expired_waitlist']} waitlist entries expired"
+            )
+        except OperationalError as e:
+            if once:
+                raise click.ClickException(str(e))
+            db.session.rollback()
+            click.echo(f"skipped: {e.orig}", err=True)
+        finally:
+            db.session.remove()
+
+        if once:
+            return
+        sleep(interval)
+
+
+@click.command("delete-account")
+@click.option("--doctor", "doctor_id", type=int, help="Doctor id.")
+@click.option("--patient", "patient_id", type=int, help="Patient id.")
+@click.option("--anonymize", is_flag=True, help="Keep a patient's visits, drop who they were.")
+@click.option("--batch-size", default=deletion.BATCH_SIZE, show_default=True, help="Appointments per transaction.")
+@click.option("--pause", default=deletion.PAUSE, show_default=True, help="Seconds between batches.")
+def delete_account(doctor_id, patient_id, anonymize, batch_size, pause):
+    """Delete a doctor or patient with their whole history, in batches that leave room for bookings."""
+    if (doctor_id is None) == (patient_id is None):
+        raise click.UsageError("Pass exactly one of --doctor and --patient")
+    if anonymize and patient_id is None:
+        raise click.UsageError("--anonymize only applies to patients")
+
+    started = perf_counter()
+    if anonymize:
+        result = deletion.anonymize_patient(patient_id)
+    elif doctor_id is not None:
+        result = deletion.delete_doctor(doctor_id, batch_size, pause)
+    else:
+        result = deletion.delete_patient(patient_id, batch_size, pause)
+    if result is None:
+        raise click.ClickException("No such account")
+
+    click.echo(", ".join(f"{count} {name}" for name, count in result.items()) + f" in {perf_counter() - started:.1f}s")
+
+
+def register_commands(app):
+    app.cli.add_command(check_query_plans)
+    app.cli.add_command(stress_booking)
+    app.cli.add_command(bench_booking)
+    app.cli.add_command(bench_login)
+    app.cli.add_command(import_data)
+    app.cli.add_command(export_data)
+    app.cli.add_command(seed_data)
+    app.cli.add_command(bench_routes)
+    app.cli.add_command(lifecycle_worker)
+    app.cli.add_command(delete_account)
@@ -0,0 +1,47 @@
+from flask import request, current_app
+import gzip
+
+# Response compression for the JSON API. Brotli is used when the package is
+# installed and the client accepts it, gzip otherwise.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_BYTES = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def choose_encoding(accept_encoding):
+    if brotli is not None and accept_encoding["br"]:
+        return "br"
+    if accept_encoding["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress(response):
+    # used as an after_request hook
+    response.vary.add("Accept-Encoding")
+
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers):
+        return response
+
+    body = response.get_data()
+    if len(body) < current_app.config.get("API_COMPRESS_MIN_BYTES", MIN_BYTES):
+        return response
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding == "br":
+        body = brotli.compress(body, quality=current_app.config.get("API_BROTLI_QUALITY", BROTLI_QUALITY))
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=current_app.config.get("API_GZIP_LEVEL", GZIP_LEVEL))
+    else:
+        return response
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
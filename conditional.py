@@ -0,0 +1,48 @@
+from flask import request, make_response
+from datetime import datetime, timezone
+import hashlib
+
+# Cache-Control for the patient pages. Directory data (profiles, search) may
+# be reused for a minute; anything showing bookings must be revalidated, which
+# is cheap because unchanged pages answer 304 from the version lookup alone.
+DIRECTORY = "private, max-age=60"
+REVALIDATE = "private, no-cache"
+
+
+def make_etag(*parts):
+    return hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()[:32]
+
+
+def last_modified(*timestamps):
+    # Pages that show the booking window change at midnight even when no
+    # doctor did, so they are never older than the start of today. Stored
+    # timestamps are naive UTC (CURRENT_TIMESTAMP), so the floor is too.
+    newest = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    for ts in timestamps:
+        if ts is not None:
+            ts = ts.replace(tzinfo=timezone.utc)
+            if ts > newest:
+                newest = ts
+    return newest.replace(microsecond=0)
+
+
+def _fresh(etag, modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return modified <= request.if_modified_since
+    return False
+
+
+def respond(etag, modified, cache_control, render):
+    # render is only called when the client's copy is stale
+    if _fresh(etag, modified):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak=True)
+    response.last_modified = modified
+    response.headers["Cache-Control"] = cache_control
+    response.vary.add("Cookie")
+    return response
@@ -0,0 +1,92 @@
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+import os
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def load_config(app):
+    url = os.getenv("DATABASE_URL", "sqlite:///hms.db")
+    # The schema relies on SQLite: triggers, FTS5, rowid, NOCASE and partial
+    # indexes declared with sqlite_where. On another database those indexes
+    # would become full unique indexes, so refuse to start rather than run
+    # with them.
+    if make_url(url).get_backend_name() != "sqlite":
+        raise RuntimeError(f"DATABASE_URL must be a sqlite:// URL, got {make_url(url).drivername}://")
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+
+    options = {
+        "pool_pre_ping": _env_bool("DB_POOL_PRE_PING", True),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "3600")),
+    }
+    if os.getenv("DB_POOL_SIZE"):
+        options["pool_size"] = int(os.getenv("DB_POOL_SIZE"))
+    if os.getenv("DB_MAX_OVERFLOW"):
+        options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW"))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    app.config['SQLITE_TUNING'] = _env_bool("SQLITE_TUNING", True)
+    app.config['SQLITE_SYNCHRONOUS'] = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    app.config['SQLITE_MMAP_SIZE'] = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+
+def sqlite_pragmas(synchronous="NORMAL", busy_timeout_ms=5000, mmap_size=256 * 1024 * 1024):
+    return [
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA synchronous={synchronous}",
+        f"PRAGMA busy_timeout={int(busy_timeout_ms)}",
+        f"PRAGMA mmap_size={int(mmap_size)}",
+        # SQLite only enforces the models' foreign keys (and their ON DELETE
+        # actions) when asked to, per connection
+        "PRAGMA foreign_keys=ON",
+    ]
+
+
+def tune_sqlite(engine, pragmas):
+    # WAL lets readers keep going while a booking commits, and NORMAL
+    # synchronous only fsyncs at checkpoints. Both are per-connection (WAL is
+    # persisted in the file once set), so apply them on every new connection.
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def init_engine(app, engine):
+    if app.config.get('SQLITE_TUNING'):
+        tune_sqlite(engine, sqlite_pragmas(
+            app.config['SQLITE_SYNCHRONOUS'],
+            app.config['SQLITE_BUSY_TIMEOUT_MS'],
+            app.config['SQLITE_MMAP_SIZE'],
+        ))
+
+
+def sync_triggers(conn, prefix, triggers):
+    # Make the triggers named prefix* match {name: body}: stale or changed
+    # ones are dropped and recreated, missing ones created. Returns whether
+    # anything changed.
+    existing = dict(conn.execute(text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE :prefix"
+    ), {"prefix": prefix + "%"}).all())
+
+    changed = False
+    for name, sql in existing.items():
+        if sql != f"CREATE TRIGGER {name} {triggers.get(name)}":
+            conn.execute(text(f"DROP TRIGGER {name}"))
+            changed = True
+    for name, body in triggers.items():
+        if existing.get(name) != f"CREATE TRIGGER {name} {body}":
+            conn.execute(text(f"CREATE TRIGGER {name} {body}"))
+            changed = True
+    return changed
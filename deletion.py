@@ -0,0 +1,188 @@
+from sqlalchemy import select, update, delete, literal_column
+from models import (
+    db, User, Doctor, Patient, DoctorAvailability, DoctorSchedule, ScheduleTemplateSlot,
+    ScheduleOverride, Appointment, Treatment, TreatmentMedicine, WaitlistEntry,
+    AppointmentArchive, TreatmentArchive, TreatmentMedicineArchive, DoctorDailyStats
+)
+from datetime import date, datetime
+from time import sleep
+import bulk_admin
+import fragment_cache
+import principal_cache
+import search_index
+import waitlist
+
+# Removing doctors and patients with everything that hangs off them. A long
+# history is deleted BATCH_SIZE appointments (live, then archived) at a time,
+# children first, each batch its own short transaction with PAUSE seconds in
+# between, so bookings never queue long behind the write lock. The first
+# transaction locks the account, cancels what is still booked and, for a
+# doctor, unpublishes the slots and the search entry: stopping half-way
+# leaves an account nobody can use or book, and running again finishes it.
+#
+# anonymize_patient() is the alternative for patients that keeps the visits
+# (and the doctors' statistics) but drops who the patient was.
+
+BATCH_SIZE = 500
+PAUSE = 0.05
+# werkzeug never accepts a hash without a method prefix
+LOCKED_PASSWORD = "!"
+
+HISTORY = (
+    (Appointment, Treatment, TreatmentMedicine),
+    (AppointmentArchive, TreatmentArchive, TreatmentMedicineArchive),
+)
+
+
+def _lock(user_id):
+    db.session.execute(update(User).where(User.id == user_id).values(password_hash=LOCKED_PASSWORD))
+
+
+def _delete_history(column, owner_id, batch_size, pause):
+    removed = 0
+    for appointment, treatment, medicine in HISTORY:
+        owner = getattr(appointment, column)
+        while True:
+            ids = db.session.execute(
+                select(appointment.id).where(owner == owner_id).limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                break
+
+            treatment_ids = select(treatment.id).where(treatment.appointment_id.in_(ids))
+            db.session.execute(delete(medicine).where(medicine.treatment_id.in_(treatment_ids)))
+            db.session.execute(delete(treatment).where(treatment.appointment_id.in_(ids)))
+            if appointment is Appointment:
+                db.session.execute(
+                    update(WaitlistEntry).where(WaitlistEntry.appointment_id.in_(ids)).values(appointment_id=None)
+                )
+            db.session.execute(delete(appointment).where(appointment.id.in_(ids)))
+            db.session.commit()
+            removed += len(ids)
+            sleep(pause)
+    return removed
+
+
+def _delete_rows(model, where, batch_size, pause):
+    # by rowid, so it works for composite keys too
+    rowid = literal_column("rowid")
+    removed = 0
+    while True:
+        result = db.session.execute(
+            delete(model).where(rowid.in_(select(rowid).select_from(model).where(where).limit(batch_size)))
+        )
+        db.session.commit()
+        removed += result.rowcount
+        if result.rowcount < batch_size:
+            return removed
+        sleep(pause)
+
+
+def _release_bookings(where, backfill):
+    # cancel what is still to come, through the same path as the admin bulk cancel
+    return bulk_admin.cancel((*where, Appointment.date >= date.today()), backfill=backfill)
+
+
+def delete_doctor(doctor_id, batch_size=BATCH_SIZE, pause=PAUSE):
+    doctor = db.session.get(Doctor, doctor_id)
+    if doctor is None:
+        return None
+    user_id = doctor.user_id
+
+    _lock(user_id)
+    summary = _release_bookings((Appointment.doctor_id == doctor_id,), backfill=False)
+    # Unpublished in the same transaction, so nobody can find or book the
+    # doctor while the history goes; the schedule goes too, or the next
+    # lifecycle pass would publish its slots again. Past slots are history
+    # and go in batches below.
+    db.session.execute(delete(ScheduleTemplateSlot).where(ScheduleTemplateSlot.doctor_id == doctor_id))
+    db.session.execute(delete(ScheduleOverride).where(ScheduleOverride.doctor_id == doctor_id))
+    db.session.execute(delete(DoctorSchedule).where(DoctorSchedule.doctor_id == doctor_id))
+    db.session.execute(delete(DoctorAvailability).where(
+        DoctorAvailability.doctor_id == doctor_id,
+        DoctorAvailability.date >= date.today()
+    ))
+    search_index.remove_doctor(doctor_id)
+    waitlist.close(doctor_id, date.min, date.max)
+    db.session.commit()
+    principal_cache.invalidate(user_id)
+    summary.doctor_ids.add(doctor_id)
+    summary.announce()
+
+    result = {
+        "appointments": _delete_history("doctor_id", doctor_id, batch_size, pause),
+        "slots": _delete_rows(DoctorAvailability, DoctorAvailability.doctor_id == doctor_id, batch_size, pause),
+        "waitlist": _delete_rows(WaitlistEntry, WaitlistEntry.doctor_id == doctor_id, batch_size, pause),
+    }
+
+    db.session.execute(delete(DoctorDailyStats).where(DoctorDailyStats.doctor_id == doctor_id))
+    db.session.execute(delete(Doctor).where(Doctor.id == doctor_id))
+    db.session.execute(delete(User).where(User.id == user_id))
+    db.session.commit()
+    db.session.expire_all()
+    principal_cache.invalidate(user_id)
+    fragment_cache.invalidate_doctor(doctor_id)
+    return result
+
+
+def delete_patient(patient_id, batch_size=BATCH_SIZE, pause=PAUSE):
+    patient = db.session.get(Patient, patient_id)
+    if patient is None:
+        return None
+    user_id = patient.user_id
+
+    _lock(user_id)
+    # freed slots go to whoever is waiting for them
+    summary = _release_bookings((Appointment.patient_id == patient_id,), backfill=True)
+    db.session.commit()
+    principal_cache.invalidate(user_id)
+    summary.announce()
+
+    result = {
+        "appointments": _delete_history("patient_id", patient_id, batch_size, pause),
+        "waitlist": _delete_rows(WaitlistEntry, WaitlistEntry.patient_id == patient_id, batch_size, pause),
+    }
+
+    db.session.execute(delete(Patient).where(Patient.id == patient_id))
+    db.session.execute(delete(User).where(User.id == user_id))
+    db.session.commit()
+    db.session.expire_all()
+    principal_cache.invalidate(user_id)
+    if result["waitlist"]:
+        # others move up the queue
+        waitlist.notify()
+    return result
+
+
+def anonymize_patient(patient_id):
+    # One transaction: upcoming bookings are cancelled, waitlist places
+    # given up, and the account keeps no name, contact or way to log in.
+    patient = db.session.get(Patient, patient_id)
+    if patient is None:
+        return None
+    user_id = patient.user_id
+
+    summary = _release_bookings((Appointment.patient_id == patient_id,), backfill=True)
+    left = db.session.execute(
+        update(WaitlistEntry).where(
+            WaitlistEntry.patient_id == patient_id,
+            WaitlistEntry.status == "Waiting"
+        ).values(status="Left", updated_at=datetime.utcnow())
+    ).rowcount
+    db.session.execute(
+        update(User).where(User.id == user_id).values(
+            name="Deleted patient",
+            email=f"deleted-{user_id}@invalid",
+            password_hash=LOCKED_PASSWORD
+        )
+    )
+    db.session.execute(
+        update(Patient).where(Patient.id == patient_id).values(dob=None, contact=None, address=None)
+    )
+    db.session.commit()
+    db.session.expire_all()
+    principal_cache.invalidate(user_id)
+    summary.announce()
+    if left:
+        waitlist.notify()
+    return {"cancelled": summary.counts["cancelled"], "waitlist": left}
@@ -0,0 +1,185 @@
+from flask import Response
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from models import db, User, Doctor, Patient, Department, Appointment
+from collections import deque
+from time import monotonic
+import json
+import threading
+import uuid
+
+# In-process pub/sub for the live dashboards. Write paths call appointment()
+# or appointments() after they commit; the event carries the appointment as the dashboards
+# show it, goes to the "admin" channel and to its doctor's channel, and is
+# kept in a ring buffer of the last BACKLOG events. stream() serves one
+# channel as server-sent events. Ids are "<epoch>.<n>": a client that comes
+# back with an id from another process run, or one that fell out of the
+# buffer, is sent a "reset" event and reloads instead of missing deltas.
+#
+# Like the waitlist wake-ups, delivery is per process: run the app as one
+# process with threads for screens to see every write.
+
+BACKLOG = 1000
+KEEPALIVE_SECONDS = 15
+EPOCH = uuid.uuid4().hex[:8]
+
+
+class Bus:
+
+    def __init__(self, backlog=BACKLOG):
+        self._changed = threading.Condition()
+        self._events = deque(maxlen=backlog)
+        self._last = 0
+
+    def position(self):
+        with self._changed:
+            return self._last
+
+    def publish(self, channels, name, data):
+        with self._changed:
+            self._last += 1
+            self._events.append((self._last, frozenset(channels), name, data))
+            self._changed.notify_all()
+            return self._last
+
+    def read(self, channel, after, timeout):
+        # Events on channel newer than after, waiting up to timeout for one.
+        # Returns (events, position, missed); missed means some were already
+        # dropped from the buffer.
+        deadline = monotonic() + timeout
+        with self._changed:
+            while True:
+                if self._events and self._events[0][0] > after + 1:
+                    return [], self._last, True
+                found = [e for e in self._events if e[0] > after and channel in e[1]]
+                after = self._last
+                remaining = deadline - monotonic()
+                if found or remaining <= 0:
+                    return found, after, False
+                self._changed.wait(remaining)
+
+
+bus = Bus()
+
+
+def doctor_channel(doctor_id):
+    return f"doctor:{doctor_id}"
+
+
+def position():
+    # the id a freshly rendered page passes to its stream as ?since=
+    return f"{EPOCH}.{bus.position()}"
+
+
+def _resume(value):
+    # position to continue from, or None when the id is unusable
+    epoch, _, n = (value or "").partition(".")
+    if epoch != EPOCH or not n.isdigit() or int(n) > bus.position():
+        return None
+    return int(n)
+
+
+def snapshots(appointment_ids):
+    # {id: appointment as the dashboards show it}, one query
+    if not appointment_ids:
+        return {}
+    doctor_user = aliased(User)
+    patient_user = aliased(User)
+    rows = db.session.execute(
+        select(
+            Appointment.id, Appointment.doctor_id, doctor_user.name, Department.name,
+            Appointment.patient_id, patient_user.name, Appointment.date,
+            Appointment.time_start, Appointment.time_end, Appointment.status
+        ).join(
+            Doctor, Doctor.id == Appointment.doctor_id
+        ).join(
+            doctor_user, doctor_user.id == Doctor.user_id
+        ).outerjoin(
+            Department, Department.id == Doctor.department_id
+        ).join(
+            Patient, Patient.id == Appointment.patient_id
+        ).join(
+            patient_user, patient_user.id == Patient.user_id
+        ).where(Appointment.id.in_(appointment_ids))
+    )
+    return {
+        row[0]: {
+            "id": row[0],
+            "doctor_id": row[1],
+            "doctor": row[2],
+            "department": row[3],
+            "patient_id": row[4],
+            "patient": row[5],
+            "date": row[6].strftime("%Y-%m-%d"),
+            "time_start": row[7].strftime("%H:%M"),
+            "time_end": row[8].strftime("%H:%M"),
+            "status": row[9],
+        }
+        for row in rows
+    }
+
+
+def publish(name, data, also=()):
+    # to the admins, the appointment's doctor and any doctor ids in also
+    channels = {"admin", doctor_channel(data["doctor_id"])}
+    channels.update(doctor_channel(doctor_id) for doctor_id in also)
+    return bus.publish(channels, name, data)
+
+
+def appointments(name, appointment_ids, also=()):
+    # name is "booked", "cancelled", "completed", "treatment", "reassigned"
+    # or "deleted". Call after the commit so screens never see a write that
+    # was rolled back.
+    found = snapshots(appointment_ids)
+    for appointment_id in appointment_ids:
+        if appointment_id in found:
+            publish(name, found[appointment_id], also)
+
+
+def appointment(name, appointment_id):
+    appointments(name, [appointment_id])
+
+
+def released(appointment_id, entry):
+    # a cancellation and, when the waitlist took the slot, the new booking
+    appointment("cancelled", appointment_id)
+    if entry is not None:
+        appointment("booked", entry.appointment_id)
+
+
+def _frame(event_id, name, data):
+    return f"id: {EPOCH}.{event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(channel, last_event_id, lifetime):
+    # Server-sent events for one channel, starting after last_event_id. The
+    # stream ends after lifetime seconds and EventSource reconnects with
+    # Last-Event-ID. It never touches the database, so it runs outside the
+    # request context and holds no connection while it waits.
+    after = _resume(last_event_id)
+
+    def generate(after):
+        deadline = monotonic() + lifetime
+        yield "retry: 3000\n\n"
+        if after is None:
+            after = bus.position()
+            yield _frame(after, "reset", {})
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return
+            events, after, missed = bus.read(channel, after, min(KEEPALIVE_SECONDS, remaining))
+            if missed:
+                yield _frame(after, "reset", {})
+            elif events:
+                for event_id, _, name, data in events:
+                    yield _frame(event_id, name, data)
+            else:
+                # an id-only frame moves Last-Event-ID past other channels' events
+                yield f": keep-alive\nid: {EPOCH}.{after}\n\n"
+
+    return Response(
+        generate(after),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
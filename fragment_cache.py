@@ -0,0 +1,316 @@
+from abc import ABC, abstractmethod
+from markupsafe import Markup
+from collections import OrderedDict, Counter
+from time import monotonic, time
+import hashlib
+import os
+import shutil
+import threading
+
+# Rendered template fragments keyed by doctor and doctor version (see
+# versions.py), so a booking or availability edit makes the old entries
+# unreachable. Write paths also call invalidate_doctor() to free them right
+# away instead of waiting for TTL or eviction.
+
+
+class FragmentCacheBackend(ABC):
+    # Stores rendered strings. Every entry is tagged with a doctor id so all
+    # of a doctor's fragments can be dropped at once.
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, tag):
+        pass
+
+    @abstractmethod
+    def delete_tag(self, tag):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def info(self):
+        return {}
+
+
+class LRUFragmentCache(FragmentCacheBackend):
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        expires, value, tag = self._entries.pop(key)
+        self._bytes -= len(value)
+        keys = self._tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, tag):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (monotonic() + self.ttl, value, tag)
+            self._tags.setdefault(tag, set()).add(key)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete_tag(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+class DiskFragmentCache(FragmentCacheBackend):
+    # One file per entry under <directory>/<tag>/<version>/, so fragments
+    # survive a restart and are shared by server processes on the same host.
+    # Expiry uses the file's mtime. Storing a newer version of a doctor
+    # removes the older version directories, whatever bumped the version
+    # (a trigger from a bulk import or the lifecycle job never calls
+    # invalidate_doctor()). The size limit is checked against a running
+    # total kept by each process; when that goes over max_bytes the
+    # directory is scanned and the oldest files removed, so with several
+    # processes the limit is approximate.
+
+    def __init__(self, directory, max_bytes=32 * 1024 * 1024, ttl=300):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._bytes = self._shrink()
+
+    def _path(self, key):
+        _, tag, version = key.split(":", 3)[:3]
+        return os.path.join(self.directory, tag, version, hashlib.sha1(key.encode()).hexdigest())
+
+    def _files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _shrink(self):
+        # Drop expired files and, when over max_bytes, the oldest down to
+        # three quarters of it, so the next scan is some writes away.
+        # Returns the bytes left.
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        limit = self.max_bytes if total <= self.max_bytes else self.max_bytes * 3 // 4
+        expired = time() - self.ttl
+        for mtime, size, path in files:
+            if mtime >= expired and total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if mtime >= expired:
+                self.evictions += 1
+        return total
+
+    def _prune_versions(self, tag, version):
+        tag_dir = os.path.join(self.directory, str(tag))
+        try:
+            names = os.listdir(tag_dir)
+        except OSError:
+            return
+        for name in names:
+            if name.isdigit() and int(name) >= version:
+                continue
+            path = os.path.join(tag_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time():
+                os.remove(path)
+                return None
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, value, tag):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        version_dir = os.path.dirname(path)
+        try:
+            if not os.path.isdir(version_dir):
+                # first entry for this version
+                self._prune_versions(tag, int(os.path.basename(version_dir)))
+                os.makedirs(version_dir, exist_ok=True)
+            # write then rename, so a reader never sees half a file
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError:
+            # another process pruned the directory meanwhile; the next
+            # request renders it again
+            return
+        with self._lock:
+            self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._bytes = self._shrink()
+
+    def delete_tag(self, tag):
+        shutil.rmtree(os.path.join(self.directory, str(tag)), ignore_errors=True)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        with self._lock:
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                "backend": "disk",
+                "directory": self.directory,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+_backend = LRUFragmentCache()
+_lock = threading.Lock()
+_stats = {"hits": Counter(), "misses": Counter()}
+_invalidations = 0
+
+
+def init_app(app, backend=None):
+    global _backend
+    if backend is None:
+        ttl = app.config.get("FRAGMENT_CACHE_TTL", 300)
+        max_bytes = app.config.get("FRAGMENT_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+        directory = app.config.get("FRAGMENT_CACHE_DIR")
+        if directory:
+            backend = DiskFragmentCache(directory, max_bytes, ttl)
+        else:
+            backend = LRUFragmentCache(max_bytes, ttl)
+    _backend = backend
+
+
+def key(kind, doctor_id, version, *parts):
+    # the doctor id and version must stay the second and third fields,
+    # DiskFragmentCache reads them
+    return ":".join(str(p) for p in (kind, doctor_id, version) + parts)
+
+
+def get_or_render(kind, doctor_id, version, parts, render):
+    cache_key = key(kind, doctor_id, version, *parts)
+    value = _backend.get(cache_key)
+    with _lock:
+        _stats["hits" if value is not None else "misses"][kind] += 1
+    if value is None:
+        value = str(render())
+        _backend.set(cache_key, value, doctor_id)
+    return Markup(value)
+
+
+def get_many(kind, doctor_versions, render_missing, parts=()):
+    # doctor_versions is [(doctor_id, version), ...]; render_missing gets the
+    # ids without a cached fragment and returns {doctor_id: rendered}
+    keys = [(doctor_id, key(kind, doctor_id, version, *parts)) for doctor_id, version in doctor_versions]
+    values = {doctor_id: _backend.get(cache_key) for doctor_id, cache_key in keys}
+    missing = [doctor_id for doctor_id, value in values.items() if value is None]
+
+    with _lock:
+        _stats["hits"][kind] += len(values) - len(missing)
+        _stats["misses"][kind] += len(missing)
+
+    if missing:
+        rendered = render_missing(missing)
+        for doctor_id, cache_key in keys:
+            if doctor_id in rendered:
+                values[doctor_id] = str(rendered[doctor_id])
+                _backend.set(cache_key, values[doctor_id], doctor_id)
+
+    return [Markup(values[doctor_id]) for doctor_id, _ in keys if values[doctor_id] is not None]
+
+
+def invalidate_doctor(doctor_id):
+    global _invalidations
+    _backend.delete_tag(doctor_id)
+    with _lock:
+        _invalidations += 1
+
+
+def stats():
+    with _lock:
+        kinds = set(_stats["hits"]) | set(_stats["misses"])
+        by_kind = {}
+        for kind in sorted(kinds):
+            hits, misses = _stats["hits"][kind], _stats["misses"][kind]
+            by_kind[kind] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+            }
+        return {"fragments": by_kind, "invalidations": _invalidations, **_backend.info()}
+
+
+def reset_stats():
+    global _invalidations
+    with _lock:
+        _stats["hits"].clear()
+        _stats["misses"].clear()
+        _invalidations = 0
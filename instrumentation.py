@@ -0,0 +1,177 @@
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from collections import Counter
+from time import perf_counter
+from models import db
+import threading
+
+SLOWEST_KEPT = 5
+
+_lock = threading.Lock()
+_endpoints = {}
+_local = threading.local()
+
+
+def _endpoint_stats(endpoint):
+    stats = _endpoints.get(endpoint)
+    if stats is None:
+        stats = _endpoints[endpoint] = {
+            "requests": 0,
+            "queries": 0,
+            "max_queries": 0,
+            "sql_ms": 0.0,
+            "template_ms": 0.0,
+            "total_ms": 0.0,
+            "slowest": [],
+            "n_plus_one": {},
+        }
+    return stats
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "sql_stats" in g:
+        conn.info.setdefault("query_start", []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not (has_request_context() and "sql_stats" in g):
+        return
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    elapsed = (perf_counter() - starts.pop()) * 1000
+
+    stats = g.sql_stats
+    stats["queries"] += 1
+    stats["sql_ms"] += elapsed
+    stats["statements"][statement] += 1
+    stats["timings"].append((elapsed, statement))
+
+
+def _before_render(sender, template, context, **extra):
+    if "sql_stats" in g:
+        g.sql_stats["render_start"].append(perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    if "sql_stats" in g and g.sql_stats["render_start"]:
+        started = g.sql_stats["render_start"].pop()
+        g.sql_stats["template_ms"] += (perf_counter() - started) * 1000
+
+
+def _start_request():
+    g.sql_stats = {
+        "started": perf_counter(),
+        "queries": 0,
+        "sql_ms": 0.0,
+        "template_ms": 0.0,
+        "render_start": [],
+        "statements": Counter(),
+        "timings": [],
+    }
+
+
+def _repeated(stats, threshold):
+    return {s: n for s, n in stats["statements"].items() if n > threshold}
+
+
+def _record(endpoint, stats, threshold):
+    total_ms = (perf_counter() - stats["started"]) * 1000
+    _local.last = {"endpoint": endpoint, "queries": stats["queries"], "total_ms": total_ms}
+    with _lock:
+        agg = _endpoint_stats(endpoint)
+        agg["requests"] += 1
+        agg["queries"] += stats["queries"]
+        agg["max_queries"] = max(agg["max_queries"], stats["queries"])
+        agg["sql_ms"] += stats["sql_ms"]
+        agg["template_ms"] += stats["template_ms"]
+        agg["total_ms"] += total_ms
+
+        slowest = agg["slowest"] + [
+            {"ms": round(ms, 3), "statement": statement}
+            for ms, statement in sorted(stats["timings"], reverse=True)[:SLOWEST_KEPT]
+        ]
+        agg["slowest"] = sorted(slowest, key=lambda s: s["ms"], reverse=True)[:SLOWEST_KEPT]
+
+        for statement, count in _repeated(stats, threshold).items():
+            seen = agg["n_plus_one"].get(statement, 0)
+            agg["n_plus_one"][statement] = max(seen, count)
+
+
+def _finish_request(response, threshold):
+    endpoint = request.endpoint or request.path
+    if response.is_streamed:
+        # A streamed template renders (and queries) after this hook, while
+        # the body is sent, so the headers would only cover the view. The
+        # figures are recorded once the body is done instead, and the
+        # headers left out.
+        stats = g.get("sql_stats")
+        if stats is not None:
+            response.call_on_close(lambda: _record(endpoint, stats, threshold))
+        return response
+
+    stats = g.pop("sql_stats", None)
+    if stats is None:
+        return response
+
+    repeated = _repeated(stats, threshold)
+    response.headers["X-Query-Count"] = str(stats["queries"])
+    response.headers["X-SQL-Time-ms"] = f"{stats['sql_ms']:.2f}"
+    response.headers["X-Template-Time-ms"] = f"{stats['template_ms']:.2f}"
+    if repeated:
+        response.headers["X-N-Plus-One"] = str(len(repeated))
+
+    _record(endpoint, stats, threshold)
+    return response
+
+
+def init_app(app, n_plus_one_threshold=5):
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    app.before_request(_start_request)
+    app.after_request(lambda response: _finish_request(response, n_plus_one_threshold))
+
+    app.extensions["sql_instrumentation"] = True
+
+
+def enabled(app):
+    return app.extensions.get("sql_instrumentation", False)
+
+
+def last_recorded():
+    # The figures recorded last in this thread, once; None when nothing was
+    # recorded since the previous call. With the test client that is the
+    # request whose response was just closed, streamed or not.
+    return _local.__dict__.pop("last", None)
+
+
+def snapshot():
+    with _lock:
+        result = {}
+        for endpoint, stats in _endpoints.items():
+            n = stats["requests"] or 1
+            result[endpoint] = {
+                "requests": stats["requests"],
+                "avg_queries": round(stats["queries"] / n, 2),
+                "max_queries": stats["max_queries"],
+                "avg_sql_ms": round(stats["sql_ms"] / n, 3),
+                "avg_template_ms": round(stats["template_ms"] / n, 3),
+                "avg_total_ms": round(stats["total_ms"] / n, 3),
+                "slowest": list(stats["slowest"]),
+                "n_plus_one": [
+                    {"statement": s, "max_repeats": c}
+                    for s, c in sorted(stats["n_plus_one"].items(), key=lambda i: -i[1])
+                ],
+            }
+        return result
+
+
+def reset():
+    with _lock:
+        _endpoints.clear()
@@ -0,0 +1,164 @@
+from sqlalchemy import select, update, insert, delete, exists
+from sqlalchemy.exc import OperationalError
+from models import (
+    db, Appointment, Treatment, TreatmentMedicine, WaitlistEntry,
+    AppointmentArchive, TreatmentArchive, TreatmentMedicineArchive
+)
+from datetime import date, timedelta
+import logging
+import threading
+import schedules
+import waitlist
+
+# Keeps the live appointments table down to the working set:
+# - bookings whose date has passed that nobody clicked complete or cancel
+#   for are marked Completed when the doctor wrote a treatment for the
+#   visit, and No-show otherwise;
+# - completed, cancelled and no-show appointments older than ARCHIVE_AFTER_DAYS move,
+#   with their treatment and medicines, into the *_archive tables.
+# History views read both (see queries.history_page). Each batch is its own
+# transaction, so a run can be interrupted at any point.
+# Each pass also publishes recurring schedules for days that entered the
+# schedules.HORIZON_WEEKS horizon since the last pass, and expires waitlist
+# entries for days that have passed.
+
+ARCHIVE_AFTER_DAYS = 90
+BATCH_SIZE = 500
+ARCHIVED_STATUSES = ("Completed", "Cancelled", "No-show")
+
+log = logging.getLogger(__name__)
+
+
+def close_past_bookings(today=None, batch_size=BATCH_SIZE):
+    today = today or date.today()
+    counts = {"completed": 0, "no_shows": 0}
+    treated = exists().where(Treatment.appointment_id == Appointment.id)
+
+    while True:
+        ids = db.session.execute(
+            select(Appointment.id).where(
+                Appointment.status == "Booked",
+                Appointment.date < today
+            ).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return counts
+
+        for status, key, where in (("Completed", "completed", treated), ("No-show", "no_shows", ~treated)):
+            counts[key] += db.session.execute(
+                update(Appointment).where(
+                    Appointment.id.in_(ids),
+                    Appointment.status == "Booked",
+                    where
+                ).values(status=status)
+            ).rowcount
+        db.session.commit()
+
+
+def _copy(source, target, where):
+    columns = [c.name for c in target.__table__.columns]
+    return insert(target).from_select(
+        columns,
+        select(*[source.__table__.c[name] for name in columns]).where(where)
+    )
+
+
+def archive_old(today=None, after_days=ARCHIVE_AFTER_DAYS, batch_size=BATCH_SIZE):
+    cutoff = (today or date.today()) - timedelta(days=after_days)
+    archived = 0
+
+    while True:
+        ids = db.session.execute(
+            select(Appointment.id).where(
+                Appointment.status.in_(ARCHIVED_STATUSES),
+                Appointment.date < cutoff
+            ).order_by(Appointment.date).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return archived
+
+        treatment_ids = db.session.execute(
+            select(Treatment.id).where(Treatment.appointment_id.in_(ids))
+        ).scalars().all()
+
+        # archive rows go in before the live rows are deleted; the analytics
+        # delete trigger skips rows it finds in appointments_archive
+        db.session.execute(_copy(Appointment, AppointmentArchive, Appointment.id.in_(ids)))
+        if treatment_ids:
+            db.session.execute(_copy(Treatment, TreatmentArchive, Treatment.id.in_(treatment_ids)))
+            db.session.execute(_copy(
+                TreatmentMedicine, TreatmentMedicineArchive,
+                TreatmentMedicine.treatment_id.in_(treatment_ids)
+            ))
+            db.session.execute(delete(TreatmentMedicine).where(TreatmentMedicine.treatment_id.in_(treatment_ids)))
+            db.session.execute(delete(Treatment).where(Treatment.id.in_(treatment_ids)))
+        # databases created before the ON DELETE rules need this done by hand
+        db.session.execute(
+            update(WaitlistEntry).where(WaitlistEntry.appointment_id.in_(ids)).values(appointment_id=None)
+        )
+        db.session.execute(delete(Appointment).where(Appointment.id.in_(ids)))
+        db.session.commit()
+        archived += len(ids)
+
+
+def publish_schedules(today=None):
+    written = schedules.materialize(today=today)
+    db.session.commit()
+    return sum(written.values())
+
+
+def expire_waitlist(today=None):
+    expired = waitlist.expire(today)
+    db.session.commit()
+    return expired
+
+
+def run_once(today=None, archive_after_days=ARCHIVE_AFTER_DAYS, batch_size=BATCH_SIZE):
+    return {
+        **close_past_bookings(today, batch_size),
+        "archived": archive_old(today, archive_after_days, batch_size),
+        "published_days": publish_schedules(today),
+        "expired_waitlist": expire_waitlist(today),
+    }
+
+
+class Scheduler(threading.Thread):
+    # In-process alternative to the `flask lifecycle` worker. Every server
+    # process that starts one runs the same idempotent batches.
+
+    def __init__(self, app, interval, archive_after_days=ARCHIVE_AFTER_DAYS):
+        super().__init__(name="appointment-lifecycle", daemon=True)
+        self.app = app
+        self.interval = interval
+        self.archive_after_days = archive_after_days
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    result = run_once(archive_after_days=self.archive_after_days)
+                    if any(result.values()):
+                        log.info(
+                            "lifecycle: %(completed)s completed, %(no_shows)s no-shows, %(archived)s archived, "
+                            "%(published_days)s schedule days published, "
+                            "%(expired_waitlist)s waitlist entries expired", result
+                        )
+                except OperationalError:
+                    # database busy; the next tick picks the work up
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def init_app(app):
+    interval = app.config.get("LIFECYCLE_INTERVAL", 0)
+    if interval <= 0:
+        return None
+    scheduler = Scheduler(app, interval, app.config.get("LIFECYCLE_ARCHIVE_AFTER_DAYS", ARCHIVE_AFTER_DAYS))
+    scheduler.start()
+    app.extensions["lifecycle_scheduler"] = scheduler
+    return scheduler
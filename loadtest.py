@@ -0,0 +1,217 @@
+from sqlalchemy import select
+from models import db, User, Doctor, Patient, Department, Appointment
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from time import perf_counter
+import json
+import random
+import threading
+import instrumentation
+
+# Drives the blueprints through the Flask test client the way the three
+# roles use them. Every step is timed end to end (streamed pages included)
+# and its query count comes from what instrumentation recorded for it once
+# the response was closed, since streamed pages send no X-Query-Count header.
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._steps = {}
+
+    def add(self, step, ms, queries, ok):
+        with self._lock:
+            entry = self._steps.setdefault(step, {"ms": [], "queries": [], "errors": 0})
+            entry["ms"].append(ms)
+            entry["queries"].append(queries)
+            if not ok:
+                entry["errors"] += 1
+
+    def summary(self, seconds):
+        result = {}
+        for step, entry in sorted(self._steps.items()):
+            ms = sorted(entry["ms"])
+            result[step] = {
+                "requests": len(ms),
+                "rps": round(len(ms) / seconds, 1),
+                "p50": round(percentile(ms, 50), 2),
+                "p95": round(percentile(ms, 95), 2),
+                "p99": round(percentile(ms, 99), 2),
+                "avg_queries": round(sum(entry["queries"]) / len(ms), 1),
+                "max_queries": max(entry["queries"]),
+                "errors": entry["errors"],
+            }
+        return result
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class RoleClient:
+    # one logged-in test client; logs in by writing the flask-login session
+    # directly so password hashing does not skew the numbers
+
+    def __init__(self, app, user_id, recorder):
+        self.client = app.test_client()
+        self.recorder = recorder
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+
+    def request(self, step, url, method="GET", **kwargs):
+        instrumentation.last_recorded()
+        started = perf_counter()
+        response = self.client.open(url, method=method, **kwargs)
+        body = response.get_data()
+        ms = (perf_counter() - started) * 1000
+        ok = response.status_code < 400
+        response.close()
+        recorded = instrumentation.last_recorded()
+        if recorded is None:
+            # a missing count must not pass as 0 queries against the baseline
+            raise ValueError(f"{step}: no query count was recorded for {url}")
+        self.recorder.add(step, ms, recorded["queries"], ok)
+        return response, body
+
+
+def sample_context(size=200):
+    def ids(statement):
+        rows = db.session.execute(statement.order_by(db.func.random()).limit(size)).all()
+        return [tuple(row) for row in rows]
+
+    context = {
+        "patients": ids(select(Patient.user_id, Patient.id)),
+        "doctors": ids(select(Doctor.user_id, Doctor.id)),
+        "admins": ids(select(User.id).where(User.role == "admin")),
+        "departments": [row[0] for row in ids(select(Department.id))],
+        "names": [row[0].split()[-1] for row in ids(select(User.name).where(User.role == "doctor"))],
+    }
+    if not context["patients"] or not context["doctors"] or not context["admins"]:
+        raise ValueError("the database needs patients, doctors and an admin; run seed-data first")
+    return context
+
+
+def patient_workflow(app, context, rng, recorder):
+    user_id, patient_id = rng.choice(context["patients"])
+    _, doctor_id = rng.choice(context["doctors"])
+    s = RoleClient(app, user_id, recorder)
+
+    s.request("patient.dashboard", "/patient/dashboard")
+    if context["names"]:
+        s.request("patient.search_doctor", f"/patient/search?q={rng.choice(context['names'])}")
+    s.request("patient.doctor_details", f"/patient/doctor/{doctor_id}")
+    s.request("patient.doctor_availability", f"/patient/doctor/{doctor_id}/availability")
+    _, body = s.request("patient.availability_json", f"/patient/doctor/{doctor_id}/availability.json")
+    department = f"&department_id={rng.choice(context['departments'])}" if context["departments"] else ""
+    s.request("patient.first_available", f"/patient/first-available?limit=5{department}")
+    s.request("patient.history", "/patient/history")
+
+    free = [
+        (day["date"], slot["time_start"])
+        for day in json.loads(body).get("days", [])
+        for slot in day["slots"]
+        if not slot["booked"]
+    ]
+    if free:
+        day, time_start = rng.choice(free)
+        s.request("patient.book", "/patient/book", method="POST", data={
+            "doctor_id": doctor_id, "date": day, "time_start": time_start[:5]
+        })
+        booked = db.session.execute(
+            select(Appointment.id).where(
+                Appointment.patient_id == patient_id,
+                Appointment.doctor_id == doctor_id,
+                Appointment.date == date.fromisoformat(day),
+                Appointment.status == "Booked"
+            )
+        ).scalar()
+        db.session.remove()
+        if booked:
+            s.request("patient.cancel", f"/patient/cancel/{booked}")
+
+
+def doctor_workflow(app, context, rng, recorder):
+    user_id, _ = rng.choice(context["doctors"])
+    _, patient_id = rng.choice(context["patients"])
+    s = RoleClient(app, user_id, recorder)
+
+    s.request("doctor.dashboard", "/doctor/dashboard")
+    s.request("doctor.availability", "/doctor/availability")
+    s.request("doctor.patient_history", f"/doctor/history/{patient_id}")
+
+
+def admin_workflow(app, context, rng, recorder):
+    (user_id,) = rng.choice(context["admins"])
+    _, patient_id = rng.choice(context["patients"])
+    s = RoleClient(app, user_id, recorder)
+
+    s.request("admin.dashboard", "/admin/dashboard")
+    if context["names"]:
+        s.request("admin.search", f"/admin/search?query={rng.choice(context['names'])}")
+    s.request("admin.patient_history", f"/admin/patient/{patient_id}/history")
+    s.request("admin.prescriptions", "/admin/prescriptions?medicine=Paracetamol")
+
+
+WORKFLOWS = {
+    "patient": patient_workflow,
+    "doctor": doctor_workflow,
+    "admin": admin_workflow,
+}
+
+# share of sessions per role
+MIX = {"patient": 0.7, "doctor": 0.2, "admin": 0.1}
+
+
+def run(app, sessions=200, concurrency=4, seed=0):
+    if not instrumentation.enabled(app):
+        instrumentation.init_app(app, app.config.get("SQL_N_PLUS_ONE_THRESHOLD", 5))
+
+    rng = random.Random(seed)
+    with app.app_context():
+        context = sample_context()
+        db.session.remove()
+
+    roles = rng.choices(list(MIX), weights=list(MIX.values()), k=sessions)
+    recorder = Recorder()
+
+    def one(i):
+        with app.app_context():
+            WORKFLOWS[roles[i]](app, context, random.Random(seed + i), recorder)
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(sessions)))
+    seconds = perf_counter() - started
+
+    return recorder.summary(seconds), seconds
+
+
+def compare(results, baseline, tolerance):
+    # A step regresses when its p95 grows past the tolerance (plus 1ms, so
+    # sub-millisecond steps do not flap) or it issues more queries than before.
+    regressions = []
+    for step, base in baseline.items():
+        current = results.get(step)
+        if current is None:
+            continue
+        if current["p95"] > base["p95"] * (1 + tolerance) + 1:
+            regressions.append(f"{step}: p95 {current['p95']}ms vs baseline {base['p95']}ms")
+        if current["max_queries"] > base["max_queries"]:
+            regressions.append(f"{step}: {current['max_queries']} queries vs baseline {base['max_queries']}")
+        if current["errors"] > base.get("errors", 0):
+            regressions.append(f"{step}: {current['errors']} errors")
+    return regressions
+
+
+def load_baseline(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,230 @@
+from sqlalchemy import inspect, select, update, insert, func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateColumn
+from models import db, Doctor, DoctorAvailability, Appointment, Treatment, TreatmentMedicine
+from datetime import date, timedelta
+import analytics
+import availability
+import search_index
+import treatments
+import versions
+import json
+
+
+def add_missing_columns(engine):
+    # Nullable or defaulted columns added to a model after hms.db was
+    # created. SQLite only supports ALTER TABLE ... ADD COLUMN, which is all
+    # these need.
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+                added.append(f"{table.name}.{column.name}")
+
+    return added
+
+
+# columns dropped from the models; a slot takes one booking, so capacity
+# never meant anything
+REMOVED_COLUMNS = {
+    "doctor_availability": ["capacity"],
+    "schedule_template_slots": ["capacity"],
+    "schedule_overrides": ["capacity"],
+}
+
+
+def drop_removed_columns(engine):
+    # They are NOT NULL without a database default, so inserts from the
+    # current models would fail while they exist. Needs SQLite 3.35+.
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    dropped = []
+
+    with engine.begin() as conn:
+        for table, columns in REMOVED_COLUMNS.items():
+            if table not in existing_tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            for column in columns:
+                if column in existing:
+                    conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+                    dropped.append(f"{table}.{column}")
+
+    return dropped
+
+
+def delete_orphans(engine, batch_size=500):
+    # Rows whose parent is gone, e.g. treatments and stats left behind by
+    # older doctor and patient deletes. With foreign keys enforced any later
+    # update of such a row fails, so they go before the other migrations.
+    # Enforcement is off meanwhile so the delete triggers cannot trip over
+    # other orphans; repeated because a removed row can orphan its children.
+    if engine.dialect.name != "sqlite":
+        return 0
+    removed = 0
+
+    with engine.connect() as conn:
+        enforced = conn.exec_driver_sql("PRAGMA foreign_keys").scalar()
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        try:
+            while True:
+                orphans = {}
+                for table, rowid, _, _ in conn.exec_driver_sql("PRAGMA foreign_key_check").all():
+                    if rowid is not None:
+                        orphans.setdefault(table, set()).add(rowid)
+                if not orphans:
+                    return removed
+                for table, rowids in orphans.items():
+                    rowids = sorted(rowids)
+                    for i in range(0, len(rowids), batch_size):
+                        chunk = rowids[i:i + batch_size]
+                        conn.execute(text(f"DELETE FROM {table} WHERE rowid IN ({', '.join(map(str, chunk))})"))
+                    removed += len(rowids)
+                conn.commit()
+        finally:
+            # the pragma is ignored inside a transaction
+            conn.rollback()
+            conn.exec_driver_sql(f"PRAGMA foreign_keys={'ON' if enforced else 'OFF'}")
+
+
+def cancel_duplicate_bookings(engine, columns):
+    # The partial unique indexes on active appointments cannot be built while
+    # an older hms.db still holds double bookings. Keep the earliest booking
+    # of each group and cancel the rest.
+    keep = select(func.min(Appointment.id)).where(
+        Appointment.status == "Booked"
+    ).group_by(*columns)
+
+    with engine.begin() as conn:
+        result = conn.execute(
+            update(Appointment).where(
+                Appointment.status == "Booked",
+                Appointment.id.not_in(keep)
+            ).values(status="Cancelled")
+        )
+
+    return result.rowcount
+
+
+def create_missing_indexes(engine):
+    # db.create_all() skips tables that already exist, so indexes added to
+    # the models after a hms.db file was created have to be added here.
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                if index.unique and table is Appointment.__table__:
+                    cancel_duplicate_bookings(engine, list(index.columns))
+                index.create(bind=engine)
+                created.append(index.name)
+
+    return created
+
+
+def backfill_availability(engine):
+    # Doctor.availability used to hold {"day_1": {"morning": "9:00-10:00", ...}}
+    # keyed relative to today. Expand it into DoctorAvailability rows once and
+    # clear the blob so it is never re-applied.
+    today = date.today()
+    migrated = 0
+
+    with engine.begin() as conn:
+        legacy = conn.execute(
+            select(Doctor.id, Doctor.availability).where(
+                Doctor.availability.is_not(None),
+                Doctor.availability != ""
+            )
+        ).all()
+
+        for doctor_id, raw in legacy:
+            try:
+                saved = json.loads(raw)
+            except ValueError:
+                saved = {}
+
+            rows = []
+            for i in range(1, availability.WINDOW_DAYS + 1):
+                day = saved.get(f"day_{i}") or {}
+                for period in ("morning", "evening"):
+                    slot = availability.parse_range(day.get(period))
+                    if slot:
+                        rows.append({
+                            "doctor_id": doctor_id,
+                            "date": today + timedelta(days=i - 1),
+                            "time_start": slot[0],
+                            "time_end": slot[1],
+                        })
+
+            if rows:
+                conn.execute(
+                    sqlite_insert(DoctorAvailability).values(rows).on_conflict_do_nothing()
+                )
+            conn.execute(
+                update(Doctor).where(Doctor.id == doctor_id).values(availability=None)
+            )
+            migrated += 1
+
+    return migrated
+
+
+def backfill_treatments(engine, batch_size=500):
+    # Treatments written before the structured fields existed have
+    # visit_type NULL; parse their notes once. Parsed rows get "" rather than
+    # NULL so they are not picked up again.
+    migrated = 0
+
+    while True:
+        with engine.begin() as conn:
+            legacy = conn.execute(
+                select(Treatment.id, Treatment.notes).where(
+                    Treatment.visit_type.is_(None)
+                ).limit(batch_size)
+            ).all()
+            if not legacy:
+                return migrated
+
+            medicines = []
+            for treatment_id, notes in legacy:
+                visit_type, tests_done, medicine_text = treatments.parse_legacy_notes(notes)
+                conn.execute(
+                    update(Treatment).where(Treatment.id == treatment_id).values(
+                        visit_type=visit_type,
+                        tests_done=tests_done
+                    )
+                )
+                medicines.extend(
+                    {"treatment_id": treatment_id, "position": i, "name": name[:200]}
+                    for i, name in enumerate(treatments.split_medicines(medicine_text))
+                )
+
+            if medicines:
+                conn.execute(insert(TreatmentMedicine), medicines)
+            migrated += len(legacy)
+
+
+def upgrade(engine):
+    add_missing_columns(engine)
+    drop_removed_columns(engine)
+    delete_orphans(engine)
+    create_missing_indexes(engine)
+    backfill_treatments(engine)
+    backfill_availability(engine)
+    analytics.ensure_rollups(engine)
+    versions.ensure_triggers(engine)
+    search_index.ensure_index(engine)
@@ -13,12 +13,21 @@ class User(UserMixin, db.Model):
     role = db.Column(db.String(20), nullable=False)
 
     def set_password(self, password, hasher=None):
-        from werkzeug.security import generate_password_hash
-        self.password_hash = generate_password_hash(password)
+        import passwords
+        self.password_hash = (hasher or passwords.hash_password)(password)
 
     def check_password(self, password):
-        from werkzeug.security import check_password_hash
-        return check_password_hash(self.password_hash, password)
+        import passwords
+        return passwords.verify(self.password_hash, password)
+
+    # same interface as principal_cache.Principal
+    @property
+    def patient_id(self):
+        return self.patient_profile.id if self.patient_profile else None
+
+    @property
+    def doctor_id(self):
+        return self.doctor_profile.id if self.doctor_profile else None
 
     def __repr__(self):
         return f"<User {self.id} {self.email} role={self.role}>"
@@ -35,27 +44,107 @@ class Department(db.Model):
 class Doctor(db.Model):
     __tablename__ = "doctors"
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, nullable=False)
-    department_id = db.Column(db.Integer, db.ForeignKey('departments.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), unique=True, nullable=False)
+    department_id = db.Column(db.Integer, db.ForeignKey('departments.id', ondelete='SET NULL'), nullable=True, index=True)
     specialization = db.Column(db.String(200))
+    # legacy day_1..day_7 JSON blob, migrated into DoctorAvailability rows
     availability = db.Column(db.Text)
+    # bumped by the triggers in versions.py
+    version = db.Column(db.Integer, nullable=False, server_default="0")
+    updated_at = db.Column(db.DateTime)
 
-    user = db.relationship('User', backref=db.backref('doctor_profile', uselist=False))
+    user = db.relationship('User', backref=db.backref(
+        'doctor_profile', uselist=False, cascade='all, delete-orphan', passive_deletes=True
+    ))
     department = db.relationship('Department', backref='doctors')
 
     def __repr__(self):
         return f"<Doctor {self.id} user={self.user_id}>"
 
 
+class DoctorAvailability(db.Model):
+    __tablename__ = "doctor_availability"
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id', ondelete='CASCADE'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time_start = db.Column(db.Time, nullable=False)
+    time_end = db.Column(db.Time, nullable=False)
+
+    doctor = db.relationship('Doctor', backref=db.backref(
+        'slots', cascade='all, delete-orphan', passive_deletes=True
+    ))
+
+    __table_args__ = (
+        db.Index("ix_doctor_availability_doctor_date_time", "doctor_id", "date", "time_start", unique=True),
+    )
+
+    def __repr__(self):
+        return f"<DoctorAvailability {self.id} doctor={self.doctor_id} date={self.date} {self.time_start}-{self.time_end}>"
+
+
+class DoctorSchedule(db.Model):
+    # a doctor's recurring schedule; schedules.py expands it into
+    # DoctorAvailability rows
+    __tablename__ = "doctor_schedules"
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id', ondelete='CASCADE'), primary_key=True)
+    # week 0 of the cycle starts on anchor (a Monday)
+    cycle_weeks = db.Column(db.Integer, nullable=False, default=1)
+    anchor = db.Column(db.Date, nullable=False)
+    revision = db.Column(db.Integer, nullable=False, default=0)
+    materialized_revision = db.Column(db.Integer)
+    materialized_through = db.Column(db.Date)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DoctorSchedule doctor={self.doctor_id} weeks={self.cycle_weeks} rev={self.revision}>"
+
+
+class ScheduleTemplateSlot(db.Model):
+    __tablename__ = "schedule_template_slots"
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id', ondelete='CASCADE'), nullable=False)
+    week = db.Column(db.Integer, nullable=False, default=0)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = Monday
+    time_start = db.Column(db.Time, nullable=False)
+    time_end = db.Column(db.Time, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_schedule_template_slots_doctor_day", "doctor_id", "week", "weekday", "time_start", unique=True),
+    )
+
+    def __repr__(self):
+        return f"<ScheduleTemplateSlot doctor={self.doctor_id} week={self.week} day={self.weekday} {self.time_start}-{self.time_end}>"
+
+
+class ScheduleOverride(db.Model):
+    # a date with override rows uses them instead of the template; a row
+    # without times closes the day
+    __tablename__ = "schedule_overrides"
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id', ondelete='CASCADE'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time_start = db.Column(db.Time)
+    time_end = db.Column(db.Time)
+
+    __table_args__ = (
+        db.Index("ix_schedule_overrides_doctor_date", "doctor_id", "date"),
+    )
+
+    def __repr__(self):
+        return f"<ScheduleOverride doctor={self.doctor_id} date={self.date} {self.time_start}-{self.time_end}>"
+
+
 class Patient(db.Model):
     __tablename__ = "patients"
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), unique=True, nullable=False)
     dob = db.Column(db.Date, nullable=True)
     contact = db.Column(db.String(100))
     address = db.Column(db.String(255))
 
-    user = db.relationship('User', backref=db.backref('patient_profile', uselist=False))
+    user = db.relationship('User', backref=db.backref(
+        'patient_profile', uselist=False, cascade='all, delete-orphan', passive_deletes=True
+    ))
 
     def __repr__(self):
         return f"<Patient {self.id} user={self.user_id}>"
@@ -65,30 +154,172 @@ class Patient(db.Model):
 class Appointment(db.Model):
     __tablename__ = "appointments"
     id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id'), nullable=False)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id', ondelete='CASCADE'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id', ondelete='CASCADE'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     time_start = db.Column(db.Time, nullable=False)
     time_end = db.Column(db.Time, nullable=False)
     status = db.Column(db.String(30), default="Booked")
 
-    patient = db.relationship('Patient', backref='appointments')
-    doctor = db.relationship('Doctor', backref='appointments')
+    patient = db.relationship('Patient', backref=db.backref(
+        'appointments', cascade='all, delete-orphan', passive_deletes=True
+    ))
+    doctor = db.relationship('Doctor', backref=db.backref(
+        'appointments', cascade='all, delete-orphan', passive_deletes=True
+    ))
+
+    __table_args__ = (
+        # booking conflict checks, doctor dashboard and availability grid
+        db.Index("ix_appointments_doctor_date_time", "doctor_id", "date", "time_start"),
+        # patient dashboard, patient/doctor/admin history views
+        db.Index("ix_appointments_patient_date", "patient_id", "date"),
+        # admin dashboard "upcoming" listing
+        db.Index("ix_appointments_status_date_time", "status", "date", "time_start"),
+        # one active booking per slot, and per patient per doctor per day
+        db.Index("uq_appointments_active_slot", "doctor_id", "date", "time_start",
+                 unique=True, sqlite_where=db.text("status = 'Booked'")),
+        db.Index("uq_appointments_active_patient_day", "doctor_id", "patient_id", "date",
+                 unique=True, sqlite_where=db.text("status = 'Booked'")),
+    )
 
     def __repr__(self):
         return f"<Appointment {self.id} doctor={self.doctor_id} patient={self.patient_id} date={self.date}>"
 
 
+class WaitlistEntry(db.Model):
+    # a patient waiting for any slot with a doctor on a date; waitlist.py
+    # assigns freed slots by priority (higher first), then by age
+    __tablename__ = "waitlist_entries"
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id', ondelete='CASCADE'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id', ondelete='CASCADE'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default="Waiting")  # Waiting/Assigned/Left/Expired
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.id', ondelete='SET NULL'))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # the queue for one doctor and day
+        db.Index("ix_waitlist_queue", "doctor_id", "date", "priority", "created_at",
+                 sqlite_where=db.text("status = 'Waiting'")),
+        db.Index("ix_waitlist_patient", "patient_id", "status"),
+        db.Index("uq_waitlist_waiting_patient_day", "doctor_id", "patient_id", "date",
+                 unique=True, sqlite_where=db.text("status = 'Waiting'")),
+    )
+
+    def __repr__(self):
+        return f"<WaitlistEntry {self.id} doctor={self.doctor_id} patient={self.patient_id} date={self.date} {self.status}>"
+
+
 class Treatment(db.Model):
     __tablename__ = "treatments"
     id = db.Column(db.Integer, primary_key=True)
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.id'), unique=True, nullable=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments.id', ondelete='CASCADE'), unique=True, nullable=False)
     diagnosis = db.Column(db.Text)
     prescription = db.Column(db.Text)
+    # legacy "Visit Type: ..., Tests: ..., Medicines: ..." text, backfilled
+    # into the structured fields below
     notes =  db.Column(db.Text)
+    visit_type = db.Column(db.String(100))
+    tests_done = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    appointment = db.relationship('Appointment', backref=db.backref('treatment', uselist=False))
+    appointment = db.relationship('Appointment', backref=db.backref(
+        'treatment', uselist=False, cascade='all, delete-orphan', passive_deletes=True
+    ))
+
+    @property
+    def medicine_names(self):
+        return ", ".join(m.name for m in self.medicines)
+
+    @property
+    def summary(self):
+        return f"Visit Type: {self.visit_type or ''}, Tests: {self.tests_done or ''}, Medicines: {self.medicine_names}"
+
+    def __repr__(self):
+        return f"<Treatment {self.id} appointment={self.appointment_id}>"
+
+
+class TreatmentMedicine(db.Model):
+    __tablename__ = "treatment_medicines"
+    id = db.Column(db.Integer, primary_key=True)
+    treatment_id = db.Column(db.Integer, db.ForeignKey('treatments.id', ondelete='CASCADE'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    name = db.Column(db.String(200, collation="NOCASE"), nullable=False, index=True)
+
+    treatment = db.relationship('Treatment', backref=db.backref(
+        'medicines',
+        order_by='TreatmentMedicine.position',
+        cascade='all, delete-orphan',
+        passive_deletes=True
+    ))
+
+    def __repr__(self):
+        return f"<TreatmentMedicine {self.name} treatment={self.treatment_id}>"
+
+class AppointmentArchive(db.Model):
+    # completed, cancelled and no-show appointments moved out of the live table by
+    # lifecycle.py; ids are kept from the live row
+    __tablename__ = "appointments_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patients.id', ondelete='CASCADE'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id', ondelete='CASCADE'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time_start = db.Column(db.Time, nullable=False)
+    time_end = db.Column(db.Time, nullable=False)
+    status = db.Column(db.String(30))
+
+    __table_args__ = (
+        db.Index("ix_appointments_archive_patient_date", "patient_id", "date"),
+        db.Index("ix_appointments_archive_doctor_date", "doctor_id", "date"),
+    )
+
+    def __repr__(self):
+        return f"<AppointmentArchive {self.id} doctor={self.doctor_id} patient={self.patient_id} date={self.date}>"
+
+
+class TreatmentArchive(db.Model):
+    __tablename__ = "treatments_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointments_archive.id', ondelete='CASCADE'), unique=True, nullable=False)
+    diagnosis = db.Column(db.Text)
+    prescription = db.Column(db.Text)
+    notes = db.Column(db.Text)
+    visit_type = db.Column(db.String(100))
+    tests_done = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<TreatmentArchive {self.id} appointment={self.appointment_id}>"
+
+
+class TreatmentMedicineArchive(db.Model):
+    __tablename__ = "treatment_medicines_archive"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    treatment_id = db.Column(db.Integer, db.ForeignKey('treatments_archive.id', ondelete='CASCADE'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    name = db.Column(db.String(200, collation="NOCASE"), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<TreatmentMedicineArchive {self.name} treatment={self.treatment_id}>"
+
+
+class DoctorDailyStats(db.Model):
+    # rollup kept current by the triggers in analytics.py
+    __tablename__ = "doctor_daily_stats"
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctors.id', ondelete='CASCADE'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    booked = db.Column(db.Integer, nullable=False, server_default="0")
+    completed = db.Column(db.Integer, nullable=False, server_default="0")
+    cancelled = db.Column(db.Integer, nullable=False, server_default="0")
+    no_show = db.Column(db.Integer, nullable=False, server_default="0")
+    published_slots = db.Column(db.Integer, nullable=False, server_default="0")
+
+    __table_args__ = (
+        db.Index("ix_doctor_daily_stats_date", "date"),
+    )
 
     def __repr__(self):
-        return f"<Treatment {self.id} appointment={self.appointment_id}>"
\ No newline at end of file
+        return f"<DoctorDailyStats doctor={self.doctor_id} date={self.date}>"
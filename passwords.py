@@ -0,0 +1,102 @@
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+import os
+import threading
+
+DEFAULT_METHOD = "scrypt:32768:8:1"
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class _HashPool:
+    # Password hashing is CPU-bound and takes tens of milliseconds, so it runs
+    # in worker processes. At most max_pending hashes are in flight; a request
+    # that cannot get a slot within timeout seconds gets PoolSaturated instead
+    # of tying up its worker behind the queue.
+
+    def __init__(self, workers, max_pending, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # a forked server worker must not reuse its parent's pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolSaturated()
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def map(self, fn, *iterables, chunksize=1):
+        # for batch jobs: bypasses the request backpressure and uses every
+        # worker process
+        if self.workers <= 0:
+            return list(map(fn, *iterables))
+        return list(self._get_executor().map(fn, *iterables, chunksize=chunksize))
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _prefix(method):
+    # werkzeug fills in defaults ("scrypt" -> "scrypt:32768:8:1"), so the
+    # prefix stored hashes get is only known by hashing something
+    return generate_password_hash("x", method).split("$", 1)[0]
+
+
+_method = DEFAULT_METHOD
+_method_prefix = DEFAULT_METHOD
+_pool = _HashPool(workers=0, max_pending=8, timeout=5)
+
+
+def configure(method=DEFAULT_METHOD, workers=0, max_pending=8, timeout=5):
+    global _method, _method_prefix, _pool
+    _pool.shutdown()
+    _method = method
+    _method_prefix = _prefix(method)
+    _pool = _HashPool(workers, max_pending, timeout)
+
+
+def init_app(app):
+    configure(
+        method=app.config.get("PASSWORD_HASH_METHOD", DEFAULT_METHOD),
+        workers=app.config.get("PASSWORD_POOL_WORKERS", 0),
+        max_pending=app.config.get("PASSWORD_POOL_MAX_PENDING", 8),
+        timeout=app.config.get("PASSWORD_POOL_TIMEOUT", 5),
+    )
+
+
+def hash_password(password):
+    return _pool.run(generate_password_hash, password, _method)
+
+
+def hash_many(values, chunksize=16):
+    values = list(values)
+    return _pool.map(generate_password_hash, values, [_method] * len(values), chunksize=chunksize)
+
+
+def verify(password_hash, password):
+    return _pool.run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    # werkzeug hashes look like "scrypt:32768:8:1$salt$hash"
+    return password_hash.split("$", 1)[0] != _method_prefix
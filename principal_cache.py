@@ -0,0 +1,146 @@
+from abc import ABC, abstractmethod
+from flask import g
+from flask_login import UserMixin
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from collections import OrderedDict
+from time import monotonic
+from models import db, User, Doctor, Patient
+import threading
+
+
+class PrincipalCacheBackend(ABC):
+    # Stores plain dicts keyed by user id so a shared backend (memcached,
+    # redis, ...) can serialize them. Subclass and pass to init_app().
+
+    @abstractmethod
+    def get(self, user_id):
+        pass
+
+    @abstractmethod
+    def set(self, user_id, principal):
+        pass
+
+    @abstractmethod
+    def delete(self, user_id):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+
+class LRUPrincipalCache(PrincipalCacheBackend):
+    # Per process: invalidate() only reaches the process it runs in, so with
+    # several server processes a deleted, locked or changed account keeps
+    # its session elsewhere for up to ttl seconds. Keep the ttl short there,
+    # or use a shared backend.
+
+    def __init__(self, maxsize=4096, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, principal = entry
+            if expires < monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return principal
+
+    def set(self, user_id, principal):
+        with self._lock:
+            self._entries[user_id] = (monotonic() + self.ttl, principal)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class Principal(UserMixin):
+    # What flask-login keeps as current_user. Role-profile ids are available
+    # without a query; the ORM profiles load on first use and are kept for
+    # the rest of the request only.
+
+    def __init__(self, id, name, email, role, patient_id=None, doctor_id=None):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.role = role
+        self.patient_id = patient_id
+        self.doctor_id = doctor_id
+
+    def _profile(self, model, profile_id):
+        if profile_id is None:
+            return None
+        key = f"_principal_{model.__tablename__}"
+        profile = g.get(key)
+        if profile is None:
+            profile = model.query.options(joinedload(model.user)).get(profile_id)
+            setattr(g, key, profile)
+        return profile
+
+    @property
+    def patient_profile(self):
+        return self._profile(Patient, self.patient_id)
+
+    @property
+    def doctor_profile(self):
+        return self._profile(Doctor, self.doctor_id)
+
+    def __repr__(self):
+        return f"<Principal {self.id} {self.email} role={self.role}>"
+
+
+_backend = LRUPrincipalCache()
+
+
+def init_app(app, backend=None):
+    global _backend
+    _backend = backend or LRUPrincipalCache(
+        maxsize=app.config.get("PRINCIPAL_CACHE_SIZE", 4096),
+        ttl=app.config.get("PRINCIPAL_CACHE_TTL", 60),
+    )
+
+
+def load(user_id):
+    cached = _backend.get(user_id)
+    if cached is None:
+        # user and both role-profile ids in a single query
+        row = db.session.execute(
+            select(User.id, User.name, User.email, User.role, Patient.id, Doctor.id)
+            .outerjoin(Patient, Patient.user_id == User.id)
+            .outerjoin(Doctor, Doctor.user_id == User.id)
+            .where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        cached = {
+            "id": row[0],
+            "name": row[1],
+            "email": row[2],
+            "role": row[3],
+            "patient_id": row[4],
+            "doctor_id": row[5],
+        }
+        _backend.set(user_id, cached)
+
+    return Principal(**cached)
+
+
+def invalidate(user_id):
+    # this process only, unless the backend is shared (see LRUPrincipalCache)
+    _backend.delete(user_id)
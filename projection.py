@@ -0,0 +1,104 @@
+from sqlalchemy import select, tuple_
+from models import db
+from datetime import date, time, datetime
+import queries
+
+# Column-level reads for the JSON API. A Resource maps public field names to
+# SQL columns and knows which joins each field needs, so a request for
+# ?fields=id,date selects two columns from one table and never builds ORM
+# objects. Rows are turned into dicts by position.
+
+
+class UnknownField(ValueError):
+    pass
+
+
+def _plain(value):
+    return value
+
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+
+def _hhmm(value):
+    return value.strftime("%H:%M") if value is not None else None
+
+
+def _converter(column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return _plain
+    if python_type is time:
+        return _hhmm
+    if python_type in (date, datetime):
+        return _iso
+    return _plain
+
+
+class Resource:
+    def __init__(self, base, fields, joins=None, default=None):
+        # fields: {name: column or (column, [join names])}
+        # joins: {name: (target, onclause, outer)}, in the order they apply
+        self.base = base
+        self.fields = {}
+        for name, spec in fields.items():
+            column, needs = spec if isinstance(spec, tuple) else (spec, [])
+            self.fields[name] = (column, needs)
+        self.joins = joins or {}
+        self.default = default or list(self.fields)
+
+    def parse(self, value):
+        if not value:
+            return list(self.default)
+        names = []
+        for name in value.split(","):
+            name = name.strip()
+            if not name or name in names:
+                continue
+            if name not in self.fields:
+                raise UnknownField(name)
+            names.append(name)
+        return names or list(self.default)
+
+    def select(self, names, require=()):
+        # require names joins a filter needs even if no chosen field does
+        needed = set(require)
+        for name in names:
+            needed.update(self.fields[name][1])
+
+        statement = select(*[self.fields[name][0].label(name) for name in names]).select_from(self.base)
+        for join_name, (target, onclause, outer) in self.joins.items():
+            if join_name in needed:
+                statement = statement.join(target, onclause, isouter=outer)
+        return statement
+
+    def serializer(self, names):
+        # converters are worked out once per request, not per row
+        converters = [_converter(self.fields[name][0]) for name in names]
+
+        def serialize(row):
+            return {name: convert(value) for name, convert, value in zip(names, converters, row)}
+        return serialize
+
+
+def page(statement, columns, serialize, cursor=None, page_size=queries.DEFAULT_PAGE_SIZE):
+    # Keyset page over a column select. The keyset columns are added under
+    # private labels, so they need not be among the requested fields.
+    keys = [column.label(f"_key{i}") for i, column in enumerate(columns)]
+
+    after = queries.decode_cursor(cursor, keys)
+    if after is not None:
+        statement = statement.where(tuple_(*columns) > tuple_(*after))
+
+    rows = db.session.execute(
+        statement.add_columns(*keys).order_by(*columns).limit(page_size + 1)
+    ).all()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = queries.encode_cursor(rows[-1], keys)
+
+    return {"data": [serialize(row) for row in rows], "next": next_cursor}
@@ -0,0 +1,302 @@
+from sqlalchemy import func, tuple_, select, literal, union_all
+from sqlalchemy.orm import joinedload
+from models import (
+    db, User, Doctor, Patient, Department, Appointment, Treatment, TreatmentMedicine,
+    AppointmentArchive, TreatmentArchive, TreatmentMedicineArchive
+)
+from datetime import date, time, datetime
+import base64
+import search_index
+import json
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 200
+
+
+class Page:
+    def __init__(self, items, total, next_cursor):
+        self.items = items
+        self.total = total
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def page_size_arg(args, name="per_page", default=DEFAULT_PAGE_SIZE):
+    try:
+        size = int(args.get(name, default))
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def _encode_value(value):
+    if isinstance(value, (date, time, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _decode_value(column, value):
+    python_type = column.type.python_type
+    if python_type in (date, time, datetime):
+        return python_type.fromisoformat(value)
+    return python_type(value)
+
+
+def encode_cursor(row, columns):
+    values = [_encode_value(getattr(row, c.key)) for c in columns]
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, columns):
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if len(values) != len(columns):
+            return None
+        return [_decode_value(c, v) for c, v in zip(columns, values)]
+    except (ValueError, TypeError):
+        return None
+
+
+def count(query, column):
+    # COUNT(*) over the filtered query without loading any rows
+    return query.order_by(None).with_entities(func.count(column)).scalar()
+
+
+def keyset_page(query, columns, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    total = count(query, columns[-1])
+
+    after = decode_cursor(cursor, columns)
+    if after is not None:
+        if len(columns) == 1:
+            query = query.filter(columns[0] > after[0])
+        else:
+            query = query.filter(tuple_(*columns) > tuple_(*after))
+
+    rows = query.order_by(*columns).limit(page_size + 1).all()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1], columns)
+
+    return Page(rows, total, next_cursor)
+
+
+def dashboard_doctors(cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    query = Doctor.query.options(
+        joinedload(Doctor.user),
+        joinedload(Doctor.department),
+    )
+    return keyset_page(query, [Doctor.id], cursor, page_size)
+
+
+def dashboard_patients(cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    query = Patient.query.options(joinedload(Patient.user))
+    return keyset_page(query, [Patient.id], cursor, page_size)
+
+
+# booked appointments from today on: the dashboards and the API add whose
+# they are; query_plans.py checks the same statements
+UPCOMING_KEYSET = [Appointment.date, Appointment.time_start, Appointment.id]
+
+
+def upcoming_where(*where):
+    return (Appointment.date >= date.today(), Appointment.status == "Booked") + where
+
+
+def upcoming_statement(*where):
+    return select(Appointment).where(*upcoming_where(*where)).order_by(
+        Appointment.date, Appointment.time_start
+    )
+
+
+def dashboard_upcoming_query():
+    return Appointment.query.filter(*upcoming_where()).options(
+        joinedload(Appointment.patient).joinedload(Patient.user),
+        joinedload(Appointment.doctor).joinedload(Doctor.user),
+        joinedload(Appointment.doctor).joinedload(Doctor.department),
+    )
+
+
+def dashboard_upcoming(cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    return keyset_page(dashboard_upcoming_query(), UPCOMING_KEYSET, cursor, page_size)
+
+
+def search_doctors(query_text):
+    return Doctor.query.join(User).filter(
+        User.name.contains(query_text)
+    ).options(
+        joinedload(Doctor.user),
+        joinedload(Doctor.department),
+    ).all()
+
+
+def search_patients(query_text):
+    return Patient.query.join(User).filter(
+        User.name.contains(query_text)
+    ).options(joinedload(Patient.user)).all()
+
+
+
+def directory_ids(query_text="", limit=None):
+    # Patient-facing doctor directory: full-text ranked when there is a query,
+    # otherwise every doctor in id order.
+    if not query_text.strip():
+        query = db.session.query(Doctor.id).order_by(Doctor.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return [row[0] for row in query]
+
+    return search_index.search(query_text, search_index.DEFAULT_LIMIT if limit is None else limit)
+
+
+def doctors_by_ids(ids):
+    # Doctors with user and department loaded, in the order of ids
+    if not ids:
+        return []
+
+    by_id = {
+        d.id: d for d in Doctor.query.options(
+            joinedload(Doctor.user),
+            joinedload(Doctor.department),
+        ).filter(Doctor.id.in_(ids)).all()
+    }
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def directory_doctors(query_text="", limit=None):
+    return doctors_by_ids(directory_ids(query_text, limit))
+
+
+def _history_branch(appointment, treatment, archived, patient_id, doctor_id,
+                    start, end, status, treated_only):
+    join = select(
+        appointment.id, appointment.date, appointment.time_start, appointment.time_end,
+        appointment.status, appointment.doctor_id,
+        treatment.id.label("treatment_id"), treatment.visit_type, treatment.tests_done,
+        treatment.diagnosis, treatment.prescription,
+        literal(archived).label("archived"),
+    ).select_from(appointment)
+    on = treatment.appointment_id == appointment.id
+    query = join.join(treatment, on) if treated_only else join.outerjoin(treatment, on)
+
+    query = query.where(appointment.patient_id == patient_id)
+    if doctor_id is not None:
+        query = query.where(appointment.doctor_id == doctor_id)
+    if start is not None:
+        query = query.where(appointment.date >= start)
+    if end is not None:
+        query = query.where(appointment.date <= end)
+    if status is not None:
+        query = query.where(appointment.status == status)
+    return query
+
+
+def _history_medicines(rows):
+    # {(archived, treatment_id): "name, name"}, at most one query per table
+    names = {}
+    for archived, model in ((False, TreatmentMedicine), (True, TreatmentMedicineArchive)):
+        ids = [r.treatment_id for r in rows if r.archived == archived and r.treatment_id is not None]
+        if not ids:
+            continue
+        medicines = db.session.execute(
+            select(model.treatment_id, model.name)
+            .where(model.treatment_id.in_(ids))
+            .order_by(model.treatment_id, model.position)
+        )
+        for treatment_id, name in medicines:
+            names.setdefault((archived, treatment_id), []).append(name)
+    return {k: ", ".join(v) for k, v in names.items()}
+
+
+def history_statement(patient_id, doctor_id=None, start=None, end=None, status=None,
+                      treated_only=True):
+    # A patient's appointments, newest first, read across the live tables and
+    # the archive lifecycle.py moves old visits into. Appointment ids are kept
+    # when archiving, so (date, time_start, id) stays a unique keyset.
+    branches = [
+        _history_branch(Appointment, Treatment, False, patient_id, doctor_id,
+                        start, end, status, treated_only),
+        _history_branch(AppointmentArchive, TreatmentArchive, True, patient_id, doctor_id,
+                        start, end, status, treated_only),
+    ]
+    history = union_all(*branches).subquery("history")
+    columns = [history.c.date, history.c.time_start, history.c.id]
+
+    query = select(history, User.name.label("doctor"), Department.name.label("department")).join(
+        Doctor, Doctor.id == history.c.doctor_id
+    ).join(
+        User, User.id == Doctor.user_id
+    ).outerjoin(
+        Department, Department.id == Doctor.department_id
+    ).order_by(*(column.desc() for column in columns))
+    return query, columns
+
+
+def history_page(patient_id, doctor_id=None, start=None, end=None, status=None,
+                 treated_only=True, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    # A page costs the count, one SELECT and up to two medicine lookups.
+    query, columns = history_statement(patient_id, doctor_id, start, end, status, treated_only)
+
+    total = db.session.execute(
+        select(func.count()).select_from(query.order_by(None).subquery())
+    ).scalar()
+
+    after = decode_cursor(cursor, columns)
+    if after is not None:
+        # newest first, so the next page is older
+        query = query.where(tuple_(*columns) < tuple_(*after))
+
+    rows = db.session.execute(query.limit(page_size + 1)).all()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1], columns)
+
+    medicines = _history_medicines(rows)
+    items = []
+    for r in rows:
+        names = medicines.get((r.archived, r.treatment_id), "")
+        items.append({
+            "visit_type": r.visit_type,
+            "test_done": r.tests_done,
+            "diagnosis": r.diagnosis,
+            "prescription": r.prescription,
+            "medicines": names,
+            "summary": f"Visit Type: {r.visit_type or ''}, Tests: {r.tests_done or ''}, Medicines: {names}"
+            if r.treatment_id is not None else None,
+            "doctor": r.doctor,
+            "department": r.department,
+            "date": r.date,
+            "time_start": r.time_start,
+            "time_end": r.time_end,
+            "status": r.status,
+            "appointment_id": r.id,
+            "archived": bool(r.archived),
+        })
+
+    return Page(items, total, next_cursor)
+
+
+def date_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        return None
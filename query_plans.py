@@ -0,0 +1,120 @@
+from sqlalchemy import create_engine, insert, text
+from models import db, User, Doctor, Patient, Department, Appointment, DoctorAvailability
+from datetime import date, time, timedelta
+import availability
+import booking
+import migrations
+import queries
+import waitlist
+
+# Tables whose hot-path queries must never fall back to a full table scan.
+WATCHED_TABLES = ("appointments", "doctor_availability", "appointments_archive", "waitlist_entries")
+
+
+def hot_path_statements():
+    # One entry per Appointment or waitlist query issued by the blueprints,
+    # from the same builders the views call.
+    today = date.today()
+    doctor_id, patient_id = 1, 1
+    slot_date, slot_time = today, time(9, 0)
+
+    return {
+        "patient.book_appointment": booking.booking_statement(
+            patient_id, doctor_id, slot_date, slot_time
+        ),
+        "patient.book_appointment:own_day": booking.own_day_statement(patient_id, doctor_id, slot_date),
+        "patient.dashboard:upcoming": queries.upcoming_statement(Appointment.patient_id == patient_id),
+        "patient.doctor_availability:grid": availability.grid_statement(
+            doctor_id, today, today + timedelta(days=6), patient_id
+        ),
+        "patient.doctor_availability:booked": availability.booked_by_patient_statement(
+            patient_id, doctor_id, today, today + timedelta(days=6)
+        ),
+        "patient.first_available": availability.first_available_statement(
+            today, today + timedelta(days=30)
+        ),
+        "patient.first_available:department": availability.first_available_statement(
+            today, today + timedelta(days=30), department_id=1
+        ),
+        "patient.appointment_history": queries.history_statement(
+            patient_id, status="Completed", treated_only=False
+        )[0],
+        "doctor.doctor_dashboard": queries.upcoming_statement(Appointment.doctor_id == doctor_id),
+        "doctor.patient_history": queries.history_statement(patient_id, doctor_id=doctor_id)[0],
+        "admin.dashboard:upcoming": queries.dashboard_upcoming_query().order_by(
+            *queries.UPCOMING_KEYSET
+        ).limit(queries.DEFAULT_PAGE_SIZE + 1).statement,
+        "admin.patient_history": queries.history_statement(patient_id)[0],
+        # every cancel route releases through waitlist.release, which backfills
+        # the slot with the booking statement above
+        "waitlist.backfill:next_entry": waitlist.next_entry_statement(doctor_id, slot_date),
+    }
+
+
+def seed(conn, doctors=20, patients=200, days=60):
+    conn.execute(insert(Department), [{"id": 1, "name": "General"}])
+    conn.execute(insert(User), [
+        {"id": i, "name": f"user {i}", "email": f"user{i}@example.com",
+         "password_hash": "x", "role": "doctor" if i <= doctors else "patient"}
+        for i in range(1, doctors + patients + 1)
+    ])
+    conn.execute(insert(Doctor), [
+        {"id": i, "user_id": i, "department_id": 1} for i in range(1, doctors + 1)
+    ])
+    conn.execute(insert(Patient), [
+        {"id": i, "user_id": doctors + i} for i in range(1, patients + 1)
+    ])
+
+    start = date.today() - timedelta(days=days)
+    rows = []
+    for day in range(days * 2):
+        for doctor_id in range(1, doctors + 1):
+            for hour in (9, 17):
+                rows.append({
+                    "doctor_id": doctor_id,
+                    "patient_id": (day * doctors + doctor_id + hour) % patients + 1,
+                    "date": start + timedelta(days=day),
+                    "time_start": time(hour, 0),
+                    "time_end": time(hour + 1, 0),
+                    "status": ("Booked", "Completed", "Cancelled")[(day + doctor_id) % 3],
+                })
+    conn.execute(insert(Appointment), rows)
+    conn.execute(insert(DoctorAvailability), [
+        {key: row[key] for key in ("doctor_id", "date", "time_start", "time_end")}
+        for row in rows
+    ])
+    conn.execute(text("ANALYZE"))
+
+
+def explain(conn, statement):
+    compiled = statement.compile(
+        dialect=conn.dialect,
+        compile_kwargs={"literal_binds": True}
+    )
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).fetchall()
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan):
+    return [
+        step for step in plan
+        if step.startswith("SCAN ")
+        and step.split()[1] in WATCHED_TABLES
+    ]
+
+
+def check(engine=None):
+    if engine is None:
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+        migrations.upgrade(engine)
+        with engine.begin() as conn:
+            seed(conn)
+
+    results = {}
+    with engine.connect() as conn:
+        for name, statement in hot_path_statements().items():
+            plan = explain(conn, statement)
+            results[name] = (plan, full_scans(plan))
+
+    return results
@@ -0,0 +1,263 @@
+from sqlalchemy import select, delete, insert
+from models import db, Doctor, DoctorSchedule, ScheduleTemplateSlot, ScheduleOverride
+from datetime import date, datetime, timedelta
+import availability
+
+# Recurring weekly schedules. A doctor's template lists slots per weekday for
+# each week of a 1..MAX_CYCLE_WEEKS cycle; overrides replace the template on
+# single dates. materialize() expands both into DoctorAvailability rows for
+# the next HORIZON_WEEKS, which is what booking and the patient pages read.
+#
+# Materializing is incremental: days whose published slots already match are
+# left alone, and when nothing changed since the last run (same revision) only
+# the days that entered the horizon since then are looked at.
+
+HORIZON_WEEKS = 4
+MAX_CYCLE_WEEKS = 4
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def week_start(day):
+    return day - timedelta(days=day.weekday())
+
+
+def cycle_week(schedule, day):
+    return ((day - schedule.anchor).days // 7) % schedule.cycle_weeks
+
+
+def parse_slots(values):
+    # ["9:00-12:00", ...] -> [(time_start, time_end), ...]; ValueError on bad input
+    slots = []
+    for value in values or []:
+        slot = availability.parse_range(value)
+        if slot is None or slot[0] >= slot[1]:
+            raise ValueError(f"Bad time range: {value!r}")
+        slots.append(slot)
+    return slots
+
+
+def parse_weeks(weeks):
+    # [{"mon": ["9:00-12:00"], ...}, ...] -> [{0: [(start, end)], ...}, ...]
+    if not isinstance(weeks, list) or not 1 <= len(weeks) <= MAX_CYCLE_WEEKS:
+        raise ValueError(f"weeks must list 1 to {MAX_CYCLE_WEEKS} weeks")
+    parsed = []
+    for week in weeks:
+        if not isinstance(week, dict) or set(week) - set(WEEKDAYS):
+            raise ValueError(f"each week maps {', '.join(WEEKDAYS)} to time ranges")
+        parsed.append({WEEKDAYS.index(day): parse_slots(values) for day, values in week.items()})
+    return parsed
+
+
+def parse_overrides(overrides):
+    # {"2025-12-25": [], "2025-12-26": ["10:00-12:00"]}; [] closes the day
+    parsed = {}
+    for value, slots in (overrides or {}).items():
+        try:
+            day = datetime.strptime(value, "%Y-%m-%d").date()
+        except ValueError:
+            raise ValueError(f"Bad date: {value!r}")
+        parsed[day] = parse_slots(slots)
+    return parsed
+
+
+def _touch(doctor_id, cycle_weeks=None, anchor=None):
+    schedule = db.session.get(DoctorSchedule, doctor_id)
+    if schedule is None:
+        schedule = DoctorSchedule(
+            doctor_id=doctor_id,
+            cycle_weeks=1,
+            anchor=week_start(date.today()),
+            revision=0
+        )
+        db.session.add(schedule)
+    if cycle_weeks is not None:
+        schedule.cycle_weeks = cycle_weeks
+    if anchor is not None:
+        schedule.anchor = week_start(anchor)
+    schedule.revision += 1
+    schedule.updated_at = datetime.utcnow()
+    return schedule
+
+
+def set_template(doctor_id, weeks, anchor=None):
+    # weeks as returned by parse_weeks; the cycle length is len(weeks)
+    _touch(doctor_id, len(weeks), anchor)
+    db.session.execute(delete(ScheduleTemplateSlot).where(ScheduleTemplateSlot.doctor_id == doctor_id))
+    rows = [
+        {
+            "doctor_id": doctor_id,
+            "week": week,
+            "weekday": weekday,
+            "time_start": slot[0],
+            "time_end": slot[1],
+        }
+        for week, days in enumerate(weeks)
+        for weekday, slots in days.items()
+        for slot in slots
+    ]
+    if rows:
+        db.session.execute(insert(ScheduleTemplateSlot), rows)
+
+
+def set_overrides(doctor_id, overrides, replace_from=None):
+    # overrides: {date: [(start, end), ...]}. With replace_from, every
+    # override on or after that date not in overrides is dropped as well.
+    _touch(doctor_id)
+    stale = delete(ScheduleOverride).where(ScheduleOverride.doctor_id == doctor_id)
+    if replace_from is not None:
+        stale = stale.where(ScheduleOverride.date >= replace_from)
+    else:
+        stale = stale.where(ScheduleOverride.date.in_(list(overrides)))
+    db.session.execute(stale)
+
+    rows = []
+    for day, slots in overrides.items():
+        if not slots:
+            rows.append({"doctor_id": doctor_id, "date": day, "time_start": None, "time_end": None})
+        for slot in slots:
+            rows.append({
+                "doctor_id": doctor_id,
+                "date": day,
+                "time_start": slot[0],
+                "time_end": slot[1],
+            })
+    if rows:
+        db.session.execute(insert(ScheduleOverride), rows)
+
+
+def template(doctor_id):
+    # (schedule or None, [{weekday: [(start, end), ...]}, ...] per cycle week)
+    schedule = db.session.get(DoctorSchedule, doctor_id)
+    weeks = [{} for _ in range(schedule.cycle_weeks if schedule else 1)]
+    rows = db.session.execute(
+        select(ScheduleTemplateSlot).where(ScheduleTemplateSlot.doctor_id == doctor_id)
+        .order_by(ScheduleTemplateSlot.week, ScheduleTemplateSlot.weekday, ScheduleTemplateSlot.time_start)
+    ).scalars()
+    for row in rows:
+        if row.week < len(weeks):
+            weeks[row.week].setdefault(row.weekday, []).append((row.time_start, row.time_end))
+    return schedule, weeks
+
+
+def overrides(doctor_id, start):
+    result = {}
+    rows = db.session.execute(
+        select(ScheduleOverride).where(
+            ScheduleOverride.doctor_id == doctor_id,
+            ScheduleOverride.date >= start
+        ).order_by(ScheduleOverride.date, ScheduleOverride.time_start)
+    ).scalars()
+    for row in rows:
+        slots = result.setdefault(row.date, [])
+        if row.time_start is not None:
+            slots.append((row.time_start, row.time_end))
+    return result
+
+
+def expand(schedule, template_rows, override_rows, start, end):
+    # {date: sorted [(start, end), ...]} for start..end
+    by_day = {}
+    for row in template_rows:
+        by_day.setdefault((row.week, row.weekday), []).append((row.time_start, row.time_end))
+
+    replaced = {}
+    for row in override_rows:
+        slots = replaced.setdefault(row.date, [])
+        if row.time_start is not None:
+            slots.append((row.time_start, row.time_end))
+
+    result = {}
+    day = start
+    while day <= end:
+        if day in replaced:
+            slots = replaced[day]
+        else:
+            slots = by_day.get((cycle_week(schedule, day), day.weekday()), [])
+        result[day] = sorted(slots)
+        day += timedelta(days=1)
+    return result
+
+
+def materialize(doctor_ids=None, today=None, horizon_weeks=HORIZON_WEEKS):
+    # Returns {doctor_id: days rewritten}. Doctors without a schedule keep
+    # whatever they published by hand. The caller commits.
+    today = today or date.today()
+    end = today + timedelta(days=7 * horizon_weeks - 1)
+
+    query = select(DoctorSchedule)
+    if doctor_ids is not None:
+        query = query.where(DoctorSchedule.doctor_id.in_(doctor_ids))
+    schedules = db.session.execute(query).scalars().all()
+
+    starts = {}
+    for schedule in schedules:
+        start = today
+        if (schedule.materialized_revision == schedule.revision
+                and schedule.materialized_through is not None):
+            start = max(today, schedule.materialized_through + timedelta(days=1))
+        if start <= end:
+            starts[schedule.doctor_id] = start
+    if not starts:
+        return {}
+
+    ids = list(starts)
+    first = min(starts.values())
+    templates, day_overrides = {}, {}
+    for row in db.session.execute(
+        select(ScheduleTemplateSlot).where(ScheduleTemplateSlot.doctor_id.in_(ids))
+    ).scalars():
+        templates.setdefault(row.doctor_id, []).append(row)
+    for row in db.session.execute(
+        select(ScheduleOverride).where(
+            ScheduleOverride.doctor_id.in_(ids),
+            ScheduleOverride.date >= first,
+            ScheduleOverride.date <= end
+        )
+    ).scalars():
+        day_overrides.setdefault(row.doctor_id, []).append(row)
+    published = availability.slots_in_window(ids, first, end)
+
+    written = {}
+    for schedule in schedules:
+        if schedule.doctor_id not in starts:
+            continue
+        wanted = expand(
+            schedule,
+            templates.get(schedule.doctor_id, []),
+            day_overrides.get(schedule.doctor_id, []),
+            starts[schedule.doctor_id],
+            end
+        )
+        current = published.get(schedule.doctor_id, {})
+        changed = {
+            day: slots for day, slots in wanted.items()
+            if slots != sorted((s.time_start, s.time_end) for s in current.get(day, []))
+        }
+        if changed:
+            availability.replace_days(schedule.doctor_id, changed)
+            written[schedule.doctor_id] = len(changed)
+        schedule.materialized_revision = schedule.revision
+        schedule.materialized_through = end
+
+    return written
+
+
+def apply_department(department_id, weeks, day_overrides=None, anchor=None,
+                     doctor_ids=None, horizon_weeks=HORIZON_WEEKS):
+    # Give every doctor of a department (or the listed subset) the same
+    # template and overrides, and publish the result. Runs in the caller's
+    # transaction; returns {doctor_id: days rewritten} for every doctor
+    # touched.
+    query = select(Doctor.id).where(Doctor.department_id == department_id)
+    if doctor_ids is not None:
+        query = query.where(Doctor.id.in_(doctor_ids))
+    ids = db.session.execute(query.order_by(Doctor.id)).scalars().all()
+
+    for doctor_id in ids:
+        set_template(doctor_id, weeks, anchor)
+        if day_overrides:
+            set_overrides(doctor_id, day_overrides)
+    db.session.flush()
+
+    written = materialize(ids, horizon_weeks=horizon_weeks)
+    return {doctor_id: written.get(doctor_id, 0) for doctor_id in ids}
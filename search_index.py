@@ -0,0 +1,74 @@
+from sqlalchemy import text
+from models import db
+import re
+
+# FTS5 inverted index over doctor name, specialization and department name.
+# rowid is the doctor id. The prefix option keeps short prefix queries on the
+# index instead of expanding them term by term.
+CREATE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS doctor_search USING fts5(
+    name, specialization, department,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '1 2 3'
+)
+"""
+
+POPULATE = """
+INSERT INTO doctor_search (rowid, name, specialization, department)
+SELECT d.id, u.name, COALESCE(d.specialization, ''), COALESCE(dep.name, '')
+FROM doctors d
+JOIN users u ON u.id = d.user_id
+LEFT JOIN departments dep ON dep.id = d.department_id
+"""
+
+DEFAULT_LIMIT = 50
+
+
+def ensure_index(engine):
+    with engine.begin() as conn:
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'doctor_search'"
+        )).first()
+        if not exists:
+            conn.execute(text(CREATE))
+            conn.execute(text(POPULATE))
+
+
+def rebuild(session=None):
+    session = session or db.session
+    session.execute(text("DELETE FROM doctor_search"))
+    session.execute(text(POPULATE))
+
+
+def index_doctor(doctor_id, session=None):
+    # Call after the doctor row is flushed, inside the same transaction.
+    session = session or db.session
+    remove_doctor(doctor_id, session)
+    session.execute(text(POPULATE + " WHERE d.id = :id"), {"id": doctor_id})
+
+
+def remove_doctor(doctor_id, session=None):
+    session = session or db.session
+    session.execute(text("DELETE FROM doctor_search WHERE rowid = :id"), {"id": doctor_id})
+
+
+def match_expression(query):
+    # "car sm" -> '"car"* "sm"*': every word must match as a prefix
+    terms = re.findall(r"\w+", query.lower())
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search(query, limit=DEFAULT_LIMIT, session=None):
+    # Doctor ids ranked by bm25, name matches weighted above specialization
+    # and department.
+    session = session or db.session
+    expression = match_expression(query)
+    if not expression:
+        return []
+
+    rows = session.execute(text(
+        "SELECT rowid FROM doctor_search WHERE doctor_search MATCH :q "
+        "ORDER BY bm25(doctor_search, 3.0, 2.0, 1.0) LIMIT :limit"
+    ), {"q": expression, "limit": limit})
+
+    return [row[0] for row in rows]
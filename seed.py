@@ -0,0 +1,148 @@
+from sqlalchemy import select, func
+from models import db, User, Doctor
+from datetime import date, time, timedelta
+from werkzeug.security import generate_password_hash
+import random
+import availability
+import bulk
+import search_index
+
+# Synthetic data for load testing, written through the bulk importer so it
+# goes through the same tables and indexes as real data. Every generated
+# account shares one password.
+
+DEPARTMENTS = [
+    "Cardiology", "Neurology", "Orthopedics", "Pediatrics", "Dermatology",
+    "Oncology", "Radiology", "Psychiatry", "Gastroenterology", "Nephrology",
+    "Pulmonology", "Endocrinology", "Urology", "Ophthalmology", "ENT",
+]
+FIRST_NAMES = [
+    "Aarav", "Ananya", "Rahul", "Priya", "Arjun", "Sneha", "Vikram", "Isha",
+    "Rohan", "Kavya", "Amit", "Neha", "Sanjay", "Pooja", "Karan", "Meera",
+]
+LAST_NAMES = [
+    "Sharma", "Das", "Gupta", "Banerjee", "Iyer", "Reddy", "Patel", "Sen",
+    "Mukherjee", "Nair", "Singh", "Chatterjee", "Roy", "Bose", "Kumar", "Ghosh",
+]
+VISIT_TYPES = ["Consultation", "Follow-up", "Emergency", "Routine check-up"]
+TESTS = ["", "Blood test", "ECG", "X-Ray", "MRI", "Blood test, Urine test"]
+MEDICINES = [
+    "Paracetamol", "Amoxicillin", "Ibuprofen", "Metformin", "Atorvastatin",
+    "Omeprazole", "Cetirizine", "Azithromycin", "Amlodipine", "Pantoprazole",
+]
+DIAGNOSES = ["Viral fever", "Hypertension", "Migraine", "Diabetes", "Gastritis", "Allergy"]
+
+# the two daily slots the doctor availability form offers
+SLOTS = [(time(9, 0), time(12, 0)), (time(17, 0), time(20, 0))]
+
+PASSWORD = "password"
+EMAIL_DOMAIN = "seed.example"
+
+
+def _name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def _appointment(rng, patient_email, doctor_email, day, slot, status):
+    row = {
+        "patient_email": patient_email,
+        "doctor_email": doctor_email,
+        "date": day.isoformat(),
+        "time_start": slot[0].isoformat(),
+        "time_end": slot[1].isoformat(),
+        "status": status,
+    }
+    if status == "Completed":
+        row.update({
+            "diagnosis": rng.choice(DIAGNOSES),
+            "prescription": "As directed",
+            "visit_type": rng.choice(VISIT_TYPES),
+            "tests_done": rng.choice(TESTS),
+            "medicines": ", ".join(rng.sample(MEDICINES, rng.randint(1, 3))),
+        })
+    return row
+
+
+def _history(rng, doctor_emails, patient_emails, start, end, fill):
+    # one appointment per filled slot; a patient sees a doctor at most once a day
+    day = start
+    while day < end:
+        for doctor_email in doctor_emails:
+            slots = [slot for slot in SLOTS if rng.random() < fill]
+            patients = rng.sample(patient_emails, min(len(slots), len(patient_emails)))
+            for slot, patient_email in zip(slots, patients):
+                roll = rng.random()
+                status = "Completed" if roll < 0.85 else "Cancelled" if roll < 0.95 else "Booked"
+                yield _appointment(rng, patient_email, doctor_email, day, slot, status)
+        day += timedelta(days=1)
+
+
+def _upcoming(rng, doctor_emails, patient_emails, days, fill):
+    for day in days:
+        for doctor_email in doctor_emails:
+            slots = [slot for slot in SLOTS if rng.random() < fill]
+            patients = rng.sample(patient_emails, min(len(slots), len(patient_emails)))
+            for slot, patient_email in zip(slots, patients):
+                yield _appointment(rng, patient_email, doctor_email, day, slot, "Booked")
+
+
+def generate(departments=10, doctors=50, patients=5000, years=2, fill=0.7,
+             upcoming_fill=0.3, seed=0, batch_size=bulk.BATCH_SIZE, progress=None):
+    rng = random.Random(seed)
+    # suffix emails past the current max id so repeated runs add to the data
+    offset = db.session.execute(select(func.coalesce(func.max(User.id), 0))).scalar() + 1
+    password_hash = generate_password_hash(PASSWORD)
+
+    def report(kind):
+        return (lambda n: progress(kind, n)) if progress else None
+
+    department_names = DEPARTMENTS[:departments] + [
+        f"Department {i}" for i in range(len(DEPARTMENTS), departments)
+    ]
+    counts = {"departments": bulk.import_rows("departments", (
+        {"name": name, "description": f"{name} department"} for name in department_names
+    ), batch_size)}
+
+    doctor_emails = [f"doctor{offset + i}@{EMAIL_DOMAIN}" for i in range(doctors)]
+    counts["doctors"] = bulk.import_rows("doctors", (
+        {
+            "name": f"Dr. {_name(rng)}",
+            "email": email,
+            "password_hash": password_hash,
+            "specialization": f"{department} specialist",
+            "department": department,
+        }
+        for email, department in zip(doctor_emails, (rng.choice(department_names) for _ in doctor_emails))
+    ), batch_size, report("doctors"))
+    search_index.rebuild()
+    db.session.commit()
+
+    patient_emails = [f"patient{offset + doctors + i}@{EMAIL_DOMAIN}" for i in range(patients)]
+    counts["patients"] = bulk.import_rows("patients", (
+        {
+            "name": _name(rng),
+            "email": email,
+            "password_hash": password_hash,
+            "dob": (date(1950, 1, 1) + timedelta(days=rng.randrange(365 * 55))).isoformat(),
+            "contact": f"9{rng.randrange(10 ** 9):09d}",
+            "address": f"{rng.randrange(1, 500)} Main Road",
+        }
+        for email in patient_emails
+    ), batch_size, report("patients"))
+
+    today = date.today()
+    days = availability.window_dates(today)
+    doctor_ids = db.session.execute(
+        select(Doctor.id).join(User, User.id == Doctor.user_id).where(User.email.in_(doctor_emails))
+    ).scalars().all()
+    for doctor_id in doctor_ids:
+        availability.replace_days(doctor_id, {day: list(SLOTS) for day in days})
+    db.session.commit()
+    counts["availability"] = len(doctor_ids) * len(days) * len(SLOTS)
+
+    history = _history(rng, doctor_emails, patient_emails, today - timedelta(days=365 * years), today, fill)
+    upcoming = _upcoming(rng, doctor_emails, patient_emails, days, upcoming_fill)
+    counts["appointments"] = bulk.import_rows("appointments", history, batch_size, report("appointments"))
+    counts["appointments"] += bulk.import_rows("appointments", upcoming, batch_size)
+
+    return counts
@@ -0,0 +1,62 @@
+from sqlalchemy import select
+from models import (
+    db, User, Patient, Appointment, Treatment, TreatmentMedicine,
+    AppointmentArchive, TreatmentArchive, TreatmentMedicineArchive
+)
+import re
+
+
+def parse_legacy_notes(notes):
+    # Split the old "Visit Type: ..., Tests: ..., Medicines: ..." notes text
+    # into (visit_type, tests_done, medicines).
+    cleaned = (notes or "").replace("\n", " ").replace("  ", " ")
+
+    vt = td = md = ""
+
+    if "Visit Type:" in cleaned:
+        vt = cleaned.split("Visit Type:")[1].split("Tests:")[0]
+    if "Tests:" in cleaned:
+        td = cleaned.split("Tests:")[1].split("Medicines:")[0]
+    if "Medicines:" in cleaned:
+        md = cleaned.split("Medicines:")[1]
+
+    return (
+        vt.strip().rstrip(",").strip(),
+        td.strip().rstrip(",").strip(),
+        md.strip().rstrip(",").strip(),
+    )
+
+
+def split_medicines(text):
+    return [name.strip() for name in re.split(r"[,\n;]", text or "") if name.strip()]
+
+
+def set_medicines(treatment, text):
+    treatment.medicines = [
+        TreatmentMedicine(name=name[:200], position=i)
+        for i, name in enumerate(split_medicines(text))
+    ]
+
+
+def patients_prescribed(medicine):
+    # Distinct patients with any treatment, live or archived, listing the
+    # medicine (case-insensitive)
+    return db.session.execute(
+        select(Patient.id, User.name, User.email).join(
+            User, User.id == Patient.user_id
+        ).where(
+            Patient.id.in_(
+                select(Appointment.patient_id).join(
+                    Treatment, Treatment.appointment_id == Appointment.id
+                ).join(
+                    TreatmentMedicine, TreatmentMedicine.treatment_id == Treatment.id
+                ).where(TreatmentMedicine.name == medicine.strip()).union(
+                    select(AppointmentArchive.patient_id).join(
+                        TreatmentArchive, TreatmentArchive.appointment_id == AppointmentArchive.id
+                    ).join(
+                        TreatmentMedicineArchive, TreatmentMedicineArchive.treatment_id == TreatmentArchive.id
+                    ).where(TreatmentMedicineArchive.name == medicine.strip())
+                )
+            )
+        ).order_by(User.name)
+    ).all()
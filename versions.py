@@ -0,0 +1,52 @@
+from sqlalchemy import select
+from models import db, Doctor
+import analytics
+import database
+
+# doctors.version counts changes to anything a patient sees about a doctor:
+# profile, department name, published slots and bookings. Like the
+# analytics rollups it is bumped by triggers, so booking's INSERT ... SELECT
+# and bulk imports are covered too. updated_at is the time of the last bump
+# (UTC).
+
+BUMP = "UPDATE doctors SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE {where};"
+
+TRIGGERS = {
+    "trg_version_appointment_insert":
+        "AFTER INSERT ON appointments BEGIN " + BUMP.format(where="id = NEW.doctor_id") + " END",
+    "trg_version_appointment_update":
+        "AFTER UPDATE OF status, doctor_id, date, time_start, time_end ON appointments BEGIN "
+        + BUMP.format(where="id IN (OLD.doctor_id, NEW.doctor_id)") + " END",
+    "trg_version_appointment_delete":
+        "AFTER DELETE ON appointments " + analytics.ARCHIVED + " BEGIN "
+        + BUMP.format(where="id = OLD.doctor_id") + " END",
+    "trg_version_slot_insert":
+        "AFTER INSERT ON doctor_availability BEGIN " + BUMP.format(where="id = NEW.doctor_id") + " END",
+    "trg_version_slot_update":
+        "AFTER UPDATE ON doctor_availability BEGIN "
+        + BUMP.format(where="id IN (OLD.doctor_id, NEW.doctor_id)") + " END",
+    "trg_version_slot_delete":
+        "AFTER DELETE ON doctor_availability BEGIN " + BUMP.format(where="id = OLD.doctor_id") + " END",
+    "trg_version_doctor_update":
+        "AFTER UPDATE OF user_id, department_id, specialization ON doctors BEGIN "
+        + BUMP.format(where="id = NEW.id") + " END",
+    "trg_version_user_update":
+        "AFTER UPDATE OF name ON users BEGIN " + BUMP.format(where="user_id = NEW.id") + " END",
+    "trg_version_department_update":
+        "AFTER UPDATE OF name ON departments BEGIN " + BUMP.format(where="department_id = NEW.id") + " END",
+}
+
+
+def ensure_triggers(engine):
+    with engine.begin() as conn:
+        return database.sync_triggers(conn, "trg_version_", TRIGGERS)
+
+
+def doctor_versions(doctor_ids):
+    # {doctor_id: (version, updated_at)}, one indexed lookup
+    if not doctor_ids:
+        return {}
+    rows = db.session.execute(
+        select(Doctor.id, Doctor.version, Doctor.updated_at).where(Doctor.id.in_(doctor_ids))
+    )
+    return {row[0]: (row[1], row[2]) for row in rows}
@@ -0,0 +1,250 @@
+from sqlalchemy import select, update, func, exists, and_, event
+from sqlalchemy.orm import aliased
+from models import db, User, Doctor, Appointment, WaitlistEntry
+from datetime import date, datetime, time
+from time import monotonic
+import hashlib
+import threading
+import availability
+import booking
+
+# Per-doctor, per-day waitlists. When a booking is cancelled, release() hands
+# the freed slot to the first waiting patient inside the cancelling
+# transaction: the new appointment and the cancellation commit together or
+# not at all. Patients follow their entries through wait_for_change(), which
+# the long-poll and server-sent-events routes use instead of re-reading the
+# availability page.
+
+POLL_INTERVAL = 2.0
+QUEUE_ORDER = (WaitlistEntry.priority.desc(), WaitlistEntry.created_at, WaitlistEntry.id)
+
+_changed = threading.Condition()
+
+
+def notify():
+    with _changed:
+        _changed.notify_all()
+
+
+def _after_commit(session):
+    if session.info.pop("waitlist_changed", False):
+        notify()
+
+
+def _after_rollback(session, previous_transaction):
+    session.info.pop("waitlist_changed", None)
+
+
+event.listen(db.session, "after_commit", _after_commit)
+event.listen(db.session, "after_soft_rollback", _after_rollback)
+
+
+def _mark_changed():
+    db.session.info["waitlist_changed"] = True
+
+
+def _started(day, time_start):
+    return day < date.today() or (day == date.today() and time_start < datetime.now().time())
+
+
+def join(patient_id, doctor_id, day, priority=0):
+    # Returns (entry, None) or (None, error) where error is "past" (the day,
+    # or every slot of it, has gone), "open" (a slot is still free that day),
+    # "unavailable", "booked" or "waiting".
+    if day < date.today():
+        return None, "past"
+
+    grid = availability.grid(doctor_id, day, day)[0]["slots"]
+    if not grid:
+        return None, "unavailable"
+    grid = [slot for slot in grid if not _started(day, time.fromisoformat(slot["time_start"]))]
+    if not grid:
+        return None, "past"
+    if any(not slot["booked"] for slot in grid):
+        return None, "open"
+
+    already = db.session.execute(
+        select(
+            exists().where(
+                Appointment.patient_id == patient_id,
+                Appointment.doctor_id == doctor_id,
+                Appointment.date == day,
+                Appointment.status == "Booked"
+            ),
+            exists().where(
+                WaitlistEntry.patient_id == patient_id,
+                WaitlistEntry.doctor_id == doctor_id,
+                WaitlistEntry.date == day,
+                WaitlistEntry.status == "Waiting"
+            )
+        )
+    ).one()
+    if already[0]:
+        return None, "booked"
+    if already[1]:
+        return None, "waiting"
+
+    entry = WaitlistEntry(patient_id=patient_id, doctor_id=doctor_id, date=day, priority=priority)
+    db.session.add(entry)
+    _mark_changed()
+    return entry, None
+
+
+def leave(entry):
+    if entry.status == "Waiting":
+        entry.status = "Left"
+        entry.updated_at = datetime.utcnow()
+        _mark_changed()
+
+
+def set_priority(entry, priority):
+    entry.priority = priority
+    entry.updated_at = datetime.utcnow()
+    _mark_changed()
+
+
+def next_entry_statement(doctor_id, day):
+    # the first waiting patient who does not already hold a booking with the
+    # doctor that day
+    has_booking = exists().where(
+        Appointment.patient_id == WaitlistEntry.patient_id,
+        Appointment.doctor_id == doctor_id,
+        Appointment.date == day,
+        Appointment.status == "Booked"
+    )
+    return select(WaitlistEntry).where(
+        WaitlistEntry.doctor_id == doctor_id,
+        WaitlistEntry.date == day,
+        WaitlistEntry.status == "Waiting",
+        ~has_booking
+    ).order_by(*QUEUE_ORDER).limit(1)
+
+
+def backfill(doctor_id, day, time_start):
+    # Book the slot for the next patient in the queue, unless it has already
+    # started. The caller commits.
+    if _started(day, time_start):
+        return None
+
+    entry = db.session.execute(next_entry_statement(doctor_id, day)).scalar()
+    if entry is None:
+        return None
+
+    result = db.session.execute(booking.booking_statement(entry.patient_id, doctor_id, day, time_start))
+    if result.rowcount == 0:
+        # the slot is no longer published
+        return None
+
+    entry.status = "Assigned"
+    entry.appointment_id = result.lastrowid
+    entry.updated_at = datetime.utcnow()
+    _mark_changed()
+    return entry
+
+
+def release(appointment):
+    # Cancel a booking and pass its slot on. Returns the waitlist entry that
+    # got the slot, if any; the caller commits.
+    was_booked = appointment.status == "Booked"
+    appointment.status = "Cancelled"
+    if not was_booked:
+        return None
+    # the cancellation must reach the database before the slot is re-booked
+    db.session.flush()
+    return backfill(appointment.doctor_id, appointment.date, appointment.time_start)
+
+
+def expire(today=None):
+    result = db.session.execute(
+        update(WaitlistEntry).where(
+            WaitlistEntry.status == "Waiting",
+            WaitlistEntry.date < (today or date.today())
+        ).values(status="Expired", updated_at=datetime.utcnow())
+    )
+    if result.rowcount:
+        _mark_changed()
+    return result.rowcount
+
+
+def close(doctor_id, start, end):
+    # the doctor closed these days, nobody waiting for them will get a slot
+    result = db.session.execute(
+        update(WaitlistEntry).where(
+            WaitlistEntry.doctor_id == doctor_id,
+            WaitlistEntry.status == "Waiting",
+            WaitlistEntry.date >= start,
+            WaitlistEntry.date <= end
+        ).values(status="Expired", updated_at=datetime.utcnow())
+    )
+    if result.rowcount:
+        _mark_changed()
+    return result.rowcount
+
+
+def entries(patient_id, since=None):
+    # The patient's waiting entries, and assigned ones from today on, with
+    # their place in the queue.
+    ahead = aliased(WaitlistEntry)
+    position = select(func.count(ahead.id) + 1).where(
+        ahead.doctor_id == WaitlistEntry.doctor_id,
+        ahead.date == WaitlistEntry.date,
+        ahead.status == "Waiting",
+        (ahead.priority > WaitlistEntry.priority)
+        | and_(ahead.priority == WaitlistEntry.priority, ahead.created_at < WaitlistEntry.created_at)
+        | and_(ahead.priority == WaitlistEntry.priority, ahead.created_at == WaitlistEntry.created_at,
+               ahead.id < WaitlistEntry.id)
+    ).scalar_subquery()
+
+    rows = db.session.execute(
+        select(
+            WaitlistEntry.id, WaitlistEntry.doctor_id, User.name, WaitlistEntry.date,
+            WaitlistEntry.status, WaitlistEntry.appointment_id, Appointment.time_start,
+            position
+        ).join(
+            Doctor, Doctor.id == WaitlistEntry.doctor_id
+        ).join(
+            User, User.id == Doctor.user_id
+        ).outerjoin(
+            Appointment, Appointment.id == WaitlistEntry.appointment_id
+        ).where(
+            WaitlistEntry.patient_id == patient_id,
+            WaitlistEntry.status.in_(("Waiting", "Assigned")),
+            WaitlistEntry.date >= (since or date.today())
+        ).order_by(WaitlistEntry.date, WaitlistEntry.id)
+    ).all()
+
+    return [
+        {
+            "id": row[0],
+            "doctor_id": row[1],
+            "doctor": row[2],
+            "date": row[3].strftime("%Y-%m-%d"),
+            "status": row[4],
+            "appointment_id": row[5],
+            "time_start": row[6].strftime("%H:%M") if row[6] else None,
+            "position": row[7] if row[4] == "Waiting" else None,
+        }
+        for row in rows
+    ]
+
+
+def state_token(items):
+    raw = "|".join(f"{i['id']}:{i['status']}:{i['position']}" for i in items)
+    return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+
+def wait_for_change(patient_id, token=None, timeout=25.0):
+    # Block until the patient's entries differ from token or timeout passes.
+    # Commits in this process wake waiters at once; changes made by other
+    # processes are seen within POLL_INTERVAL.
+    deadline = monotonic() + timeout
+    while True:
+        # end the read transaction so the next query sees new commits
+        db.session.rollback()
+        items = entries(patient_id)
+        current = state_token(items)
+        remaining = deadline - monotonic()
+        if current != token or remaining <= 0:
+            return items, current
+        with _changed:
+            _changed.wait(min(POLL_INTERVAL, remaining))